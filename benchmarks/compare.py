@@ -0,0 +1,69 @@
+"""Compare benchmark results saved by `python -m benchmarks.run --output`.
+
+Usage: `python -m benchmarks.compare baseline.json candidate.json [...]`. Every result
+is compared against the first one.
+"""
+import argparse
+import json
+from typing import Any, Dict, List
+
+# The reported metrics, with whether a higher value is better
+METRICS = (
+    ("messages_per_s", "msgs/s", True),
+    ("latency_p50_ms", "p50 ms", False),
+    ("latency_p99_ms", "p99 ms", False),
+    ("peak_rss_mib", "RSS MiB", False),
+    ("failed", "failed", False),
+)
+
+
+def load_result(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def describe(result: Dict[str, Any]) -> str:
+    """A short label of the commit a result was measured at"""
+    commit = result.get("commit") or "unknown"
+    return f"{commit}{'+dirty' if result.get('dirty') else ''}"
+
+
+def format_comparison(results: List[Dict[str, Any]]) -> str:
+    """Format a table of results, with each metric's change relative to the first"""
+    baseline = results[0]["results"]
+    rows = [["commit"] + [label for _, label, _ in METRICS]]
+    for result in results:
+        row = [describe(result)]
+        for key, _, higher_is_better in METRICS:
+            value = result["results"][key]
+            cell = f"{value:.1f}" if isinstance(value, float) else str(value)
+            if result is not results[0] and baseline[key]:
+                change = (value - baseline[key]) / baseline[key] * 100
+                better = (change > 0) == higher_is_better
+                # Flag regressions, ignoring noise below a percent
+                flag = "" if better or abs(change) < 1 else " !"
+                cell += f" ({change:+.0f}%{flag})"
+            row.append(cell)
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip() for row in rows
+    ]
+
+    params = {json.dumps(result["params"], sort_keys=True) for result in results}
+    if len(params) > 1:
+        lines.append("Warning: the results were measured with different parameters")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("results", nargs="+", help="result files, baseline first")
+    args = parser.parse_args()
+
+    print(format_comparison([load_result(path) for path in args.results]))
+
+
+if __name__ == "__main__":
+    main()
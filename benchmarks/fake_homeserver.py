@@ -0,0 +1,379 @@
+"""A minimal stand-in for a Matrix homeserver, for benchmarking nio-send.
+
+Implements just enough of the Client-Server API for the bot to log in, sync, create
+DM rooms, invite users, upload media and send messages. Every request can be delayed
+by a configurable latency, and requests can be rate limited, either by a per-endpoint
+rate or at random, to see how the bot copes with a loaded homeserver.
+
+End-to-end encryption is not implemented: rooms are created unencrypted, whatever
+initial state the bot asks for.
+
+Run it on its own with `python -m benchmarks.fake_homeserver --port 8008`.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+CLIENT_PATH = "/_matrix/client/{version}"
+MEDIA_PATH = "/_matrix/media/{version}"
+
+# Requests that can be rate limited, by the name of their route
+RATE_LIMITED_ROUTES = ("login", "create_room", "invite", "upload", "send")
+
+
+class FakeHomeserver:
+    def __init__(
+        self,
+        server_name: str = "localhost",
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        rate: Optional[float] = None,
+        burst: int = 10,
+        error_rate: float = 0,
+        retry_after_ms: int = 1000,
+    ):
+        """
+        Args:
+            server_name: The domain of the user and room IDs.
+
+            latency_ms: The delay added to every request.
+
+            jitter_ms: A random delay of up to this many milliseconds added on top.
+
+            rate: The requests per second allowed for each rate limited endpoint,
+                with bursts of `burst` requests. Unlimited if None.
+
+            burst: The number of requests allowed at once when rate limiting.
+
+            error_rate: The fraction of rate limited endpoint requests that are
+                answered with a 429 at random, regardless of `rate`.
+
+            retry_after_ms: The `retry_after_ms` of 429 responses.
+        """
+        self.server_name = server_name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate = rate
+        self.burst = burst
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+
+        # route name -> (tokens, last refill)
+        self._buckets: Dict[str, List[float]] = {}
+
+        # Every event, in the order it happened. The sync token is the number of
+        # events a client has seen.
+        self.events: List[Dict[str, Any]] = []
+        self._new_events = asyncio.Condition()
+        self._ids = itertools.count()
+
+        # (room ID, transaction ID) -> event ID, so that resending is idempotent
+        self.transactions: Dict[tuple, str] = {}
+
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "rooms_created": 0,
+            "invites": 0,
+            "uploads": 0,
+            "messages": 0,
+        }
+
+    def make_app(self) -> web.Application:
+        app = web.Application(
+            middlewares=[self._latency_middleware], client_max_size=1024**3
+        )
+        for version in ("r0", "v3"):
+            client = CLIENT_PATH.format(version=version)
+            media = MEDIA_PATH.format(version=version)
+            app.router.add_post(f"{client}/login", self.login, name=f"login_{version}")
+            app.router.add_get(f"{client}/sync", self.sync)
+            app.router.add_post(f"{client}/user/{{user_id}}/filter", self.filter)
+            app.router.add_post(
+                f"{client}/createRoom", self.create_room, name=f"create_room_{version}"
+            )
+            app.router.add_post(
+                f"{client}/rooms/{{room_id}}/invite",
+                self.invite,
+                name=f"invite_{version}",
+            )
+            app.router.add_put(
+                f"{client}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}",
+                self.send,
+                name=f"send_{version}",
+            )
+            app.router.add_post(
+                f"{media}/upload", self.upload, name=f"upload_{version}"
+            )
+        return app
+
+    @web.middleware
+    async def _latency_middleware(self, request: web.Request, handler):
+        self.stats["requests"] += 1
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+        route = request.match_info.route.name
+        if route is not None and route.rsplit("_", 1)[0] in RATE_LIMITED_ROUTES:
+            if self._is_rate_limited(route.rsplit("_", 1)[0]):
+                self.stats["rate_limited"] += 1
+                return web.json_response(
+                    {
+                        "errcode": "M_LIMIT_EXCEEDED",
+                        "error": "Too many requests",
+                        "retry_after_ms": self.retry_after_ms,
+                    },
+                    status=429,
+                )
+        return await handler(request)
+
+    def _is_rate_limited(self, route: str) -> bool:
+        if self.error_rate and random.random() < self.error_rate:
+            return True
+        if self.rate is None:
+            return False
+
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(route, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[route] = [tokens, now]
+            return True
+        self._buckets[route] = [tokens - 1, now]
+        return False
+
+    def _id(self, sigil: str) -> str:
+        return f"{sigil}{next(self._ids)}{uuid.uuid4().hex[:8]}:{self.server_name}"
+
+    async def _add_event(
+        self,
+        room_id: str,
+        event_type: str,
+        sender: str,
+        content: Dict[str, Any],
+        state_key: Optional[str] = None,
+    ) -> str:
+        event = {
+            "room_id": room_id,
+            "type": event_type,
+            "event_id": self._id("$"),
+            "sender": sender,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+            "unsigned": {},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+
+        async with self._new_events:
+            self.events.append(event)
+            self._new_events.notify_all()
+        return event["event_id"]
+
+    @staticmethod
+    def _user_id(request: web.Request) -> str:
+        # The access token is the user ID it was issued to
+        return request.headers.get("Authorization", "").replace("Bearer ", "", 1)
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        user = body.get("identifier", {}).get("user") or body.get("user")
+        user_id = user if user.startswith("@") else f"@{user}:{self.server_name}"
+        return web.json_response(
+            {
+                "user_id": user_id,
+                "access_token": user_id,
+                "device_id": body.get("device_id") or "BENCHMARK",
+            }
+        )
+
+    async def filter(self, request: web.Request) -> web.Response:
+        # Filters are accepted, but syncs always return every event
+        await request.json()
+        return web.json_response({"filter_id": str(next(self._ids))})
+
+    async def sync(self, request: web.Request) -> web.Response:
+        since = int(request.query.get("since", 0))
+        timeout_ms = int(request.query.get("timeout", 0))
+
+        async with self._new_events:
+            if len(self.events) <= since and timeout_ms > 0:
+                try:
+                    await asyncio.wait_for(
+                        self._new_events.wait_for(lambda: len(self.events) > since),
+                        timeout_ms / 1000,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            events = self.events[since:]
+
+        join: Dict[str, Any] = {}
+        for event in events:
+            room = join.setdefault(
+                event["room_id"],
+                {
+                    "timeline": {"events": [], "limited": False, "prev_batch": "0"},
+                    "state": {"events": []},
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                    "summary": {},
+                    "unread_notifications": {},
+                },
+            )
+            room["timeline"]["events"].append(
+                {key: value for key, value in event.items() if key != "room_id"}
+            )
+
+        return web.json_response(
+            {
+                "next_batch": str(since + len(events)),
+                "rooms": {"join": join, "invite": {}, "leave": {}},
+                "to_device": {"events": []},
+                "device_lists": {"changed": [], "left": []},
+                "device_one_time_keys_count": {},
+                "presence": {"events": []},
+                "account_data": {"events": []},
+            }
+        )
+
+    async def create_room(self, request: web.Request) -> web.Response:
+        self.stats["rooms_created"] += 1
+        body = await request.json()
+        sender = self._user_id(request)
+        room_id = self._id("!")
+
+        await self._add_event(room_id, "m.room.create", sender, {"creator": sender}, "")
+        await self._add_event(
+            room_id, "m.room.member", sender, {"membership": "join"}, sender
+        )
+        for state in body.get("initial_state", []):
+            # Encryption is not supported, so rooms stay unencrypted
+            if state["type"] == "m.room.encryption":
+                continue
+            await self._add_event(
+                room_id,
+                state["type"],
+                sender,
+                state["content"],
+                state.get("state_key", ""),
+            )
+        if body.get("name"):
+            await self._add_event(
+                room_id, "m.room.name", sender, {"name": body["name"]}, ""
+            )
+        for user_id in body.get("invite", []):
+            await self._add_event(
+                room_id,
+                "m.room.member",
+                sender,
+                {"membership": "invite", "is_direct": body.get("is_direct", False)},
+                user_id,
+            )
+
+        return web.json_response({"room_id": room_id})
+
+    async def invite(self, request: web.Request) -> web.Response:
+        self.stats["invites"] += 1
+        body = await request.json()
+        await self._add_event(
+            request.match_info["room_id"],
+            "m.room.member",
+            self._user_id(request),
+            {"membership": "invite"},
+            body["user_id"],
+        )
+        return web.json_response({})
+
+    async def upload(self, request: web.Request) -> web.Response:
+        self.stats["uploads"] += 1
+        # Read the whole body, so uploads cost what they would on a real server
+        async for _ in request.content.iter_chunked(64 * 1024):
+            pass
+        return web.json_response(
+            {"content_uri": f"mxc://{self.server_name}/{uuid.uuid4().hex}"}
+        )
+
+    async def send(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        key = (room_id, request.match_info["txn_id"])
+        event_id = self.transactions.get(key)
+        if event_id is None:
+            self.stats["messages"] += 1
+            event_id = await self._add_event(
+                room_id,
+                request.match_info["event_type"],
+                self._user_id(request),
+                await request.json(),
+            )
+            self.transactions[key] = event_id
+        return web.json_response({"event_id": event_id})
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of the fake homeserver to a command line parser"""
+    group = parser.add_argument_group("fake homeserver")
+    group.add_argument(
+        "--latency-ms", type=float, default=0, help="delay added to every request"
+    )
+    group.add_argument(
+        "--jitter-ms",
+        type=float,
+        default=0,
+        help="random delay of up to this many milliseconds added to every request",
+    )
+    group.add_argument(
+        "--server-rate",
+        type=float,
+        default=None,
+        help="requests per second allowed per endpoint before answering with 429",
+    )
+    group.add_argument(
+        "--server-burst",
+        type=int,
+        default=10,
+        help="requests allowed at once per endpoint when --server-rate is set",
+    )
+    group.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="fraction of requests answered with 429 at random",
+    )
+    group.add_argument(
+        "--retry-after-ms",
+        type=int,
+        default=1000,
+        help="retry_after_ms of 429 responses",
+    )
+
+
+def from_arguments(args: argparse.Namespace) -> FakeHomeserver:
+    return FakeHomeserver(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate=args.server_rate,
+        burst=args.server_burst,
+        error_rate=args.error_rate,
+        retry_after_ms=args.retry_after_ms,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    web.run_app(from_arguments(args).make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Measure the sending throughput, latency and memory use of nio-send.
+
+Starts the fake homeserver in a subprocess, logs in to it and sends N recipients x M
+messages through `Callbacks.send_msg`, the way a campaign is sent. Reports the
+messages sent per second, the p50/p99 time from handing a message to `send_msg` until
+it was sent, and the peak resident memory of the bot.
+
+Usage: `python -m benchmarks.run --recipients 100 --messages 5 --output HEAD.json`.
+Save a result per commit and compare them with `--compare` or `benchmarks.compare`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import yaml
+from nio import (
+    AsyncClient,
+    AsyncClientConfig,
+    KeysQueryResponse,
+    RoomMemberEvent,
+    SyncResponse,
+)
+
+from benchmarks import fake_homeserver
+from benchmarks.compare import format_comparison, load_result
+from nio_send.callbacks import Callbacks
+from nio_send.campaign import CampaignMessage, MessageState, run_campaign
+from nio_send.config import Config
+from nio_send.ratelimit import DEFAULT_LIMITS, RateLimiter
+from nio_send.storage import Storage
+from nio_send.sync import get_sync_filters
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_IMAGE = os.path.join(PROJECT_DIR, "example", "toads.jpg")
+
+# Client side rate limits high enough to never hold back a benchmark
+UNLIMITED_RATE = {"rate": 100000, "burst": 100000}
+
+
+class BenchmarkCallbacks(Callbacks):
+    """Callbacks that time every message from `send_msg` until it was processed"""
+
+    def __init__(self, client, store, config):
+        super().__init__(client, store, config)
+        self.started: Dict[str, float] = {}
+        self.latencies: List[float] = []
+        self.states: Dict[str, int] = {}
+        self.first_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+
+    async def send_msg(self, *args, txn_id: str = None, **kwargs):
+        now = time.perf_counter()
+        self.started[txn_id] = now
+        if self.first_started is None:
+            self.first_started = now
+        await super().send_msg(*args, txn_id=txn_id, **kwargs)
+
+    async def _finish_message(self, txn_id: Optional[str], state: str) -> None:
+        self.last_finished = time.perf_counter()
+        self.latencies.append(self.last_finished - self.started.pop(txn_id))
+        self.states[state] = self.states.get(state, 0) + 1
+        await super()._finish_message(txn_id, state)
+
+
+def make_config(directory: str, homeserver_url: str, args: argparse.Namespace):
+    """Write a bot config for the benchmark, and load it"""
+    if args.client_limits == "unlimited":
+        ratelimit = {endpoint: UNLIMITED_RATE for endpoint in DEFAULT_LIMITS}
+    else:
+        ratelimit = {}
+
+    config = {
+        "matrix": {
+            "user_name": "bench",
+            "user_suffix": "localhost",
+            "user_password": "benchmark",
+            "homeserver_url": homeserver_url,
+            "device_id": "BENCHMARK",
+            "device_name": "nio-send benchmark",
+        },
+        "sending": {"max_concurrent_sends": args.concurrency},
+        "ratelimit": ratelimit,
+        "storage": {
+            "database": f"sqlite://{os.path.join(directory, 'bot.db')}",
+            "store_path": os.path.join(directory, "store"),
+        },
+        "logging": {
+            "level": args.log_level,
+            "file_logging": {"enabled": False},
+            "console_logging": {"enabled": True},
+        },
+    }
+    path = os.path.join(directory, "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return Config(path)
+
+
+def make_messages(args: argparse.Namespace) -> List[CampaignMessage]:
+    messages = []
+    for recipient in range(args.recipients):
+        user_id = f"@user{recipient}:localhost"
+        for index in range(args.messages):
+            if index < args.images:
+                messages.append(CampaignMessage(user_id, "image", args.image))
+            else:
+                messages.append(
+                    CampaignMessage(user_id, "text", f"Message {index} to {user_id}")
+                )
+    return messages
+
+
+async def send_messages(homeserver_url: str, args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory() as directory:
+        config = make_config(directory, homeserver_url, args)
+        store = Storage(config.database)
+        client = AsyncClient(
+            config.homeserver_url,
+            config.user_id,
+            device_id=config.device_id,
+            store_path=config.store_path,
+            # The fake homeserver does not implement end-to-end encryption
+            config=AsyncClientConfig(
+                max_limit_exceeded=0, max_timeouts=0, encryption_enabled=False
+            ),
+        )
+        client.rate_limiter = RateLimiter(
+            config.rate_limits, config.ratelimit_max_retries
+        )
+
+        callbacks = BenchmarkCallbacks(client, store, config)
+        client.add_event_callback(callbacks.member, (RoomMemberEvent,))
+        client.add_response_callback(callbacks.readiness.on_sync, SyncResponse)
+        client.add_response_callback(
+            callbacks.readiness.on_keys_query, KeysQueryResponse
+        )
+
+        try:
+            await client.login(password=config.user_password)
+            first_sync_filter, sync_filter = await get_sync_filters(
+                client, config.sync_lazy_load_members
+            )
+            sync_task = asyncio.create_task(
+                client.sync_forever(
+                    30000,
+                    sync_filter,
+                    full_state=True,
+                    first_sync_filter=first_sync_filter,
+                )
+            )
+            callbacks.main_loop = sync_task
+            await client.synced.wait()
+
+            await run_campaign(callbacks, "benchmark", make_messages(args))
+            callbacks.finish_queueing()
+            try:
+                await asyncio.wait_for(sync_task, args.timeout)
+            except asyncio.CancelledError:
+                # Cancelled by the callbacks once every message was processed
+                pass
+        finally:
+            await client.close()
+            await store.close()
+
+    latencies = sorted(callbacks.latencies)
+    duration = (callbacks.last_finished or 0) - (callbacks.first_started or 0)
+    sent = callbacks.states.get(MessageState.SENT, 0)
+    return {
+        "messages": len(latencies),
+        "sent": sent,
+        "failed": len(latencies) - sent,
+        "duration_s": duration,
+        "messages_per_s": sent / duration if duration > 0 else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def peak_rss_mib() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and KiB everywhere else
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port: int, process: subprocess.Popen) -> None:
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("The fake homeserver failed to start")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+def git_revision() -> Dict[str, Any]:
+    """The commit the benchmark ran at, and whether the tree had changes"""
+
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=PROJECT_DIR, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    # The homeserver runs in its own process, so it doesn't count towards the bot's
+    # memory or compete with it for the event loop
+    port = free_port()
+    server_args = [
+        "--port",
+        str(port),
+        "--latency-ms",
+        str(args.latency_ms),
+        "--jitter-ms",
+        str(args.jitter_ms),
+        "--server-burst",
+        str(args.server_burst),
+        "--error-rate",
+        str(args.error_rate),
+        "--retry-after-ms",
+        str(args.retry_after_ms),
+    ]
+    if args.server_rate is not None:
+        server_args += ["--server-rate", str(args.server_rate)]
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_homeserver", *server_args],
+        cwd=PROJECT_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        await wait_for_port(port, process)
+        results = await send_messages(f"http://127.0.0.1:{port}", args)
+    finally:
+        process.terminate()
+        process.wait()
+
+    params = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("output", "compare", "log_level", "timeout")
+    }
+    return {**git_revision(), "params": params, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", "-n", type=int, default=50)
+    parser.add_argument(
+        "--messages", "-m", type=int, default=4, help="messages per recipient"
+    )
+    parser.add_argument(
+        "--images",
+        type=int,
+        default=0,
+        help="how many of the messages to each recipient are images",
+    )
+    parser.add_argument("--image", default=DEFAULT_IMAGE, help="the image to send")
+    parser.add_argument(
+        "--concurrency", type=int, default=10, help="sending.max_concurrent_sends"
+    )
+    parser.add_argument(
+        "--client-limits",
+        choices=("unlimited", "default"),
+        default="unlimited",
+        help="lift the bot's own rate limits, or use its defaults",
+    )
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", "-o", help="save the result to this JSON file")
+    parser.add_argument(
+        "--compare",
+        nargs="+",
+        default=[],
+        help="saved results to compare this run with, baseline first",
+    )
+    fake_homeserver.add_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    print(format_comparison([load_result(path) for path in args.compare] + [result]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+# noinspection PyPackageRequirements
+from nio import (
+    AsyncClient,
+    AsyncClientConfig,
+    KeysQueryResponse,
+    LocalProtocolError,
+    LoginError,
+    RoomMemberEvent,
+    SyncResponse,
+)
+
+from nio_send.callbacks import Callbacks
+from nio_send.config import AccountConfig, Config
+from nio_send.preparation import FilePreparer
+from nio_send.ratelimit import RateLimiter
+from nio_send.snapshot import SyncSnapshot
+from nio_send.storage import Storage
+from nio_send.sync import get_sync_filters
+from nio_send.utils import AliasResolver, get_username, sleep_ms
+
+logger = logging.getLogger(__name__)
+
+# The number of points of each account on the hash ring. More points spread the users
+# more evenly over the accounts.
+RING_REPLICAS = 100
+
+
+class HashRing:
+    def __init__(self, nodes: List[str], replicas: int = RING_REPLICAS):
+        """Assigns keys to nodes by consistent hashing.
+
+        A key always maps to the same node, and adding or removing a node only moves
+        the keys of that node, rather than reshuffling all of them.
+
+        Args:
+            nodes: The nodes to assign keys to.
+
+            replicas: The number of points of each node on the ring.
+        """
+        # (hash, node), sorted by hash
+        self.points = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key: str) -> str:
+        """Get the node of a key: the first node clockwise of the key on the ring"""
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class Account:
+    def __init__(
+        self,
+        config: Config,
+        account: AccountConfig,
+        store: Storage,
+        alias_resolver: AliasResolver,
+        file_preparer: Optional[FilePreparer] = None,
+    ):
+        """One of the accounts messages are sent from, with a client of its own.
+
+        Each account logs in, syncs and keeps its DM rooms separately, and has its own
+        rate limiter, as homeservers rate limit every account separately.
+
+        Args:
+            config: Bot configuration parameters.
+
+            account: The login details of the account.
+
+            store: Bot storage, shared by all accounts.
+
+            alias_resolver: Resolves room aliases, shared by all accounts.
+
+            file_preparer: Prepares files for sending in worker processes, shared by
+                all accounts. Files are prepared on the event loop if not given.
+        """
+        self.config = config
+        self.account = account
+        self.store = store
+
+        # Configuration options for the AsyncClient
+        client_config = AsyncClientConfig(
+            max_limit_exceeded=0,
+            max_timeouts=0,
+            store_sync_tokens=True,
+            encryption_enabled=True,
+        )
+
+        # Initialize the matrix client
+        self.client = AsyncClient(
+            config.homeserver_url,
+            account.user_id,
+            device_id=account.device_id,
+            store_path=account.store_path,
+            config=client_config,
+        )
+        # Known before logging in, as the account's rows in the database are keyed by it
+        self.client.user_id = account.user_id
+        if account.user_token:
+            self.client.access_token = account.user_token
+
+        self.client.user_name = get_username(account.user_id)
+        # Shared by every request of the client, so they stay below the server's limits
+        self.client.rate_limiter = RateLimiter(
+            config.rate_limits, config.ratelimit_max_retries
+        )
+        self.client.alias_resolver = alias_resolver
+        self.client.file_preparer = file_preparer
+
+        # Set up event callbacks for receiving room member events
+        self.callbacks = Callbacks(self.client, store, config)
+        self.client.add_event_callback(self.callbacks.member, (RoomMemberEvent,))
+        self.client.add_response_callback(
+            self.callbacks.readiness.on_sync, SyncResponse
+        )
+        self.client.add_response_callback(
+            self.callbacks.readiness.on_keys_query, KeysQueryResponse
+        )
+        self.snapshot = SyncSnapshot(self.client, store, self.callbacks.dm_index)
+
+        self.first_sync_filter = self.sync_filter = None
+        self.restored = False
+
+    @property
+    def user_id(self) -> str:
+        return self.account.user_id
+
+    @property
+    def is_main(self) -> bool:
+        """Whether this is the account of the `matrix` section of the config"""
+        return self.account == self.config.accounts[0]
+
+    async def load(self) -> None:
+        """Load the state persisted by earlier runs"""
+        if self.is_main:
+            # The DM rooms stored before there were several accounts are its own
+            await self.store.claim_direct_rooms(self.user_id)
+        await self.callbacks.dm_index.load()
+        await self.callbacks.media_cache.evict_stale()
+
+    async def login(self) -> bool:
+        """Log in, returning whether it succeeded"""
+        client = self.client
+        if self.account.user_token:
+            # Use token to log in
+            client.load_store()
+            # Sync encryption keys with the server
+            if client.should_upload_keys:
+                await client.keys_upload()
+        else:
+            # Try to login with the configured username/password
+            try:
+                login_response = await client.login(
+                    password=self.account.user_password,
+                    device_name=self.account.device_name,
+                )
+                # Check if login failed
+                if type(login_response) == LoginError:
+                    if login_response.status_code == "M_LIMIT_EXCEEDED":
+                        await sleep_ms(login_response.retry_after_ms)
+                        login_response = await client.login(
+                            password=self.account.user_password,
+                            device_name=self.account.device_name,
+                        )
+                    if type(login_response) == LoginError:
+                        logger.error(
+                            f"Failed to login as {self.user_id}: "
+                            f"{login_response.message}"
+                        )
+                        return False
+            except LocalProtocolError as e:
+                # There's an edge case here where the user hasn't installed the correct C
+                # dependencies. In that case, a LocalProtocolError is raised on login.
+                logger.fatal(
+                    "Failed to login. Have you installed the correct dependencies? "
+                    "https://github.com/poljar/matrix-nio#installation "
+                    "Error: %s",
+                    e,
+                )
+                return False
+
+        # Login succeeded!
+        logger.info(f"Logged in as {self.user_id}")
+        return True
+
+    async def prepare(self) -> bool:
+        """Get ready to sync, returning whether it succeeded"""
+        client = self.client
+        config = self.config
+        if config.sync_filter:
+            self.first_sync_filter, self.sync_filter = await get_sync_filters(
+                client, config.sync_lazy_load_members
+            )
+
+        # With a snapshot of the rooms from the last run, sending starts right away and
+        # the first sync only catches up with what changed since, in the background
+        if config.sync_snapshot:
+            self.restored = await self.snapshot.restore()
+            client.add_response_callback(self.snapshot.on_sync, SyncResponse)
+
+        if config.sync_send_only and not self.restored:
+            # A single sync, to learn the rooms we are in. Long-polling only starts
+            # once a room has to be created, to be told when its user was invited.
+            sync_response = await client.sync(
+                0, self.first_sync_filter, full_state=True
+            )
+            if not isinstance(sync_response, SyncResponse):
+                logger.error(f"Failed to sync {self.user_id}: {sync_response}")
+                return False
+            if client.should_upload_keys:
+                await client.keys_upload()
+            if config.sync_snapshot:
+                await self.snapshot.save()
+
+        return True
+
+    def start_syncing(self) -> asyncio.Task:
+        """Start the sync loop, which the account's callbacks stop once every message
+        was sent"""
+        task = asyncio.create_task(self._sync())
+        self.callbacks.main_loop = task
+        return task
+
+    async def _sync(self) -> None:
+        if self.config.sync_send_only:
+            await self.callbacks.sync_needed.wait()
+            await self.client.sync_forever(30000, self.sync_filter)
+        else:
+            await self.client.sync_forever(
+                30000,
+                self.sync_filter,
+                full_state=None if self.restored else True,
+                first_sync_filter=self.first_sync_filter,
+            )
+
+    async def wait_ready(self) -> None:
+        """Wait until messages can be sent from the account"""
+        if not self.config.sync_send_only and not self.restored:
+            await self.client.synced.wait()
+
+        # Only scans the joined rooms if no DM rooms were persisted yet
+        await self.callbacks.dm_index.build()
+
+    async def close(self, campaign: str) -> None:
+        """Save the account's state and log its statistics, then log out"""
+        callbacks = self.callbacks
+        if self.config.sync_snapshot:
+            await self.snapshot.save()
+        if callbacks.provisioner.started_at is not None:
+            callbacks.provisioner.log_rate()
+        callbacks.room_workers.log_summary()
+        callbacks.session_policy.log_summary(campaign)
+        logger.info(
+            f"Event dedup cache of {self.user_id}: {callbacks.received_events.hits} "
+            f"hits, {callbacks.received_events.misses} misses"
+        )
+        await self.client.close()
+
+
+class AccountPool:
+    def __init__(self, accounts: List[Account], config: Config, store: Storage):
+        """Spreads the messages of a campaign over several accounts.
+
+        A user already sharing a DM room with one of the accounts hears from that
+        account. Other users are assigned to accounts by consistent hashing, so each
+        user always hears from the same account and keeps the DM room it creates, and
+        adding an account only moves the users it takes over. Each account sends
+        through its own callbacks, so the pool sends as fast as all of their rate
+        limits allow.
+
+        The pool stands in for the callbacks of a single account when running a
+        campaign.
+
+        Args:
+            accounts: The accounts to send from.
+
+            config: Bot configuration parameters.
+
+            store: Bot storage, shared by all accounts.
+        """
+        self.accounts = accounts
+        self.config = config
+        self.store = store
+
+        # user ID -> account
+        self.by_user_id: Dict[str, Account] = {
+            account.user_id: account for account in accounts
+        }
+        self.ring = HashRing(list(self.by_user_id))
+
+    @property
+    def max_in_flight(self) -> int:
+        """The number of campaign messages handled at once, by all accounts"""
+        return sum(account.callbacks.max_in_flight for account in self.accounts)
+
+    def account_for(self, mxid: str) -> Account:
+        """Get the account that sends to a user: the account with a DM room with the
+        user if there is one (the ring's choice, if several have one), and otherwise
+        the account the user hashes to"""
+        hashed = self.by_user_id[self.ring.get(mxid)]
+        if mxid in hashed.callbacks.dm_index.rooms:
+            return hashed
+        for account in self.accounts:
+            if mxid in account.callbacks.dm_index.rooms:
+                return account
+        return hashed
+
+    async def send_msg(self, mxid: str, *args, **kwargs) -> None:
+        await self.account_for(mxid).callbacks.send_msg(mxid, *args, **kwargs)
+
+    def finish_queueing(self) -> None:
+        for account in self.accounts:
+            account.callbacks.finish_queueing()
+
+
+async def wait_for_tasks(tasks: List[asyncio.Task]) -> None:
+    """Wait until every task has finished or was cancelled.
+
+    The sync loop of each account is cancelled by its callbacks once it has sent its
+    messages, which is not an error.
+
+    Raises:
+        The exception of the first task that failed, after cancelling the others.
+    """
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                for other in pending:
+                    other.cancel()
+                raise task.exception()
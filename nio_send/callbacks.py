@@ -1,22 +1,23 @@
 import asyncio
 import logging
-from datetime import datetime
+from typing import Dict, NamedTuple, Optional
 
 # noinspection PyPackageRequirements
-from nio import MatrixRoom, RoomCreateResponse, RoomMemberEvent
-
-from nio_send.chat_functions import (
-    create_private_room,
-    find_private_msg,
-    send_file_to_room,
-    send_text_to_room,
-)
-from nio_send.utils import with_ratelimit
+from nio import MatrixRoom, RoomMemberEvent, RoomSendResponse
+
+from nio_send.campaign import MESSAGE_TYPES, MessageState
+from nio_send.chat_functions import send_file_to_room, send_text_to_room
+from nio_send.direct_rooms import DirectRoomIndex
+from nio_send.media import MediaCache
+from nio_send.prewarm import SessionPrewarmer
+from nio_send.provisioning import RoomProvisioner
+from nio_send.readiness import RoomReadinessTracker
+from nio_send.room_workers import RoomWorkers
+from nio_send.sessions import GroupSessionPolicy
+from nio_send.utils import KeyedLock, LRUCache, with_ratelimit
 
 logger = logging.getLogger(__name__)
 
-DUPLICATES_CACHE_SIZE = 1000
-
 
 class Callbacks(object):
     def __init__(self, client, store, config):
@@ -29,24 +30,64 @@ class Callbacks(object):
         self.client = client
         self.store = store
         self.config = config
-        self.received_events = []
+        # The IDs of the events already processed, as syncs may repeat events
+        self.received_events = LRUCache(config.dedup_cache_size, config.dedup_cache_ttl)
+        self.dm_index = DirectRoomIndex(client, store)
+        self.media_cache = MediaCache(store, config.media_cache_max_age)
 
         self.rooms_pending = {}
         self.user_rooms_pending = {}
-        self.lock = asyncio.Lock()
+        # Per-user locks, so that only one DM is created for each user
+        self.user_locks = KeyedLock()
+        # Caps the number of requests in flight at once, across all users
+        self.send_slots = asyncio.Semaphore(config.max_concurrent_sends)
+        # Creates new DM rooms, next to and independently of sending
+        self.provisioner = RoomProvisioner(client, config.max_concurrent_room_creates)
         self.items_to_send = 0
+        self.all_messages_queued = False
         self.main_loop = None
+        # Set once the sync loop is needed, in send-only mode
+        self.sync_needed = asyncio.Event()
+        # Follows new rooms until messages can be sent to them
+        self.readiness = RoomReadinessTracker(client, config.room_ready_timeout)
+        self.waiting_rooms = set()
+        self.prewarmer = SessionPrewarmer(client)
+        # Reuses each room's encryption keys for all of its messages, until rotated
+        self.session_policy = GroupSessionPolicy(
+            client, config.session_rotation_messages, config.session_rotation_hours
+        )
+        # Sends the messages of each ready room in order, many rooms in parallel
+        self.room_workers = RoomWorkers(self._send_to_room)
+
+    @property
+    def max_in_flight(self) -> int:
+        """The number of campaign messages handled at once"""
+        return (
+            self.config.max_concurrent_sends + self.config.max_concurrent_room_creates
+        )
 
-    def trim_duplicates_caches(self):
-        if len(self.received_events) > DUPLICATES_CACHE_SIZE:
-            self.received_events = self.received_events[:DUPLICATES_CACHE_SIZE]
+    def finish_queueing(self) -> None:
+        """Mark that no more messages will be queued, so the sync loop can be stopped
+        as soon as the remaining messages have been sent."""
+        self.all_messages_queued = True
+        self._stop_if_finished()
+
+    def _message_processed(self) -> None:
+        """Decrement the message counter after a message was sent or dropped"""
+        self.items_to_send -= 1
+        self._stop_if_finished()
+
+    def _stop_if_finished(self) -> None:
+        # Check if that was the last message to be sent - exit the program.
+        if self.all_messages_queued and self.items_to_send == 0:
+            self.main_loop.cancel()
 
     def should_process(self, event_id: str) -> bool:
         logger.debug("Callback received event: %s", event_id)
-        if event_id in self.received_events:
+        if self.received_events.get(event_id) is not None:
             logger.debug("Skipping %s as it's already processed", event_id)
             return False
-        self.received_events.insert(0, event_id)
+        self.received_events.set(event_id, True)
         return True
 
     async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
@@ -59,67 +100,11 @@ class Callbacks(object):
             f"Received a room member event for {room.display_name} | "
             f"{event.sender}: {event.membership}"
         )
-        async with self.lock:
-            self.trim_duplicates_caches()
-            if self.should_process(event.event_id) is False:
-                return
-
-            # Ignore messages older than 15 seconds
-            if (
-                datetime.now() - datetime.fromtimestamp(event.server_timestamp / 1000.0)
-            ).total_seconds() > 15:
-                logger.debug("Ignoring old member event")
-                return
-
-            # Ignore if it was not us sending the invite
-            if event.sender != self.client.user:
-                logger.debug("Ignoring member event since it was not sent by us")
-                return
-
-            # Ignore if any other membership event
-            if (
-                event.membership != "invite"
-            ):  # or event.prev_content is None or event.prev_content.get("membership") == "join":
-                logger.debug("Ignoring due to not being an invite")
-                return
-
-            # Ignore event, if no messages waiting to be processed
-            if room.room_id not in self.rooms_pending.keys():
-                logger.debug("Ignoring due to no messages waiting to be processed")
-                return
-
-            # Check if this is the invited user, other than us
-            receiving_user = event.state_key
-            if receiving_user not in self.user_rooms_pending.keys():
-                logger.debug("Ignoring, since invited user does not have pending rooms")
-                return
-            elif room.room_id not in self.user_rooms_pending[receiving_user]:
-                logger.debug(
-                    "Ignoring, since room id does not match any pending room in user room queue"
-                )
-                return
+        if self.should_process(event.event_id) is False:
+            return
 
-            logger.debug(
-                f"Received invite to: {room.room_id}"
-                f"Pending messages for room / Total messages: {len(self.rooms_pending[room.room_id])} / {self.items_to_send}"
-            )
-
-            # Send all pending messages for the room
-            for message_task in self.rooms_pending[room.room_id]:
-                await message_task  # TODO: Missing error handling here
-                self.items_to_send -= 1
-
-            # Clear processed room messages from queue
-            self.rooms_pending.pop(room.room_id)
-            self.user_rooms_pending[receiving_user].remove(room.room_id)
-
-            # If user has no more pending rooms - remove from queue
-            if len(self.user_rooms_pending[receiving_user]) == 0:
-                self.user_rooms_pending.pop(receiving_user)
-
-            # Check if that was the last messages to be sent - exit the program.
-            if self.items_to_send == 0:
-                self.main_loop.cancel()
+        # Keep track of DM rooms as their membership changes
+        await self.dm_index.update(room, event)
 
     # Code adapted from - https://github.com/vranki/hemppa/blob/dcd69da85f10a60a8eb51670009e7d6829639a2a/bot.py
     async def send_msg(
@@ -129,79 +114,211 @@ class Callbacks(object):
         message_type: str,
         room_id: str = None,
         roomname: str = "",
+        txn_id: str = None,
+        variables: Dict[str, str] = None,
     ):
         """
         :param mxid: A Matrix user id to send the message to
         :param roomname: A Matrix room id to send the message to
         :param message: Text to be sent as message
+        :param txn_id: The transaction id of a message queued in the database. Its
+            state is updated as it is sent, and resending it is idempotent.
+        :param variables: The values of the placeholders of a text message
         :return bool: Returns room id upon sending the message
         """
+        # Counted until the message is sent or dropped
+        self.items_to_send += 1
+
+        if message_type not in MESSAGE_TYPES:
+            logger.error(f"Unknown message type: {message_type}")
+            await self._finish_message(txn_id, MessageState.FAILED)
+            return
 
         room_initialized = True
+        sent = None
+        handed_off = False
+        try:
+            # Acquire lock to process room for user - so duplicate room requests are not sent.
+            # Messages to the same user are sent in order, while other users proceed in parallel.
+            async with self.user_locks.acquire(mxid):
+                # Sends private message to user. Returns true on success.
+                if room_id is None:
+                    logger.debug(f"Searching for an existing room for {mxid}")
+                    # A room that is not ready yet comes first, so the messages queued
+                    # for it are not overtaken
+                    if mxid in self.user_rooms_pending.keys():
+                        room_id = self.user_rooms_pending[mxid][0]
+                        logger.debug(f"Room is being created for {mxid}: {room_id}")
+                        room_initialized = False
+                    else:
+                        msg_room = await self.dm_index.get(mxid)
+                        if msg_room is not None:
+                            room_id = msg_room.room_id
+                            logger.debug(f"Found existing room for {mxid}: {room_id}")
+                elif room_id in self.rooms_pending:
+                    # Resumed into a room another message is already waiting for
+                    room_initialized = False
+                elif not self._is_ready(room_id, mxid):
+                    # Resumed into a room created by an earlier run, which may not be
+                    # synced yet (or restored from a snapshot taken before it was)
+                    logger.debug(f"Waiting for room {room_id} of {mxid} to be ready")
+                    room_initialized = False
+                    self._wait_for_room(room_id, mxid)
+
+                # If an existing room was not found - create a new one.
+                if room_id is None:
+                    logger.debug(f"Creating a new room for {mxid}")
+                    # Keep syncing, to be told when the user was invited
+                    self.sync_needed.set()
+                    room_id = await self.provisioner.provision(mxid, roomname)
+                    if room_id is None:
+                        logger.error(f"Failed to create room for {mxid}")
+                        await self._finish_message(txn_id, MessageState.FAILED)
+                        return
 
-        # Acquire lock to process room for user - so duplicate room requests are not sent.
-        async with self.lock:
-            # Sends private message to user. Returns true on success.
-            if room_id is None:
-                logger.debug(f"Searching for an existing room for {mxid}")
-                msg_room = find_private_msg(self.client, mxid)
-                if msg_room is not None:
-                    room_id = msg_room.room_id
-                    logger.debug(f"Found existing room for {mxid}: {room_id}")
-                elif mxid in self.user_rooms_pending.keys():
-                    room_id = self.user_rooms_pending[mxid]
-                    logger.debug(f"Room is being created for {mxid}: {room_id}")
                     room_initialized = False
+                    self._wait_for_room(room_id, mxid)
 
-            # If an existing room was not found - create a new one.
-            if room_id is None:
-                logger.debug(f"Creating a new room for {mxid}")
-                resp = await create_private_room(self.client, mxid, roomname)
+                message = PendingMessage(mxid, message_type, content, txn_id, variables)
 
-                if isinstance(resp, RoomCreateResponse):
-                    room_id = resp.room_id
-                    room_initialized = False
-                    if room_id not in self.rooms_pending.keys():
-                        self.rooms_pending[room_id] = []
+                # Based on if the room is initialized - send the message now, or defer sending until user has been invited to the room
+                if room_initialized:
+                    sent = self.room_workers.submit(room_id, message)
+                    # From here on, the room's worker finishes the message
+                    handed_off = True
                 else:
-                    logger.error(f"Failed to create room for {mxid}")
-                    return
-
-            task = None
-
-            # Determine task type
-            if message_type == "text":
-                task = with_ratelimit(send_text_to_room)(self.client, room_id, content)
-            elif message_type == "image":
-                task = with_ratelimit(send_file_to_room)(self.client, room_id, content, "m.image")
-            elif message_type == "file":
-                task = with_ratelimit(send_file_to_room)(self.client, room_id, content, "m.file")
-            else:
-                logger.error(f"Unknown message type: {message_type}")
-                return
-
-            # Based on if the room is initialized - execute the task now, or defer execution until user has been invited to the room
-            if room_initialized:
-                await task
-                logger.debug(f"Message sent to {mxid} in room {room_id}")
-
-                # Decrement task counter
-                self.items_to_send -= 1
-
-                # Check if that was the last messages to be sent - exit the program.
-                if self.items_to_send == 0:
-                    self.main_loop.cancel()
-            else:
-                self.rooms_pending[room_id].append(task)
-                if mxid not in self.user_rooms_pending.keys():
-                    self.user_rooms_pending[mxid] = [room_id]
+                    self.rooms_pending[room_id].append(message)
+                    # From here on, the wait for the room finishes the message
+                    handed_off = True
+                    user_rooms = self.user_rooms_pending.setdefault(mxid, [])
+                    if room_id not in user_rooms:
+                        user_rooms.append(room_id)
+                    if txn_id is not None:
+                        await self.store.set_message_state(
+                            txn_id, MessageState.ROOM_PENDING, room_id
+                        )
+
+                    logger.debug(
+                        f"Message appended to queue to be sent to {mxid} in room {room_id}"
+                    )
 
                 logger.debug(
-                    f"Message appended to queue to be sent to {mxid} in room {room_id}"
+                    f"Messages left to send: {self.items_to_send}"
+                    f"Room message queue: {self.rooms_pending}"
+                    f"Pending User room queue: {self.user_rooms_pending}"
                 )
-
+        except Exception:
+            if handed_off:
+                raise
+            # Counted as processed, or the campaign would wait for it forever
+            logger.exception(f"Failed to queue a message to {mxid}")
+            await self._finish_message(txn_id, MessageState.FAILED)
+            return
+
+        # Wait outside of the lock, so the campaign doesn't run ahead of sending
+        if sent is not None:
+            await sent
+
+    def _is_ready(self, room_id: str, mxid: str) -> bool:
+        """Whether a room is synced, with its user invited or joined"""
+        room = self.client.rooms.get(room_id)
+        return room is not None and (mxid in room.users or mxid in room.invited_users)
+
+    def _wait_for_room(self, room_id: str, mxid: str) -> None:
+        """Queue the messages to a room until it is ready"""
+        # Keep syncing, to be told when the user was invited
+        self.sync_needed.set()
+        self.rooms_pending.setdefault(room_id, [])
+        # Send the queued messages once the room is ready
+        self.readiness.track(room_id, mxid)
+        task = asyncio.create_task(self._send_when_ready(room_id, mxid))
+        self.waiting_rooms.add(task)
+        task.add_done_callback(self.waiting_rooms.discard)
+
+    async def _send_when_ready(self, room_id: str, mxid: str) -> None:
+        """Send the messages queued for a new room once it is ready, or fail them if it
+        never becomes ready"""
+        ready = await self.readiness.wait(room_id)
+        if ready:
+            # Share the room's encryption keys before the first message, batched with
+            # the other rooms that became ready at the same time
+            await self.prewarmer.prewarm(room_id)
+            self.session_policy.observe(room_id)
+
+        # Hold the user's lock while handing the messages to the room's worker, so no
+        # message to the user overtakes the queued ones
+        async with self.user_locks.acquire(mxid):
+            messages = self.rooms_pending.pop(room_id, [])
             logger.debug(
-                f"Messages left to send: {self.items_to_send}"
-                f"Room message queue: {self.rooms_pending}"
-                f"Pending User room queue: {self.user_rooms_pending}"
+                f"Room {room_id} is {'ready' if ready else 'not usable'}, "
+                f"{len(messages)} pending messages / {self.items_to_send} total"
+            )
+            for message in messages:
+                if ready:
+                    self.room_workers.submit(room_id, message)
+                else:
+                    await self._finish_message(message.txn_id, MessageState.FAILED)
+
+            # If user has no more pending rooms - remove from queue
+            user_rooms = self.user_rooms_pending.get(mxid, [])
+            if room_id in user_rooms:
+                user_rooms.remove(room_id)
+            if not user_rooms:
+                self.user_rooms_pending.pop(mxid, None)
+
+    async def _send_to_room(self, room_id: str, message: "PendingMessage") -> None:
+        """Send a message to a room that is ready, and record the outcome"""
+        if message.message_type == "text":
+            send = with_ratelimit(send_text_to_room)(
+                self.client,
+                room_id,
+                message.content,
+                txn_id=message.txn_id,
+                variables=message.variables,
             )
+        else:
+            send = with_ratelimit(send_file_to_room)(
+                self.client,
+                room_id,
+                message.content,
+                "m.image" if message.message_type == "image" else "m.file",
+                self.media_cache,
+                txn_id=message.txn_id,
+            )
+
+        try:
+            async with self.send_slots:
+                resp = await send
+        except Exception as e:
+            logger.exception(f"Error sending a message to {message.mxid}")
+            resp = e
+
+        # Sending shares new keys if the room had none yet, or they were rotated
+        self.session_policy.observe(room_id)
+
+        if isinstance(resp, RoomSendResponse):
+            logger.debug(f"Message sent to {message.mxid} in room {room_id}")
+            await self._finish_message(message.txn_id, MessageState.SENT)
+        else:
+            logger.error(
+                f"Failed to send message to {message.mxid} in room {room_id}: {resp}"
+            )
+            await self._finish_message(message.txn_id, MessageState.FAILED)
+
+    async def _finish_message(self, txn_id: Optional[str], state: str) -> None:
+        """Record that a message was sent or failed, and count it as processed"""
+        try:
+            if txn_id is not None:
+                await self.store.set_message_state(txn_id, state)
+        finally:
+            self._message_processed()
+
+
+class PendingMessage(NamedTuple):
+    """A message waiting for its room to become ready"""
+
+    mxid: str
+    message_type: str
+    content: str
+    txn_id: Optional[str] = None
+    variables: Optional[Dict[str, str]] = None
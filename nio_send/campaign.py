@@ -0,0 +1,325 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+)
+
+import yaml
+
+from nio_send.errors import ManifestError
+from nio_send.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# The message kinds understood by Callbacks.send_msg
+MESSAGE_TYPES = ("text", "image", "file")
+
+# The fields of a manifest row that are not placeholder values
+MANIFEST_FIELDS = ("user", "type", "content", "room_name")
+
+
+class MessageState:
+    """The states of a message in the outbound queue"""
+
+    # Waiting to be sent
+    QUEUED = "queued"
+    # Waiting for its newly created room to become ready
+    ROOM_PENDING = "room_pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+    # States of messages that still have to be sent
+    UNFINISHED = (QUEUED, ROOM_PENDING)
+
+
+class CampaignMessage(NamedTuple):
+    """A single message of a campaign, as read from one row of a manifest"""
+
+    user_id: str
+    message_type: str
+    content: str
+    room_name: str = ""
+    # The values of the `{{name}}` placeholders of a text message
+    variables: Optional[Dict[str, str]] = None
+
+
+class QueuedMessage(NamedTuple):
+    """A message stored in the outbound queue, ready to be sent"""
+
+    message: CampaignMessage
+    txn_id: str
+    # The room the message was being sent to, if one was chosen before a restart
+    room_id: Optional[str] = None
+
+
+def read_manifest(path: str, user_suffix: str) -> Iterator[CampaignMessage]:
+    """Lazily read the messages of a campaign manifest.
+
+    The manifest format is picked from the file extension: `.csv` (with a header row),
+    `.jsonl` (one JSON object per line) or `.yaml`/`.yml` (a list of mappings). Each
+    row provides the `user`, `type` and `content` fields and an optional `room_name`.
+    Any other fields of a row are the values of the `{{name}}` placeholders of its
+    text, e.g. a `first_name` column fills in `{{first_name}}`.
+
+    Rows are yielded one at a time, so arbitrarily large CSV and JSONL manifests are
+    never fully loaded into memory. Invalid rows are logged and skipped.
+
+    Args:
+        path: The path to the manifest file.
+
+        user_suffix: The server name appended to users given without one, e.g.
+            `test` becomes `@test:<user_suffix>`.
+
+    Raises:
+        ManifestError: If the manifest does not exist or is of an unknown format.
+    """
+    if not os.path.isfile(path):
+        raise ManifestError(f"Manifest file '{path}' does not exist")
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        rows = _read_csv_rows(path)
+    elif extension in (".jsonl", ".ndjson"):
+        rows = _read_jsonl_rows(path)
+    elif extension in (".yaml", ".yml"):
+        rows = _read_yaml_rows(path)
+    else:
+        raise ManifestError(f"Unknown manifest format '{extension}'")
+
+    return _parse_rows(path, rows, user_suffix)
+
+
+def _parse_rows(
+    path: str, rows: Iterator[Dict[str, Any]], user_suffix: str
+) -> Iterator[CampaignMessage]:
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for row_number, row in enumerate(rows, start=1):
+        try:
+            yield parse_row(row, user_suffix, base_dir)
+        except ManifestError as e:
+            logger.error(f"Skipping row {row_number} of manifest {path}: {e}")
+
+
+def _read_csv_rows(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, newline="") as file_stream:
+        yield from csv.DictReader(file_stream)
+
+
+def _read_jsonl_rows(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as file_stream:
+        for line in file_stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                # Yield the broken line so that it is reported as an invalid row
+                yield {"error": str(e)}
+
+
+def _read_yaml_rows(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as file_stream:
+        rows = yaml.safe_load(file_stream)
+    if not isinstance(rows, list):
+        raise ManifestError("A YAML manifest must contain a list of messages")
+    yield from rows
+
+
+def parse_row(row: Any, user_suffix: str, base_dir: str) -> CampaignMessage:
+    """Validate a manifest row and convert it to a CampaignMessage.
+
+    Raises:
+        ManifestError: If the row is not a valid message.
+    """
+    if not isinstance(row, dict):
+        raise ManifestError("row is not a mapping")
+    if "error" in row:
+        raise ManifestError(row["error"])
+
+    user = str(row.get("user") or "").strip()
+    message_type = str(row.get("type") or "").strip()
+    content = row.get("content")
+    room_name = str(row.get("room_name") or "")
+
+    if not user:
+        raise ManifestError("missing user")
+    if message_type not in MESSAGE_TYPES:
+        raise ManifestError(f"unknown message type '{message_type}'")
+    if content is None or content == "":
+        raise ManifestError("missing content")
+    content = str(content)
+
+    if not user.startswith("@"):
+        user = f"@{user}:{user_suffix}"
+
+    # Attachments are resolved relative to the manifest, so it can be moved together
+    # with its files
+    if message_type != "text":
+        content = os.path.join(base_dir, os.path.expanduser(content))
+
+    variables = {
+        str(name): str(value)
+        for name, value in row.items()
+        if name not in MANIFEST_FIELDS and value is not None and value != ""
+    }
+
+    return CampaignMessage(user, message_type, content, room_name, variables or None)
+
+
+async def get_manifest_campaign(store: Storage, manifest_id: str) -> str:
+    """Get the campaign ID of the run of a manifest.
+
+    A run of a manifest that still has messages to send is resumed. Once every message
+    of a run was sent (or failed), running the same manifest again starts a new run,
+    which sends every message again.
+
+    Args:
+        store: Bot storage, holding the queue.
+
+        manifest_id: An ID identifying the manifest, e.g. the hash of its contents.
+    """
+    campaign = manifest_id
+    run = 1
+    while True:
+        states = await store.get_campaign_states(campaign)
+        if not states or any(state in MessageState.UNFINISHED for state in states):
+            return campaign
+
+        run += 1
+        campaign = f"{manifest_id}:{run}"
+
+
+async def queue_messages(
+    store: Storage,
+    campaign: str,
+    messages: Iterable[CampaignMessage],
+    resume_unfinished: bool = True,
+) -> AsyncIterator[QueuedMessage]:
+    """Store the messages of a campaign in the outbound queue, yielding the ones that
+    still have to be sent.
+
+    Messages left unfinished by earlier campaigns are yielded first. Messages of this
+    campaign that were already sent (or failed) in an earlier run are skipped, so
+    running a campaign again resumes it where it stopped.
+
+    Args:
+        store: Bot storage, holding the queue.
+
+        campaign: An ID identifying the campaign across restarts.
+
+        messages: The messages of the campaign.
+
+        resume_unfinished: Whether to yield the unfinished messages of earlier
+            campaigns. Disabled for campaigns running next to each other.
+    """
+    if resume_unfinished:
+        for txn_id, *fields, variables, room_id in await store.get_unfinished_messages(
+            MessageState.UNFINISHED, campaign
+        ):
+            if variables is not None:
+                variables = json.loads(variables)
+            yield QueuedMessage(CampaignMessage(*fields, variables), txn_id, room_id)
+
+    skipped = 0
+    for position, message in enumerate(messages):
+        txn_id, state, room_id = await store.enqueue_message(
+            campaign,
+            position,
+            message.user_id,
+            message.message_type,
+            message.content,
+            message.room_name,
+            json.dumps(message.variables) if message.variables else None,
+            MessageState.QUEUED,
+        )
+        if state in MessageState.UNFINISHED:
+            yield QueuedMessage(message, txn_id, room_id)
+        else:
+            skipped += 1
+
+    if skipped:
+        logger.info(f"Skipped {skipped} messages handled by an earlier run")
+
+
+async def run_campaign(
+    callbacks,
+    campaign: str,
+    messages: Iterable[CampaignMessage],
+    resume_unfinished: bool = True,
+    on_queued: Optional[Callable[[], None]] = None,
+) -> None:
+    """Feed every message of a campaign into Callbacks.send_msg.
+
+    Messages are consumed as they are sent, so the manifest is streamed instead of
+    being loaded up front. Every message is recorded in the outbound queue before it
+    is sent, and sent with the queue's transaction ID, so an interrupted campaign can
+    be resumed without sending duplicates.
+
+    Up to `max_concurrent_sends` + `max_concurrent_room_creates` messages (per
+    account) are handed to the callbacks at once, so rooms keep being created while
+    messages are sent; messages to the same user are still sent in manifest order.
+
+    Args:
+        callbacks (Callbacks or AccountPool): The callbacks of the logged in client,
+            or the pool of accounts to send from.
+
+        campaign: An ID identifying the campaign across restarts.
+
+        messages: The messages to send.
+
+        resume_unfinished: Whether to first send the unfinished messages of earlier
+            campaigns.
+
+        on_queued: Called once every message was queued and handed to the callbacks,
+            before waiting for the last ones to be sent.
+    """
+    start = time.monotonic()
+    queued = 0
+    in_flight = asyncio.Semaphore(callbacks.max_in_flight)
+    tasks = set()
+
+    def on_done(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Failed to process campaign message", exc_info=task.exception()
+            )
+
+    async for message, txn_id, room_id in queue_messages(
+        callbacks.store, campaign, messages, resume_unfinished
+    ):
+        await in_flight.acquire()
+        task = asyncio.create_task(
+            callbacks.send_msg(
+                message.user_id,
+                message.content,
+                message.message_type,
+                room_id=room_id,
+                roomname=message.room_name,
+                txn_id=txn_id,
+                variables=message.variables,
+            )
+        )
+        task.add_done_callback(on_done)
+        tasks.add(task)
+        queued += 1
+
+    if on_queued is not None:
+        on_queued()
+    if tasks:
+        await asyncio.wait(tasks)
+
+    logger.info(f"Queued {queued} campaign messages in {time.monotonic() - start:.1f}s")
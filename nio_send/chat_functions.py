@@ -1,12 +1,11 @@
+import itertools
 import logging
 import os
-import traceback
-from typing import Union
+import stat
+from typing import Dict, List, Optional, Union
 
 import aiofiles
 import aiofiles.os
-import magic
-from commonmark import commonmark
 
 # noinspection PyPackageRequirements
 from nio import (
@@ -24,9 +23,17 @@ from nio import (
     RoomSendResponse,
     RoomVisibility,
     SendRetryError,
-    UploadResponse,
 )
 
+from nio_send.media import (
+    MediaCache,
+    ProgressCallback,
+    describe_image,
+    log_upload_progress,
+    upload_file,
+)
+from nio_send.preparation import get_file_preparer, sniff_mime_type
+from nio_send.templates import fill_placeholders, render_markdown
 from nio_send.utils import get_room_id, with_ratelimit
 
 logger = logging.getLogger(__name__)
@@ -40,6 +47,8 @@ async def send_text_to_room(
     markdown_convert: bool = True,
     reply_to_event_id: str = None,
     replaces_event_id: str = None,
+    txn_id: str = None,
+    variables: Dict[str, str] = None,
 ) -> Union[RoomSendResponse, RoomSendError, str]:
     """Send text to a matrix room
     Args:
@@ -52,6 +61,10 @@ async def send_text_to_room(
             Defaults to true.
         reply_to_event_id (str): Optional event ID that this message is a reply to.
         replaces_event_id (str): Optional event ID that this message replaces.
+        txn_id (str): Optional transaction ID, so that resending the message is
+            idempotent.
+        variables (dict): Optional values of the `{{name}}` placeholders of the
+            message, filled in after its markdown is rendered.
     """
     try:
         room_id = await get_room_id(client, room, logger)
@@ -61,14 +74,19 @@ async def send_text_to_room(
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
 
+    body = fill_placeholders(message, variables)
     content = {
         "msgtype": msgtype,
         "format": "org.matrix.custom.html",
-        "body": message,
+        "body": body,
     }
 
+    formatted_body = None
     if markdown_convert:
-        content["formatted_body"] = commonmark(message)
+        formatted_body = fill_placeholders(
+            render_markdown(message), variables, escape=True
+        )
+        content["formatted_body"] = formatted_body
 
     if replaces_event_id:
         content["m.relates_to"] = {
@@ -78,10 +96,10 @@ async def send_text_to_room(
         content["m.new_content"] = {
             "msgtype": msgtype,
             "format": "org.matrix.custom.html",
-            "body": message,
+            "body": body,
         }
         if markdown_convert:
-            content["m.new_content"]["formatted_body"] = commonmark(message)
+            content["m.new_content"]["formatted_body"] = formatted_body
     # We don't store the original message content so cannot provide the fallback, unfortunately
     elif reply_to_event_id:
         content["m.relates_to"] = {
@@ -95,6 +113,7 @@ async def send_text_to_room(
             room_id,
             "m.room.message",
             content,
+            tx_id=txn_id,
             ignore_unverified_devices=True,
         )
     except (LocalProtocolError, SendRetryError) as ex:
@@ -111,6 +130,7 @@ async def send_media_to_room(
     media_file: dict = None,
     media_info: dict = None,
     reply_to_event_id: str = None,
+    txn_id: str = None,
 ) -> Union[RoomSendResponse, RoomSendError, str]:
     """Send media to a matrix room
     Args:
@@ -122,6 +142,8 @@ async def send_media_to_room(
         media_file (dict): The media metadata
         media_info (dict): The media url and metadata
         reply_to_event_id (str): Optional event ID that this message is a reply to.
+        txn_id (str): Optional transaction ID, so that resending the message is
+            idempotent.
     """
     try:
         room_id = await get_room_id(client, room, logger)
@@ -159,6 +181,7 @@ async def send_media_to_room(
             room_id,
             "m.room.message",
             content,
+            tx_id=txn_id,
             ignore_unverified_devices=True,
         )
     except (LocalProtocolError, SendRetryError) as ex:
@@ -181,7 +204,7 @@ async def create_private_room(
             "content": {"users": {mxid: 100, client.user_id: 100}},
         }
     ]
-    resp = await with_ratelimit(client.room_create)(
+    resp = await with_ratelimit(client.room_create, "room_create")(
         visibility=RoomVisibility.private,
         name=roomname,
         is_direct=True,
@@ -198,14 +221,21 @@ async def create_private_room(
     return resp
 
 
+def _room_heroes(room: MatrixRoom) -> List[str]:
+    """The members of a room named by its summary.
+
+    When room members are lazy-loaded, the other member of a DM may not have been
+    synced, but is still named among the heroes of the room summary.
+    """
+    if room.summary is None:
+        return []
+    return room.summary.heroes or []
+
+
 def is_user_in_room(room: MatrixRoom, mxid: str) -> bool:
-    for user in room.users:
-        if user == mxid:
-            return True
-    for user in room.invited_users:
-        if user == mxid:
-            return True
-    return False
+    return (
+        mxid in room.users or mxid in room.invited_users or mxid in _room_heroes(room)
+    )
 
 
 def is_room_private_msg(room: MatrixRoom, mxid: str) -> bool:
@@ -214,20 +244,14 @@ def is_room_private_msg(room: MatrixRoom, mxid: str) -> bool:
     return False
 
 
-def find_private_msg(client: AsyncClient, mxid: str) -> Union[MatrixRoom, None]:
-    # Find if we already have a common room with user:
-    msg_room = None
-    for roomid in client.rooms:
-        room = client.rooms[roomid]
-        if is_room_private_msg(room, mxid):
-            msg_room = room
-            break
-
-    if msg_room:
-        logger.debug(
-            f"Found existing DM for user {mxid} with roomID: {msg_room.room_id}"
-        )
-    return msg_room
+def get_private_msg_user(room: MatrixRoom, own_user_id: str) -> Optional[str]:
+    """Get the user we share a private room with, if the room is one"""
+    if room.member_count != 2:
+        return None
+    for user in itertools.chain(room.users, room.invited_users, _room_heroes(room)):
+        if user != own_user_id:
+            return user
+    return None
 
 
 async def create_room(
@@ -237,7 +261,7 @@ async def create_room(
     :param roomname: The room name
     :return: the Room Response from room_create()
     """
-    resp = await with_ratelimit(client.room_create)(
+    resp = await with_ratelimit(client.room_create, "room_create")(
         name=roomname,
     )
     if isinstance(resp, RoomCreateResponse):
@@ -256,7 +280,7 @@ async def invite_to_room(
     :param roomname: The room name
     :return: the Room Response from room_create()
     """
-    resp = await with_ratelimit(client.room_invite)(
+    resp = await with_ratelimit(client.room_invite, "invite")(
         room_id=room_id,
         user_id=mxid,
     )
@@ -274,7 +298,10 @@ async def send_file_to_room(
     room_id: str,
     file: str,
     type: str,
-) -> Union[RoomSendResponse, ErrorResponse]:
+    media_cache: MediaCache = None,
+    on_progress: ProgressCallback = log_upload_progress,
+    txn_id: str = None,
+) -> Union[RoomSendResponse, ErrorResponse, str, None]:
     """Process file.
     Upload file to server and then send link to rooms.
     Works and tested for .pdf, .txt, .ogg, .wav.
@@ -285,8 +312,18 @@ async def send_file_to_room(
         list of room_id-s
     file : str
         file name of file from --file argument
+    media_cache : MediaCache
+        optional cache of uploaded files, so the same content is only uploaded once
+    on_progress : ProgressCallback
+        called periodically with the bytes uploaded and the upload speed
+    txn_id : str
+        optional transaction ID, so that resending the message is idempotent
     """
-    if not os.path.isfile(file):
+    try:
+        file_stat = await aiofiles.os.stat(file)
+    except OSError:
+        file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
         logger.debug(
             f"File {file} is not a file. Doesn't exist or "
             "is a directory."
@@ -294,68 +331,95 @@ async def send_file_to_room(
         )
         return
 
-    mime_type = magic.from_file(file, mime=True)
+    # Files are inspected and encrypted in worker processes if configured, so the
+    # event loop keeps syncing and sending meanwhile
+    preparer = get_file_preparer(client)
+
+    # Attachments sent to encrypted rooms are encrypted as well
+    room = client.rooms.get(room_id)
+    encrypt = room is None or room.encrypted
+    # Images are described, so clients can lay them out without downloading them
+    describe = type == "m.image"
 
     # first do an upload of file if it hasn't already been uploaded
     # see https://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload # noqa
     # then send URI of upload to room
-    file_stat = await aiofiles.os.stat(file)
-
-    content_uri = None  # self.store.get_uri(file)
-    if content_uri is None:
-        async with aiofiles.open(file, "r+b") as f:
-            resp, maybe_keys = await client.upload(
-                f,
-                content_type=mime_type,  # application/pdf
-                filename=os.path.basename(file),
-                filesize=file_stat.st_size,
-            )
-        if isinstance(resp, UploadResponse):
-            logger.debug(
-                "File was uploaded successfully to server. "
-                f"Response is: {resp.content_uri}"
-            )
-            content_uri = resp.content_uri
-            # Store the content uri in our database for later reuse
-            logger.debug(f"Storing file {file} uri {content_uri} to the DB.")
-            # self.store.set_uri(file, content_uri)
+    if media_cache is None:
+        if preparer is not None:
+            mime_type = await preparer.sniff_mime_type(file)
         else:
-            logger.info(
-                "Failed to upload file to server. "
-                "Please retry. This could be temporary issue on "
-                "your server. "
-                "Sorry."
-            )
-            logger.info(
-                f'file="{file}"; mime_type="{mime_type}"; '
-                f'filessize="{file_stat.st_size}"'
-                f"Failed to upload: {resp}"
+            mime_type = sniff_mime_type(file)
+        media = await upload_file(
+            client, file, mime_type, file_stat.st_size, on_progress, encrypt, preparer
+        )
+        if media is not None and describe:
+            media = media._replace(
+                info=await describe_image(
+                    client, file, media, mime_type, file_stat.st_size, preparer
+                )
             )
-            return
     else:
-        logger.debug(f"Found URI of {file} in the DB, using: {content_uri}")
-    print("Finished file upload")
+        # Known without reading the file again, once it was sent before
+        sha256, mime_type = await media_cache.get_file_info(file, file_stat, preparer)
+
+        # Concurrent sends of the same content wait for a single upload
+        async with media_cache.upload_locks.acquire((sha256, encrypt)):
+            media = await media_cache.get_upload(sha256, file_stat.st_size, encrypt)
+            if media is None:
+                media = await upload_file(
+                    client,
+                    file,
+                    mime_type,
+                    file_stat.st_size,
+                    on_progress,
+                    encrypt,
+                    preparer,
+                )
+                if media is not None:
+                    if describe:
+                        media = media._replace(
+                            info=await describe_image(
+                                client,
+                                file,
+                                media,
+                                mime_type,
+                                file_stat.st_size,
+                                preparer,
+                            )
+                        )
+                    # Store the content uri in our database for later reuse
+                    logger.debug(f"Storing file {file} uri {media.uri} to the DB.")
+                    await media_cache.set_upload(sha256, file_stat.st_size, media)
+            else:
+                logger.debug(f"Found URI of {file} in the DB, using: {media.uri}")
+                # Uploaded before, but not sent as an image yet
+                if describe and media.info is None:
+                    media = media._replace(
+                        info=await describe_image(
+                            client, file, media, mime_type, file_stat.st_size, preparer
+                        )
+                    )
+                    await media_cache.set_info(sha256, file_stat.st_size, media)
+
+    if media is None:
+        return
 
-    content = {
-        "body": os.path.basename(file),  # descriptive title
-        "info": {
+    resp = await send_media_to_room(
+        client,
+        room_id,
+        type,
+        os.path.basename(file),  # descriptive title
+        media_url=None if media.encrypted else media.uri,
+        media_file=media.as_file() if media.encrypted else None,
+        media_info={
             "size": file_stat.st_size,
             "mimetype": mime_type,
+            **(media.info if describe and media.info else {}),
         },
-        "msgtype": type,
-        "url": content_uri,
-    }
-    try:
-        await client.room_send(
-            room_id,
-            message_type="m.room.message",
-            content=content,
-            ignore_unverified_devices = True,
-        )
-        logger.debug(f'This file was sent: {file} to room {room_id}')
-    except Exception:
-        logger.debug(
-            f"File send of file {file} failed. " "Sorry. Here is the traceback."
-        )
-        logger.debug(traceback.format_exc())
-    return content_uri
+        txn_id=txn_id,
+    )
+    if isinstance(resp, RoomSendResponse):
+        logger.debug(f"This file was sent: {file} to room {room_id}")
+    else:
+        logger.debug(f"File send of file {file} failed: {resp}")
+    return resp
@@ -2,11 +2,12 @@ import logging
 import os
 import re
 import sys
-from typing import Any, List, Optional
+from typing import Any, List, NamedTuple, Optional
 
 import yaml
 
 from nio_send.errors import ConfigError
+from nio_send.ratelimit import DEFAULT_LIMITS, DEFAULT_MAX_RETRIES
 
 logger = logging.getLogger()
 logging.getLogger("peewee").setLevel(
@@ -14,6 +15,18 @@ logging.getLogger("peewee").setLevel(
 )  # Prevent debug messages from peewee lib
 
 
+class AccountConfig(NamedTuple):
+    """The login details of one of the accounts messages are sent from"""
+
+    user_id: str
+    user_password: Optional[str]
+    user_token: Optional[str]
+    device_id: str
+    device_name: str
+    # The directory holding the account's encryption keys and sync tokens
+    store_path: str
+
+
 class Config:
     """Creates a Config object from a YAML-encoded config file from a given filepath"""
 
@@ -58,6 +71,26 @@ class Config:
             handler.setFormatter(formatter)
             logger.addHandler(handler)
 
+        # Rate limiting setup
+        self.ratelimit_max_retries = self._get_cfg(
+            ["ratelimit", "max_retries"], default=DEFAULT_MAX_RETRIES, required=False
+        )
+        self.rate_limits = {}
+        for endpoint in DEFAULT_LIMITS:
+            limit = self._get_cfg(["ratelimit", endpoint], required=False)
+            if limit is None:
+                continue
+            try:
+                self.rate_limits[endpoint] = (float(limit["rate"]), int(limit["burst"]))
+            except (KeyError, TypeError, ValueError):
+                raise ConfigError(
+                    f"ratelimit.{endpoint} must have a numeric rate and burst"
+                )
+            if self.rate_limits[endpoint][0] <= 0 or self.rate_limits[endpoint][1] < 1:
+                raise ConfigError(
+                    f"ratelimit.{endpoint} rate and burst must be positive"
+                )
+
         # Storage setup
         self.store_path = self._get_cfg(["storage", "store_path"], required=True)
 
@@ -87,6 +120,17 @@ class Config:
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
+        # How long uploaded media is reused for, before uploading it again
+        self.media_cache_max_age = self._get_cfg(
+            ["storage", "media_cache_max_age_days"], default=30, required=False
+        )
+        if not isinstance(self.media_cache_max_age, int) or (
+            self.media_cache_max_age < 0
+        ):
+            raise ConfigError(
+                "storage.media_cache_max_age_days must be a non-negative integer"
+            )
+
         # Matrix bot account setup
         self.user_name = self._get_cfg(["matrix", "user_name"], required=True)
         self.user_suffix = self._get_cfg(["matrix", "user_suffix"], required=True)
@@ -106,6 +150,196 @@ class Config:
         )
         self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
 
+        # The accounts to send from: the main account, and any additional ones to
+        # spread the recipients over
+        self.accounts = [
+            AccountConfig(
+                self.user_id,
+                self.user_password,
+                self.user_token,
+                self.device_id,
+                self.device_name,
+                self.store_path,
+            )
+        ]
+        extra_accounts = self._get_cfg(["accounts"], default=[], required=False)
+        if not isinstance(extra_accounts, list):
+            raise ConfigError("accounts must be a list")
+        for index, account in enumerate(extra_accounts):
+            self.accounts.append(self._parse_account(index, account))
+        if len({account.user_id for account in self.accounts}) < len(self.accounts):
+            raise ConfigError("accounts must not repeat an account")
+
+        # Sync setup
+        self.dedup_cache_size = self._get_cfg(
+            ["sync", "dedup_cache_size"], default=10000, required=False
+        )
+        if not isinstance(self.dedup_cache_size, int) or self.dedup_cache_size < 1:
+            raise ConfigError("sync.dedup_cache_size must be a positive integer")
+        self.dedup_cache_ttl = self._get_cfg(
+            ["sync", "dedup_cache_ttl_seconds"], default=3600, required=False
+        )
+        if not isinstance(self.dedup_cache_ttl, (int, float)) or (
+            self.dedup_cache_ttl <= 0
+        ):
+            raise ConfigError("sync.dedup_cache_ttl_seconds must be a positive number")
+
+        # Only sync the events the bot needs, with a server-side filter
+        self.sync_filter = self._get_cfg(
+            ["sync", "filter"], default=True, required=False
+        )
+        self.sync_lazy_load_members = self._get_cfg(
+            ["sync", "lazy_load_members"], default=True, required=False
+        )
+        self.sync_send_only = self._get_cfg(
+            ["sync", "send_only"], default=False, required=False
+        )
+        self.sync_snapshot = self._get_cfg(
+            ["sync", "snapshot"], default=True, required=False
+        )
+
+        # Sending setup
+        self.max_concurrent_sends = self._get_cfg(
+            ["sending", "max_concurrent_sends"], default=10, required=False
+        )
+        if not isinstance(self.max_concurrent_sends, int) or (
+            self.max_concurrent_sends < 1
+        ):
+            raise ConfigError("sending.max_concurrent_sends must be a positive integer")
+        self.max_concurrent_room_creates = self._get_cfg(
+            ["sending", "max_concurrent_room_creates"], default=5, required=False
+        )
+        if not isinstance(self.max_concurrent_room_creates, int) or (
+            self.max_concurrent_room_creates < 1
+        ):
+            raise ConfigError(
+                "sending.max_concurrent_room_creates must be a positive integer"
+            )
+        self.room_ready_timeout = self._get_cfg(
+            ["sending", "room_ready_timeout_seconds"], default=120, required=False
+        )
+        if not isinstance(self.room_ready_timeout, (int, float)) or (
+            self.room_ready_timeout <= 0
+        ):
+            raise ConfigError(
+                "sending.room_ready_timeout_seconds must be a positive number"
+            )
+        self.alias_cache_ttl = self._get_cfg(
+            ["sending", "alias_cache_ttl_seconds"], default=3600, required=False
+        )
+        if not isinstance(self.alias_cache_ttl, (int, float)) or (
+            self.alias_cache_ttl <= 0
+        ):
+            raise ConfigError(
+                "sending.alias_cache_ttl_seconds must be a positive number"
+            )
+        self.alias_cache_negative_ttl = self._get_cfg(
+            ["sending", "alias_cache_negative_ttl_seconds"], default=60, required=False
+        )
+        if not isinstance(self.alias_cache_negative_ttl, (int, float)) or (
+            self.alias_cache_negative_ttl <= 0
+        ):
+            raise ConfigError(
+                "sending.alias_cache_negative_ttl_seconds must be a positive number"
+            )
+        self.alias_cache_persist = self._get_cfg(
+            ["sending", "alias_cache_persist"], default=False, required=False
+        )
+        self.file_workers = self._get_cfg(
+            ["sending", "file_workers"], default=os.cpu_count() or 1, required=False
+        )
+        if not isinstance(self.file_workers, int) or self.file_workers < 0:
+            raise ConfigError("sending.file_workers must be a non-negative integer")
+        self.file_queue_size = self._get_cfg(
+            ["sending", "file_queue_size"], default=16, required=False
+        )
+        if not isinstance(self.file_queue_size, int) or self.file_queue_size < 1:
+            raise ConfigError("sending.file_queue_size must be a positive integer")
+        self.encrypt_in_workers = self._get_cfg(
+            ["sending", "encrypt_in_workers"], default=False, required=False
+        )
+
+        # Daemon setup
+        self.daemon_host = self._get_cfg(
+            ["daemon", "host"], default="127.0.0.1", required=False
+        )
+        self.daemon_port = self._get_cfg(
+            ["daemon", "port"], default=8088, required=False
+        )
+        if not isinstance(self.daemon_port, int) or not 0 < self.daemon_port < 65536:
+            raise ConfigError("daemon.port must be a valid port number")
+        self.daemon_unix_socket = self._get_cfg(
+            ["daemon", "unix_socket"], default=None, required=False
+        )
+        self.daemon_token = self._get_cfg(
+            ["daemon", "token"], default=None, required=False
+        )
+        if self.daemon_token is not None and (
+            not isinstance(self.daemon_token, str) or not self.daemon_token
+        ):
+            raise ConfigError("daemon.token must be a non-empty string")
+        self.daemon_media_dir = self._get_cfg(
+            ["daemon", "media_dir"], default=None, required=False
+        )
+        if self.daemon_media_dir is not None:
+            if not os.path.isdir(self.daemon_media_dir):
+                raise ConfigError(
+                    f"daemon.media_dir '{self.daemon_media_dir}' is not a directory"
+                )
+            self.daemon_media_dir = os.path.realpath(self.daemon_media_dir)
+
+        # Encryption setup
+        self.session_rotation_messages = self._get_cfg(
+            ["encryption", "session_rotation_messages"], default=100, required=False
+        )
+        if not isinstance(self.session_rotation_messages, int) or (
+            self.session_rotation_messages < 1
+        ):
+            raise ConfigError(
+                "encryption.session_rotation_messages must be a positive integer"
+            )
+        self.session_rotation_hours = self._get_cfg(
+            ["encryption", "session_rotation_hours"], default=168, required=False
+        )
+        if not isinstance(self.session_rotation_hours, (int, float)) or (
+            self.session_rotation_hours <= 0
+        ):
+            raise ConfigError(
+                "encryption.session_rotation_hours must be a positive number"
+            )
+
+    def _parse_account(self, index: int, account: Any) -> AccountConfig:
+        if not isinstance(account, dict):
+            raise ConfigError(f"accounts[{index}] must be a mapping")
+
+        user_name = account.get("user_name")
+        device_id = account.get("device_id")
+        if not user_name or not device_id:
+            raise ConfigError(f"accounts[{index}] needs a user_name and device_id")
+        user_password = account.get("user_password")
+        user_token = account.get("user_token")
+        if not user_token and not user_password:
+            raise ConfigError(f"accounts[{index}] needs a user token or password")
+
+        store_path = account.get("store_path") or os.path.join(
+            self.store_path, user_name
+        )
+        if not os.path.isdir(store_path):
+            if os.path.exists(store_path):
+                raise ConfigError(
+                    f"accounts[{index}].store_path '{store_path}' is not a directory"
+                )
+            os.makedirs(store_path)
+
+        return AccountConfig(
+            f"@{user_name}:{self.user_suffix}",
+            user_password,
+            user_token,
+            device_id,
+            account.get("device_name") or self.device_name,
+            store_path,
+        )
+
     def _get_cfg(
         self,
         path: List[str],
@@ -0,0 +1,188 @@
+import asyncio
+import hmac
+import logging
+import os
+import uuid
+from typing import Dict, Optional, Set
+
+from aiohttp import web
+
+from nio_send.campaign import CampaignMessage, MessageState, parse_row, run_campaign
+from nio_send.errors import ManifestError
+
+logger = logging.getLogger(__name__)
+
+
+class JobState:
+    """The states of a job submitted to the daemon"""
+
+    # Its messages are being queued
+    QUEUEING = "queueing"
+    # Every message was queued, and some are still being sent
+    SENDING = "sending"
+    # Every message was sent or failed
+    DONE = "done"
+    # Queueing the messages failed
+    FAILED = "failed"
+
+
+class JobServer:
+    def __init__(self, callbacks, config):
+        """Accepts send jobs over a local HTTP API, while the daemon stays logged in.
+
+        A job is a list of messages in the format of a manifest row. Each job is run
+        as a campaign of its own, identified by the job ID, so its messages go through
+        the outbound queue and their state is tracked in the database. Jobs run next
+        to each other, sharing the client's limits on requests in flight.
+
+        Requests have to be JSON, so web pages can't submit jobs without a CORS
+        preflight, and carry the configured bearer token if there is one. Files are
+        only sent from the configured media directory.
+
+        Endpoints:
+            POST /jobs: Submit `{"messages": [...]}`, returning `{"job_id": ...}`.
+
+            GET /jobs/{job_id}: The state of a job, and its number of messages in
+                each message state.
+
+        Args:
+            callbacks (Callbacks or AccountPool): The callbacks of the logged in
+                client, or the pool of accounts to send from.
+
+            config (Config): Bot configuration parameters.
+        """
+        self.callbacks = callbacks
+        self.config = config
+
+        # job ID -> the task running the job, for the jobs still being sent
+        self.jobs: Dict[str, asyncio.Task] = {}
+        # The IDs of the running jobs whose messages were all queued
+        self.queued_jobs: Set[str] = set()
+        self.runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.add_routes(
+            [
+                web.post("/jobs", self.submit),
+                web.get("/jobs/{job_id}", self.status),
+            ]
+        )
+
+    async def start(self) -> None:
+        """Start listening on the configured Unix socket, or else TCP address"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        if self.config.daemon_unix_socket:
+            site = web.UnixSite(self.runner, self.config.daemon_unix_socket)
+        else:
+            site = web.TCPSite(
+                self.runner, self.config.daemon_host, self.config.daemon_port
+            )
+        await site.start()
+        logger.info(f"Accepting jobs on {site.name}")
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+        for job in self.jobs.values():
+            job.cancel()
+
+    def _authorize(self, request: web.Request) -> None:
+        token = self.config.daemon_token
+        if token is None:
+            return
+        expected = f"Bearer {token}".encode()
+        given = request.headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(given, expected):
+            raise web.HTTPUnauthorized(reason="Missing or wrong token")
+
+    def _resolve_file(self, message: CampaignMessage) -> CampaignMessage:
+        """Check that the file of a message is in the media directory"""
+        media_dir = self.config.daemon_media_dir
+        if media_dir is None:
+            raise ManifestError(
+                "sending files is disabled, daemon.media_dir is not set"
+            )
+        path = os.path.realpath(message.content)
+        if os.path.commonpath([path, media_dir]) != media_dir:
+            raise ManifestError(f"'{message.content}' is outside of daemon.media_dir")
+        return message._replace(content=path)
+
+    async def submit(self, request: web.Request) -> web.Response:
+        self._authorize(request)
+        # Anything else could be sent by a web page, without a CORS preflight
+        if request.content_type != "application/json":
+            raise web.HTTPUnsupportedMediaType(reason="The body has to be JSON")
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(reason="The body is not valid JSON")
+
+        rows = body.get("messages") if isinstance(body, dict) else None
+        if not isinstance(rows, list) or not rows:
+            raise web.HTTPBadRequest(reason="A job needs a list of messages")
+
+        # Files are resolved relative to the media directory
+        base_dir = self.config.daemon_media_dir or os.getcwd()
+        messages = []
+        for row_number, row in enumerate(rows, start=1):
+            try:
+                message = parse_row(row, self.config.user_suffix, base_dir)
+                if message.message_type != "text":
+                    message = self._resolve_file(message)
+                messages.append(message)
+            except ManifestError as e:
+                raise web.HTTPBadRequest(reason=f"Invalid message {row_number}: {e}")
+
+        job_id = uuid.uuid4().hex
+        # Unfinished messages of earlier runs are resumed once, at startup, and not
+        # by every job
+        job = self.jobs[job_id] = asyncio.create_task(
+            run_campaign(
+                self.callbacks,
+                job_id,
+                messages,
+                resume_unfinished=False,
+                on_queued=lambda: self.queued_jobs.add(job_id),
+            )
+        )
+        job.add_done_callback(self._on_job_done)
+        logger.info(f"Accepted job {job_id} with {len(messages)} messages")
+
+        return web.json_response({"job_id": job_id}, status=201)
+
+    def _on_job_done(self, job: asyncio.Task) -> None:
+        if not job.cancelled() and job.exception() is not None:
+            logger.error(
+                "Failed to queue the messages of a job", exc_info=job.exception()
+            )
+            # Kept, to report the job as failed
+            return
+
+        # The states of its messages are in the database
+        for job_id, task in list(self.jobs.items()):
+            if task is job:
+                del self.jobs[job_id]
+                self.queued_jobs.discard(job_id)
+
+    async def status(self, request: web.Request) -> web.Response:
+        self._authorize(request)
+        job_id = request.match_info["job_id"]
+        counts = await self.callbacks.store.get_campaign_states(job_id)
+        job = self.jobs.get(job_id)
+        if job is None and not counts:
+            raise web.HTTPNotFound(reason="Unknown job")
+
+        running = job is not None and not job.done()
+        if running and job_id not in self.queued_jobs:
+            state = JobState.QUEUEING
+        elif (
+            not running and job is not None and not job.cancelled() and job.exception()
+        ):
+            state = JobState.FAILED
+        elif any(counts.get(state) for state in MessageState.UNFINISHED):
+            state = JobState.SENDING
+        else:
+            state = JobState.DONE
+
+        return web.json_response({"job_id": job_id, "state": state, "messages": counts})
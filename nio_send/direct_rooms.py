@@ -0,0 +1,90 @@
+import logging
+from typing import Dict, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, MatrixRoom, RoomMemberEvent
+
+from nio_send.chat_functions import get_private_msg_user, is_room_private_msg
+from nio_send.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class DirectRoomIndex:
+    def __init__(self, client: AsyncClient, store: Storage):
+        """An index of the private (DM) room the client shares with each user.
+
+        Looking up the DM of a user is a dictionary lookup instead of a search through
+        every joined room. The index is persisted in the database and kept up to date
+        from room member events.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            store: Bot storage, used to persist the index.
+        """
+        self.client = client
+        self.store = store
+
+        # user ID -> room ID
+        self.rooms: Dict[str, str] = {}
+
+    async def load(self) -> None:
+        """Load the index persisted by a previous run"""
+        self.rooms = await self.store.get_direct_rooms(self.client.user_id)
+        logger.debug(f"Loaded {len(self.rooms)} DM rooms from the database")
+
+    async def build(self) -> None:
+        """Index the DM rooms among all joined rooms.
+
+        This is a full scan of the client's rooms, so it is only done when nothing was
+        persisted by a previous run. Afterwards the index is kept up to date by
+        `update`.
+        """
+        if self.rooms:
+            return
+
+        for room in self.client.rooms.values():
+            user = get_private_msg_user(room, self.client.user_id)
+            if user is not None and user not in self.rooms:
+                await self._set(user, room.room_id)
+
+        logger.info(f"Indexed {len(self.rooms)} DM rooms")
+
+    async def get(self, mxid: str) -> Optional[MatrixRoom]:
+        """Get the DM room shared with a user, if there is one.
+
+        Entries whose room is no longer a DM with the user are dropped.
+        """
+        room_id = self.rooms.get(mxid)
+        if room_id is None:
+            return None
+
+        room = self.client.rooms.get(room_id)
+        if room is None or not is_room_private_msg(room, mxid):
+            logger.debug(f"Dropping stale DM {room_id} of {mxid}")
+            await self._delete(mxid)
+            return None
+
+        return room
+
+    async def update(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
+        """Update the index from a member event of a room"""
+        user = get_private_msg_user(room, self.client.user_id)
+        if user is not None:
+            # Keep the DM we already know of, unless it is no longer valid
+            if self.rooms.get(user) != room.room_id and await self.get(user) is None:
+                await self._set(user, room.room_id)
+        elif (
+            event.membership in ("leave", "ban")
+            and self.rooms.get(event.state_key) == room.room_id
+        ):
+            await self._delete(event.state_key)
+
+    async def _set(self, mxid: str, room_id: str) -> None:
+        self.rooms[mxid] = room_id
+        await self.store.set_direct_room(self.client.user_id, mxid, room_id)
+
+    async def _delete(self, mxid: str) -> None:
+        self.rooms.pop(mxid, None)
+        await self.store.delete_direct_room(self.client.user_id, mxid)
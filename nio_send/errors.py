@@ -10,3 +10,14 @@ class ConfigError(RuntimeError):
 
     def __init__(self, msg: str):
         super(ConfigError, self).__init__("%s" % (msg,))
+
+
+class ManifestError(RuntimeError):
+    """An error encountered while reading a campaign manifest.
+
+    Args:
+        msg: The message displayed to the user on error.
+    """
+
+    def __init__(self, msg: str):
+        super(ManifestError, self).__init__("%s" % (msg,))
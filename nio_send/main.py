@@ -2,20 +2,23 @@ import asyncio
 import logging
 import os
 import sys
+import uuid
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
-from nio import (
-    AsyncClient,
-    AsyncClientConfig,
-    LocalProtocolError,
-    LoginError,
-    RoomMemberEvent,
-)
 
-from nio_send.callbacks import Callbacks
+from nio_send.accounts import Account, AccountPool, wait_for_tasks
+from nio_send.campaign import (
+    CampaignMessage,
+    get_manifest_campaign,
+    read_manifest,
+    run_campaign,
+)
 from nio_send.config import Config
+from nio_send.daemon import JobServer
+from nio_send.media import hash_file
+from nio_send.preparation import FilePreparer
 from nio_send.storage import Storage
-from nio_send.utils import sleep_ms
+from nio_send.utils import AliasResolver
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
@@ -30,16 +33,26 @@ async def main(args):
     # Read user-configured options from a config file.
     # A different config file path can be specified as the first command line argument
     config_path = "config.yaml"
+    manifest_path = None
+    daemon = False
 
-    if len(args) == 4:
+    if len(args) == 3 and args[2] == "--daemon":
+        config_path = os.path.join(PROJECT_DIR, args[1])
+        daemon = True
+    elif len(args) == 4:
         config_path = os.path.join(
             PROJECT_DIR, args[1]
         )  # /home/user/nio_send/config.yaml
         file_path = args[2]  # /home/user/Downloads/image.png
         receiver_id = args[3]  # @test:matrix.org
+    elif len(args) == 3:
+        config_path = os.path.join(PROJECT_DIR, args[1])
+        manifest_path = args[2]  # /home/user/campaign.csv
     else:
         print(
-            "Wrong number of arguments. Usage: nio-send 'config.yaml' 'filepath' 'username'"
+            "Wrong number of arguments. Usage: nio-send 'config.yaml' 'filepath' 'username'\n"
+            "or, to send a campaign: nio-send 'config.yaml' 'manifest.csv|jsonl|yaml'\n"
+            "or, to accept send jobs over HTTP: nio-send 'config.yaml' --daemon"
         )
         exit(1)
 
@@ -53,117 +66,89 @@ async def main(args):
     )
     store = Storage(static_database)
 
-    # Configuration options for the AsyncClient
-    client_config = AsyncClientConfig(
-        max_limit_exceeded=0,
-        max_timeouts=0,
-        store_sync_tokens=True,
-        encryption_enabled=True,
+    # Resolves room aliases for every account
+    alias_resolver = AliasResolver(
+        config.alias_cache_ttl,
+        config.alias_cache_negative_ttl,
+        store if config.alias_cache_persist else None,
     )
-
-    # Initialize the matrix client
-    client = AsyncClient(
-        config.homeserver_url,
-        config.user_id,
-        device_id=config.device_id,
-        store_path=config.store_path,
-        config=client_config,
+    # Prepares files for sending on the other cores, for every account
+    file_preparer = (
+        FilePreparer(
+            config.file_workers, config.file_queue_size, config.encrypt_in_workers
+        )
+        if config.file_workers
+        else None
     )
-
-    if config.user_token:
-        client.access_token = config.user_token
-        client.user_id = config.user_id
-
-    client.user_name = config.user_name
-
-    receiver_id = f"@{receiver_id}:{config.user_suffix}"
-
-    # Set up event callbacks for receiving room member events
-    callbacks = Callbacks(client, store, config)
-    client.add_event_callback(callbacks.member, (RoomMemberEvent,))
+    accounts = [
+        Account(config, account, store, alias_resolver, file_preparer)
+        for account in config.accounts
+    ]
+    # Spreads the users over the accounts
+    pool = AccountPool(accounts, config, store)
+
+    if daemon:
+        # Only the unfinished messages of earlier runs, before accepting jobs
+        campaign = uuid.uuid4().hex
+        messages = []
+    elif manifest_path is not None:
+        # Rows are read lazily, as the campaign is being sent
+        messages = read_manifest(manifest_path, config.user_suffix)
+        # Running the same manifest again resumes it, or sends it again once finished
+        campaign = await get_manifest_campaign(store, await hash_file(manifest_path))
+    else:
+        campaign = uuid.uuid4().hex
+        receiver_id = f"@{receiver_id}:{config.user_suffix}"
+        messages = [
+            CampaignMessage(receiver_id, "text", "Hello World!", "User Room"),
+            CampaignMessage(receiver_id, "text", "Here is your file", "User Room"),
+            CampaignMessage(receiver_id, "image", file_path, "User Room"),
+        ]
+
+    for account in accounts:
+        await account.load()
+    job_server = JobServer(pool, config) if daemon else None
 
     # Keep trying to reconnect on failure (with some time in-between)
     try:
-        if config.user_token:
-            # Use token to log in
-            client.load_store()
-            # Sync encryption keys with the server
-            if client.should_upload_keys:
-                await client.keys_upload()
-        else:
-            # Try to login with the configured username/password
-            try:
-                login_response = await client.login(
-                    password=config.user_password,
-                    device_name=config.device_name,
-                )
-                # Check if login failed
-                if type(login_response) == LoginError:
-                    if login_response.status_code == "M_LIMIT_EXCEEDED":
-						await sleep_ms(login_response.retry_after_ms)
-						login_response = await client.login(
-							password=config.user_password,
-							device_name=config.device_name,
-						)
-					if type(login_response) == LoginError:
-						logger.error("Failed to login: %s", login_response.message)
-						return -1
-            except LocalProtocolError as e:
-                # There's an edge case here where the user hasn't installed the correct C
-                # dependencies. In that case, a LocalProtocolError is raised on login.
-                logger.fatal(
-                    "Failed to login. Have you installed the correct dependencies? "
-                    "https://github.com/poljar/matrix-nio#installation "
-                    "Error: %s",
-                    e,
-                )
+        for account in accounts:
+            if not await account.login() or not await account.prepare():
                 return -1
 
-        # Login succeeded!
-        logger.info(f"Logged in as {config.user_id}")
-
         # Create tasks for bot to perform asynchronously
-        async def after_first_sync(client: AsyncClient, tasks):
-            await client.synced.wait()
+        async def after_first_sync(messages):
+            for account in accounts:
+                await account.wait_ready()
 
-            for task in tasks:
-                await task
+            await run_campaign(pool, campaign, messages)
+            if job_server is not None:
+                # Keep syncing, for the jobs to come
+                for account in accounts:
+                    account.callbacks.sync_needed.set()
+                await job_server.start()
+            else:
+                # Stop the sync loops once the last message has been sent
+                pool.finish_queueing()
 
-        sync_forever_task = asyncio.create_task(
-            client.sync_forever(30000, full_state=True)
-        )
-        callbacks.main_loop = sync_forever_task
+        sync_tasks = [account.start_syncing() for account in accounts]
+        after_first_sync_task = asyncio.create_task(after_first_sync(messages))
 
-        # IMPORTANT BITS FOR SETTING UP MESSAGES
-        first_message = callbacks.send_msg(
-            receiver_id, "Hello World!", "text", roomname="User Room"
-        )
-        second_message = callbacks.send_msg(
-            receiver_id, "Here is your file", "text", roomname="User Room"
-        )
-        third_message = callbacks.send_msg(
-            receiver_id, file_path, "image", roomname="User Room"
-        )
-        task_queue = [first_message, second_message, third_message]
-        #############################################
-
-        callbacks.items_to_send = len(task_queue)
-        after_first_sync_task = asyncio.create_task(
-            after_first_sync(client, task_queue)
-        )
-
-        await asyncio.gather(
-            after_first_sync_task,
-            sync_forever_task,
-        )
+        await wait_for_tasks([after_first_sync_task, *sync_tasks])
 
     except (ClientConnectionError, ServerDisconnectedError):
         logger.warning("Unable to connect to homeserver")
         # Sleep so we don't bombard the server with login requests
-        await client.close()
+        for account in accounts:
+            await account.client.close()
         # Exit with error code 255
         sys.exit(-1)
     finally:
         # Make sure to close the client connection on disconnect
         logger.info("Exiting")
-        await client.close()
+        if job_server is not None:
+            await job_server.stop()
+        for account in accounts:
+            await account.close(campaign)
+        if file_preparer is not None:
+            file_preparer.shutdown()
+        await store.close()
@@ -0,0 +1,401 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Callable, Dict, NamedTuple, Optional
+
+import aiofiles
+from aiohttp import ClientError
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, UploadResponse
+
+from nio_send.preparation import FileInfo, FilePreparer, inspect_file, inspect_image
+from nio_send.ratelimit import get_rate_limiter
+from nio_send.storage import Storage
+from nio_send.utils import KeyedLock, LRUCache, sleep_ms
+
+logger = logging.getLogger(__name__)
+
+# The size of the chunks files are read and uploaded in
+CHUNK_SIZE = 64 * 1024
+
+# How often a failed upload is retried
+UPLOAD_RETRIES = 3
+
+# The minimum time between two progress reports of an upload, in seconds
+PROGRESS_INTERVAL = 1.0
+
+# Called with the number of bytes transferred, the total number of bytes and the
+# average transfer speed in bytes per second
+ProgressCallback = Callable[[int, int, float], None]
+
+# The number of files whose hash and MIME type are kept in memory
+FILE_INFO_CACHE_SIZE = 1024
+
+# The key of the blurhash in the info of image messages (MSC2448)
+BLURHASH_KEY = "xyz.amorgan.blurhash"
+
+MXC_URI_REGEX = re.compile(r"^mxc://[^/]+/[A-Za-z0-9_\-]+$")
+
+
+class UploadedMedia(NamedTuple):
+    """The result of uploading a file to the content repository"""
+
+    uri: str
+    # For encrypted uploads, the key, iv and hashes needed to decrypt the content
+    file_info: Optional[Dict[str, Any]] = None
+    # For images, the dimensions, thumbnail and blurhash of the `info` of messages
+    info: Optional[Dict[str, Any]] = None
+
+    @property
+    def encrypted(self) -> bool:
+        return self.file_info is not None
+
+    def as_file(self) -> Dict[str, Any]:
+        """The `file` object of an encrypted attachment message"""
+        return {"url": self.uri, **self.file_info}
+
+
+async def hash_file(path: str) -> str:
+    """Calculate the hex encoded SHA-256 hash of a file's content"""
+    sha256 = hashlib.sha256()
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def log_upload_progress(transferred: int, total: int, bytes_per_second: float) -> None:
+    """The default upload progress callback"""
+    logger.debug(
+        f"Uploaded {transferred}/{total} bytes ({bytes_per_second / 1024:.1f} KiB/s)"
+    )
+
+
+async def read_file_chunks(
+    path: str,
+    total: int,
+    on_progress: Optional[ProgressCallback] = None,
+) -> AsyncIterator[bytes]:
+    """Read a file in chunks of CHUNK_SIZE, reporting progress as they are consumed.
+
+    The next chunk is only read once the previous one was consumed, so a slow upload
+    holds back reading and memory use does not depend on the file size.
+    """
+    start = last_report = time.monotonic()
+    transferred = 0
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(CHUNK_SIZE):
+            yield chunk
+
+            transferred += len(chunk)
+            now = time.monotonic()
+            if on_progress is not None and (
+                now - last_report >= PROGRESS_INTERVAL or transferred >= total
+            ):
+                on_progress(transferred, total, transferred / max(now - start, 1e-6))
+                last_report = now
+
+
+async def upload_file(
+    client: AsyncClient,
+    path: str,
+    mime_type: str,
+    size: int,
+    on_progress: Optional[ProgressCallback] = log_upload_progress,
+    encrypt: bool = False,
+    preparer: Optional[FilePreparer] = None,
+) -> Optional[UploadedMedia]:
+    """Stream a file to the content repository, returning the upload on success.
+
+    When encrypting, each chunk is encrypted as it is read, so memory use does not
+    depend on the file size either way.
+
+    Uploads that are rate limited, fail with a server error or lose their connection
+    are retried up to UPLOAD_RETRIES times. The media API has no way to resume a
+    partial upload, so each attempt streams the file from the start.
+
+    Args:
+        client: The client to communicate to matrix with.
+
+        path: The path of the file to upload.
+
+        mime_type: The MIME type of the file.
+
+        size: The size of the file in bytes.
+
+        on_progress: Called periodically with the progress of the upload.
+
+        encrypt: Whether to upload the file as an encrypted attachment, for sending
+            to encrypted rooms.
+
+        preparer: Worker processes to encrypt the file in before uploading it, if
+            they are set to encrypt files. The file is otherwise encrypted on the
+            event loop while it is uploaded.
+    """
+    if encrypt and preparer is not None and preparer.encrypt_files:
+        encrypted_path, file_info = await preparer.encrypt_file(path)
+        try:
+            media = await _upload_file(
+                client, encrypted_path, os.path.basename(path), None, size, on_progress
+            )
+        finally:
+            os.remove(encrypted_path)
+        return media._replace(file_info=file_info) if media is not None else None
+
+    return await _upload_file(
+        client, path, os.path.basename(path), mime_type, size, on_progress, encrypt
+    )
+
+
+async def _upload_file(
+    client: AsyncClient,
+    path: str,
+    filename: str,
+    mime_type: Optional[str],
+    size: int,
+    on_progress: Optional[ProgressCallback],
+    encrypt: bool = False,
+) -> Optional[UploadedMedia]:
+    start = time.monotonic()
+    bucket = get_rate_limiter(client).buckets["upload"]
+
+    for attempt in range(UPLOAD_RETRIES + 1):
+        # Also the delay after the first failure, doubled for every further one
+        delay_ms = 1000 * 2**attempt
+        await bucket.acquire()
+        try:
+            resp, file_info = await client.upload(
+                lambda got_429, got_timeouts: read_file_chunks(path, size, on_progress),
+                # Encrypted content is uploaded without its real type
+                content_type=mime_type or "application/octet-stream",
+                filename=filename,
+                encrypt=encrypt,
+                filesize=size,
+            )
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to upload {path} (attempt {attempt + 1}): {e!r}")
+        else:
+            if isinstance(resp, UploadResponse):
+                bucket.on_success()
+                elapsed = time.monotonic() - start
+                logger.info(
+                    f"Uploaded {path} ({size} bytes) in {elapsed:.1f}s, "
+                    f"{size / max(elapsed, 1e-6) / 1024:.1f} KiB/s"
+                )
+                return UploadedMedia(resp.content_uri, file_info)
+
+            logger.warning(
+                f'Failed to upload file="{path}"; mime_type="{mime_type}"; '
+                f'filesize="{size}" (attempt {attempt + 1}): {resp}'
+            )
+            if resp.status_code == "M_LIMIT_EXCEEDED":
+                # The rate limiter holds back the next attempt
+                bucket.on_rate_limited(resp.retry_after_ms)
+                continue
+            elif (
+                resp.transport_response is not None
+                and resp.transport_response.status not in (408, 429)
+                and resp.transport_response.status < 500
+            ):
+                # Client errors, such as the file being too large, won't go away
+                return None
+
+        if attempt < UPLOAD_RETRIES:
+            await sleep_ms(delay_ms)
+
+    logger.error(f"Giving up uploading {path} after {UPLOAD_RETRIES + 1} attempts")
+    return None
+
+
+async def describe_image(
+    client: AsyncClient,
+    path: str,
+    media: UploadedMedia,
+    mime_type: str,
+    size: int,
+    preparer: Optional[FilePreparer] = None,
+) -> Dict[str, Any]:
+    """Describe an image for the `info` of the messages sending it, so clients can lay
+    it out without downloading it.
+
+    The description holds the dimensions and blurhash of the image, and a thumbnail.
+    Large images get a thumbnail of their own, uploaded (and encrypted, if the image
+    was) here; smaller images are their own thumbnail. Anything that can't be
+    generated, if the file is no image or the optional image dependencies are
+    missing, is left out.
+
+    Args:
+        client: The client to upload the thumbnail with.
+
+        path: The path of the image.
+
+        media: The upload of the image.
+
+        mime_type: The MIME type of the image.
+
+        size: The size of the image in bytes.
+
+        preparer: Worker processes to generate the thumbnail in. It is otherwise
+            generated in a thread.
+    """
+    if preparer is not None:
+        image = await preparer.inspect_image(path)
+    else:
+        image = await asyncio.to_thread(inspect_image, path)
+    if image is None:
+        return {}
+
+    info: Dict[str, Any] = {"w": image.width, "h": image.height}
+    if image.blurhash is not None:
+        info[BLURHASH_KEY] = image.blurhash
+
+    thumbnail = image.thumbnail
+    if thumbnail is not None:
+        try:
+            thumbnail_media = await upload_file(
+                client,
+                thumbnail.path,
+                thumbnail.mime_type,
+                thumbnail.size,
+                None,
+                media.encrypted,
+                preparer,
+            )
+        finally:
+            os.remove(thumbnail.path)
+        if thumbnail_media is None:
+            return info
+        thumbnail_info = {
+            "w": thumbnail.width,
+            "h": thumbnail.height,
+            "mimetype": thumbnail.mime_type,
+            "size": thumbnail.size,
+        }
+    else:
+        thumbnail_media = media
+        thumbnail_info = {
+            "w": image.width,
+            "h": image.height,
+            "mimetype": mime_type,
+            "size": size,
+        }
+
+    if thumbnail_media.encrypted:
+        info["thumbnail_file"] = thumbnail_media.as_file()
+    else:
+        info["thumbnail_url"] = thumbnail_media.uri
+    info["thumbnail_info"] = thumbnail_info
+    return info
+
+
+class MediaCache:
+    def __init__(self, store: Storage, max_age_days: int):
+        """A cache of the uris that file contents were uploaded to.
+
+        Files are identified by the SHA-256 hash and size of their content, so the
+        same content is only uploaded once, whatever the file is called. Encrypted
+        uploads are cached with their decryption info, so a file sent to many
+        encrypted rooms is also only encrypted once, and the description of an image
+        (its dimensions, thumbnail and blurhash) is generated once. The hash and MIME
+        type of a file are themselves cached by path, size, modification time and
+        inode, in memory and in the database, so unchanged files are not read again.
+
+        Args:
+            store: Bot storage, holding the cache.
+
+            max_age_days: How long an uploaded uri is reused for. Homeservers may purge
+                old media, so older uploads are evicted and the file uploaded again.
+        """
+        self.store = store
+        self.max_age = max_age_days * 24 * 60 * 60
+
+        # Serializes uploads of the same content, so concurrent sends of a file
+        # upload it once
+        self.upload_locks = KeyedLock()
+
+        # (path, size, mtime, inode) -> FileInfo
+        self.file_infos = LRUCache(FILE_INFO_CACHE_SIZE)
+        # Serializes inspecting the same file, so concurrent sends read it once
+        self.inspect_locks = KeyedLock()
+
+    async def evict_stale(self) -> None:
+        """Remove the uploads that are too old to be reused"""
+        await self.store.delete_media_uris_before(int(time.time()) - self.max_age)
+
+    async def get_file_info(
+        self,
+        path: str,
+        file_stat: os.stat_result,
+        preparer: Optional[FilePreparer] = None,
+    ) -> FileInfo:
+        """Get the content hash and MIME type of a file, only reading the file if it
+        changed.
+
+        The file is inspected by the preparer's worker processes if one is given.
+        """
+        path = os.path.abspath(path)
+        key = (path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        info = self.file_infos.get(key)
+        if info is not None:
+            return info
+
+        async with self.inspect_locks.acquire(key):
+            # Inspected while waiting for the lock
+            info = self.file_infos.get(key)
+            if info is not None:
+                return info
+
+            row = await self.store.get_file_info(*key)
+            if row is not None:
+                info = FileInfo(*row)
+            else:
+                if preparer is not None:
+                    info = await preparer.inspect_file(path)
+                else:
+                    info = await asyncio.to_thread(inspect_file, path)
+                await self.store.set_file_info(*key, *info)
+
+            self.file_infos.set(key, info)
+            return info
+
+    async def get_upload(
+        self, sha256: str, size: int, encrypted: bool
+    ) -> Optional[UploadedMedia]:
+        """Get the upload of some content, if it can be reused"""
+        row = await self.store.get_media_uri(sha256, size, encrypted)
+        if row is None:
+            return None
+
+        uri, file_info, info, uploaded_at = row
+        if not MXC_URI_REGEX.match(uri) or uploaded_at < time.time() - self.max_age:
+            logger.debug(f"Evicting stale media uri {uri}")
+            await self.store.delete_media_uri(sha256, size, encrypted)
+            return None
+
+        return UploadedMedia(
+            uri,
+            json.loads(file_info) if file_info else None,
+            json.loads(info) if info else None,
+        )
+
+    async def set_upload(self, sha256: str, size: int, media: UploadedMedia) -> None:
+        """Store the upload of some content"""
+        await self.store.set_media_uri(
+            sha256,
+            size,
+            media.encrypted,
+            media.uri,
+            json.dumps(media.file_info) if media.encrypted else None,
+            json.dumps(media.info) if media.info is not None else None,
+        )
+
+    async def set_info(self, sha256: str, size: int, media: UploadedMedia) -> None:
+        """Store the description of content uploaded before"""
+        await self.store.set_media_info(
+            sha256, size, media.encrypted, json.dumps(media.info)
+        )
@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple, TypeVar
+
+import magic
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+from nio.crypto.attachments import encrypted_attachment_generator
+
+# Images are only described (dimensions, thumbnail and blurhash) if the optional image
+# dependencies are installed: pip install nio-send[images]
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+try:
+    import blurhash
+except ImportError:
+    blurhash = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The size of the chunks files are read in by the workers
+CHUNK_SIZE = 64 * 1024
+
+# The bounding box of thumbnails. Smaller images are their own thumbnail.
+THUMBNAIL_SIZE = (800, 600)
+
+# The bounding box of the copy of an image its blurhash is computed from, and the
+# number of blurhash components along each axis
+BLURHASH_IMAGE_SIZE = (64, 64)
+BLURHASH_COMPONENTS = (4, 3)
+
+
+class FileInfo(NamedTuple):
+    """What is needed to know about a file before uploading it"""
+
+    sha256: str
+    mime_type: str
+
+
+def guess_mime_type(path: str) -> Optional[str]:
+    """Guess the MIME type of a file from its extension, without reading it"""
+    return mimetypes.guess_type(path, strict=False)[0]
+
+
+def sniff_mime_type(path: str) -> str:
+    """Detect the MIME type of a file, from its extension if it is a known one and
+    otherwise from its content"""
+    return guess_mime_type(path) or magic.from_file(path, mime=True)
+
+
+def inspect_file(path: str) -> FileInfo:
+    """Hash a file and detect its MIME type, reading it only once.
+
+    Files with an unknown extension are sniffed from their first chunk, which is
+    already read for hashing.
+    """
+    mime_type = guess_mime_type(path)
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            if mime_type is None:
+                mime_type = magic.from_buffer(chunk, mime=True)
+            sha256.update(chunk)
+    return FileInfo(sha256.hexdigest(), mime_type or "application/x-empty")
+
+
+class Thumbnail(NamedTuple):
+    """A thumbnail of an image, written to a temporary file"""
+
+    path: str
+    width: int
+    height: int
+    mime_type: str
+    size: int
+
+
+class ImageInfo(NamedTuple):
+    """What clients need to lay out an image before downloading it"""
+
+    width: int
+    height: int
+    blurhash: Optional[str] = None
+    thumbnail: Optional[Thumbnail] = None
+
+
+def inspect_image(path: str) -> Optional[ImageInfo]:
+    """Measure an image, and make a thumbnail and blurhash of it.
+
+    Returns:
+        The dimensions of the image, with its thumbnail (whose file the caller has to
+        remove) if it is larger than THUMBNAIL_SIZE and its blurhash if the blurhash
+        package is installed. None if the file is not an image, or Pillow is not
+        installed.
+    """
+    if Image is None:
+        return None
+
+    try:
+        with Image.open(path) as image:
+            # The dimensions clients display the image at
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+
+            encoded_blurhash = None
+            if blurhash is not None:
+                small = image.copy()
+                small.thumbnail(BLURHASH_IMAGE_SIZE)
+                encoded_blurhash = blurhash.encode(
+                    small.convert("RGB"), *BLURHASH_COMPONENTS
+                )
+
+            thumbnail = None
+            if width > THUMBNAIL_SIZE[0] or height > THUMBNAIL_SIZE[1]:
+                thumbnail = _write_thumbnail(image)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.debug(f"Not describing {path} as an image: {e!r}")
+        return None
+
+    return ImageInfo(width, height, encoded_blurhash, thumbnail)
+
+
+def _write_thumbnail(image: "Image.Image") -> Thumbnail:
+    image = image.copy()
+    image.thumbnail(THUMBNAIL_SIZE)
+    # Transparency needs PNG, everything else is smaller as JPEG
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        mime_type, image_format = "image/png", "PNG"
+    else:
+        mime_type, image_format = "image/jpeg", "JPEG"
+        image = image.convert("RGB")
+
+    fd, thumbnail_path = tempfile.mkstemp(prefix="nio-send-", suffix=".thumbnail")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            image.save(f, image_format)
+    except BaseException:
+        os.remove(thumbnail_path)
+        raise
+    return Thumbnail(
+        thumbnail_path,
+        image.width,
+        image.height,
+        mime_type,
+        os.path.getsize(thumbnail_path),
+    )
+
+
+def _read_chunks(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def encrypt_file(path: str) -> Tuple[str, Dict[str, Any]]:
+    """Encrypt a file as a Matrix attachment, into a temporary file.
+
+    Returns:
+        The path of the encrypted file, which the caller has to remove, and the
+        key, iv and hashes needed to decrypt it.
+    """
+    fd, encrypted_path = tempfile.mkstemp(prefix="nio-send-", suffix=".enc")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in encrypted_attachment_generator(_read_chunks(path)):
+                # The generator ends with the decryption info
+                if isinstance(chunk, dict):
+                    return encrypted_path, chunk
+                f.write(chunk)
+    except BaseException:
+        os.remove(encrypted_path)
+        raise
+    raise RuntimeError("Encrypting the attachment returned no decryption info")
+
+
+class FilePreparer:
+    def __init__(self, max_workers: int, max_queued: int, encrypt_files: bool = False):
+        """Prepares files for sending in worker processes.
+
+        Inspecting, encrypting and thumbnailing files is CPU bound, and would stall
+        the event loop (and with it syncing and sending) for as long as it runs. The
+        workers do it on the other cores instead. At most `max_queued` files are
+        waiting for or being prepared at once; callers beyond that wait for a slot, so
+        a large media campaign does not queue up more work than the workers get
+        through.
+
+        Args:
+            max_workers: The number of worker processes.
+
+            max_queued: The maximum number of files being prepared or waiting for a
+                worker.
+
+            encrypt_files: Whether to encrypt attachments in the workers too. They
+                are written to a temporary file and uploaded from there, which needs
+                as much free space as the attachment and reads and writes it twice
+                more, so attachments are otherwise encrypted while they are streamed.
+        """
+        # Forking the bot would copy its event loop, open connections and database
+        # into the workers, so they are started from a clean process instead
+        start_method = (
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self.executor = ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context(start_method)
+        )
+        self.slots = asyncio.Semaphore(max_queued)
+        self.encrypt_files = encrypt_files
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Run a picklable function in a worker, once a queue slot is free"""
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+
+    async def sniff_mime_type(self, path: str) -> str:
+        return await self.run(sniff_mime_type, path)
+
+    async def inspect_file(self, path: str) -> FileInfo:
+        return await self.run(inspect_file, path)
+
+    async def encrypt_file(self, path: str) -> Tuple[str, Dict[str, Any]]:
+        return await self.run(encrypt_file, path)
+
+    async def inspect_image(self, path: str) -> Optional[ImageInfo]:
+        return await self.run(inspect_image, path)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_file_preparer(client: AsyncClient) -> Optional[FilePreparer]:
+    """Get the file preparer of a client, if files are prepared in worker processes"""
+    return getattr(client, "file_preparer", None)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, LocalProtocolError
+
+logger = logging.getLogger(__name__)
+
+# How long to collect rooms becoming ready around the same time into one batch, in
+# seconds. The rooms of a sync all become ready at once.
+PREWARM_WINDOW = 0.05
+
+
+class SessionPrewarmer:
+    def __init__(self, client: AsyncClient, window: float = PREWARM_WINDOW):
+        """Sets up the encryption of new encrypted rooms before their first message.
+
+        Sending the first message to an encrypted room takes several round trips: the
+        room's members and their device keys are queried, one-time keys are claimed to
+        establish Olm sessions with the devices, and a Megolm session is shared over
+        those. Rooms that become ready together are prepared in a batch instead, with
+        a single keys query and a single key claim for all of their users, and their
+        Megolm sessions shared concurrently.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            window: How long to wait for more rooms before preparing a batch.
+        """
+        self.client = client
+        self.window = window
+
+        # room ID -> completed once the room was prepared
+        self.pending: Dict[str, asyncio.Future] = {}
+        self._batch: Optional[asyncio.Task] = None
+
+    def needs_prewarm(self, room_id: str) -> bool:
+        if self.client.olm is None:
+            return False
+        room = self.client.rooms.get(room_id)
+        return (
+            room is not None
+            and room.encrypted
+            and self.client.olm.should_share_group_session(room_id)
+        )
+
+    async def prewarm(self, room_id: str) -> None:
+        """Prepare the encryption of a room, together with the other rooms prepared
+        around the same time. Failures are logged and left to the first send."""
+        if not self.needs_prewarm(room_id):
+            return
+
+        if room_id not in self.pending:
+            self.pending[room_id] = asyncio.get_running_loop().create_future()
+        prepared = self.pending[room_id]
+        if self._batch is None:
+            self._batch = asyncio.create_task(self._run_batch())
+        await asyncio.shield(prepared)
+
+    async def _run_batch(self) -> None:
+        await asyncio.sleep(self.window)
+        batch, self.pending, self._batch = self.pending, {}, None
+        try:
+            await self._prewarm_rooms(list(batch))
+        except Exception:
+            logger.exception("Failed to prepare the encryption of new rooms")
+        finally:
+            for prepared in batch.values():
+                prepared.set_result(None)
+
+    async def _prewarm_rooms(self, room_ids: List[str]) -> None:
+        # Encryption keys are shared with every member, so the full member lists are
+        # needed. Rooms synced with lazy-loaded members only know some of them.
+        await asyncio.gather(
+            *(
+                self.client.joined_members(room_id)
+                for room_id in room_ids
+                if not self.client.rooms[room_id].members_synced
+            )
+        )
+
+        # One query for the device keys of every new member
+        if self.client.should_query_keys:
+            await self.client.keys_query()
+
+        # One claim for the one-time keys of every device without an Olm session
+        try:
+            users = self.client.get_users_for_key_claiming()
+        except LocalProtocolError:
+            # Sessions exist with every device already
+            users = None
+        if users:
+            await self.client.keys_claim(users)
+
+        results = await asyncio.gather(
+            *(
+                self.client.share_group_session(room_id, ignore_unverified_devices=True)
+                for room_id in room_ids
+                if self.needs_prewarm(room_id)
+                and room_id not in self.client.sharing_session
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to share a group session: {result!r}")
+
+        logger.debug(f"Prepared the encryption of {len(room_ids)} rooms")
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, RoomCreateResponse
+
+from nio_send.chat_functions import create_private_room
+
+logger = logging.getLogger(__name__)
+
+# How many provisioned rooms between two reports of the provisioning rate
+REPORT_EVERY = 100
+
+
+class RoomProvisioner:
+    def __init__(self, client: AsyncClient, max_in_flight: int):
+        """Creates the DM rooms of a campaign, with a fixed number of requests in flight.
+
+        Rooms are created with their user already invited, so each room takes a single
+        request. Room creation has its own limit on requests in flight, so a campaign
+        to many new users keeps creating rooms while messages are being sent to the
+        rooms that are ready, rather than the two competing for the same slots.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            max_in_flight: The maximum number of rooms created at once.
+        """
+        self.client = client
+        self.slots = asyncio.Semaphore(max_in_flight)
+
+        self.created = 0
+        self.failed = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def rate(self) -> float:
+        """The number of rooms created per second, since the first was requested"""
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.created / max(self.finished_at - self.started_at, 1e-6)
+
+    async def provision(self, mxid: str, room_name: str) -> Optional[str]:
+        """Create a DM room with a user, returning its room ID on success"""
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+        async with self.slots:
+            resp = await create_private_room(self.client, mxid, room_name)
+
+        self.finished_at = time.monotonic()
+        if not isinstance(resp, RoomCreateResponse):
+            self.failed += 1
+            return None
+
+        self.created += 1
+        if self.created % REPORT_EVERY == 0:
+            self.log_rate()
+        return resp.room_id
+
+    def log_rate(self) -> None:
+        logger.info(
+            f"Provisioned {self.created} rooms ({self.failed} failed) "
+            f"at {self.rate:.1f} rooms/s"
+        )
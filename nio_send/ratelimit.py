@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+logger = logging.getLogger(__name__)
+
+# The kinds of requests that are rate limited separately, with their default rate (in
+# requests per second) and burst size
+DEFAULT_LIMITS = {
+    "room_create": (0.5, 5),
+    "invite": (1.0, 10),
+    "send": (5.0, 20),
+    "upload": (1.0, 5),
+    "resolve": (1.0, 10),
+}
+
+# How often a rate limited request is retried before giving up
+DEFAULT_MAX_RETRIES = 5
+
+# The fraction of a wait that is randomly added to it, so that waiting requests don't
+# all retry at the same instant
+JITTER = 0.1
+
+# On a rate limit, the rate is multiplied by this factor
+RATE_DECREASE = 0.5
+# The slowest rate a bucket slows down to, as a fraction of its configured rate
+MIN_RATE = 0.05
+# On a success, this fraction of the configured rate is added to the rate again
+RATE_INCREASE = 0.05
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """Spaces out requests to stay below a rate limit.
+
+        Requests take a token before they are made; tokens are refilled at `rate` per
+        second, up to `burst` tokens. The rate adapts to the homeserver: it is halved
+        (and requests paused for the time the server asks for) whenever a request is
+        rate limited, and slowly recovers to the configured rate as requests succeed.
+
+        Args:
+            rate: The number of requests per second.
+
+            burst: The number of requests that may be made at once after being idle.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+        # Created on first use, so that it belongs to the running event loop
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait until a request may be made. Waiting requests are served in order."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+                await asyncio.sleep(wait * (1 + random.uniform(0, JITTER)))
+
+    def on_rate_limited(self, retry_after_ms: Optional[int]) -> None:
+        """Slow down after the homeserver rate limited a request"""
+        retry_after = (retry_after_ms or 1000) / 1000
+        now = time.monotonic()
+        self._refill(now)
+
+        # Retry a single request once the pause is over, then continue at the
+        # lowered rate
+        self.tokens = min(self.tokens, 1)
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.rate = max(
+            self.max_rate * MIN_RATE,
+            min(self.rate * RATE_DECREASE, 1 / retry_after),
+        )
+        logger.debug(
+            f"Rate limited, pausing for {retry_after:.2f}s and slowing down to "
+            f"{self.rate:.2f} requests/s"
+        )
+
+    def on_success(self) -> None:
+        """Speed up again after a request went through"""
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[float, int]] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ):
+        """The token buckets shared by all requests of a client.
+
+        Args:
+            limits: The rate (in requests per second) and burst size of each kind of
+                request. Kinds that are not given use DEFAULT_LIMITS.
+
+            max_retries: How often a rate limited request is retried before giving up.
+        """
+        limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.buckets = {
+            endpoint: TokenBucket(rate, burst)
+            for endpoint, (rate, burst) in limits.items()
+        }
+        self.max_retries = max_retries
+
+
+def get_rate_limiter(client: AsyncClient) -> RateLimiter:
+    """Get the rate limiter shared by all requests of a client"""
+    limiter = getattr(client, "rate_limiter", None)
+    if limiter is None:
+        limiter = client.rate_limiter = RateLimiter()
+    return limiter
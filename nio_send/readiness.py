@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import Dict
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, KeysQueryResponse, SyncResponse
+
+logger = logging.getLogger(__name__)
+
+
+class RoomReadiness:
+    """The stages a new room goes through before messages can be sent to it"""
+
+    # The room was created, but the invite of its user was not synced yet
+    CREATED = "created"
+    # The user was invited. Unencrypted rooms are ready from here on.
+    INVITED = "invited"
+    # Encryption is enabled, but the devices of the user are not known yet
+    ENCRYPTED = "encrypted"
+    # The devices of the user are known, so messages can be encrypted for them
+    DEVICES_KNOWN = "devices_known"
+
+
+class PendingRoom:
+    def __init__(self, room_id: str, mxid: str):
+        """A room that was created for a user, and is not ready to send to yet"""
+        self.room_id = room_id
+        self.mxid = mxid
+        self.state = RoomReadiness.CREATED
+        # Completes once messages can be sent to the room
+        self.ready = asyncio.get_running_loop().create_future()
+
+    def set_state(self, state: str) -> None:
+        logger.debug(f"Room {self.room_id} of {self.mxid} is now {state}")
+        self.state = state
+
+
+class RoomReadinessTracker:
+    def __init__(self, client: AsyncClient, timeout: float):
+        """Tracks new rooms until messages can be sent to them.
+
+        The state of each room is advanced from the synced room state after every sync
+        and device key query, rather than by looking at individual events, so a slow
+        sync or a skewed clock only delays a room, without losing it.
+
+        Args:
+            client: The client the rooms were created with.
+
+            timeout: The number of seconds to wait for a room to become ready.
+        """
+        self.client = client
+        self.timeout = timeout
+
+        # room ID -> room
+        self.pending: Dict[str, PendingRoom] = {}
+
+    def track(self, room_id: str, mxid: str) -> PendingRoom:
+        """Start tracking a room that was just created for a user"""
+        room = self.pending.get(room_id)
+        if room is None:
+            room = self.pending[room_id] = PendingRoom(room_id, mxid)
+            self._advance(room)
+        return room
+
+    async def wait(self, room_id: str) -> bool:
+        """Wait until a tracked room is ready, or the timeout has passed.
+
+        Rooms whose user was invited are usable even if their devices are not known
+        yet (the keys are then queried when sending), so only rooms without a synced
+        invite count as failed.
+
+        Returns:
+            Whether messages can be sent to the room.
+        """
+        room = self.pending[room_id]
+        try:
+            await asyncio.wait_for(asyncio.shield(room.ready), self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Room {room_id} of {room.mxid} was not ready after {self.timeout}s, "
+                f"stuck at {room.state}"
+            )
+            return room.state != RoomReadiness.CREATED
+        finally:
+            self.pending.pop(room_id, None)
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback advancing the rooms from the synced room state"""
+        self._advance_all()
+
+    async def on_keys_query(self, response: KeysQueryResponse) -> None:
+        """Response callback advancing the rooms waiting for the devices of their user"""
+        self._advance_all()
+
+    def _advance_all(self) -> None:
+        for room in list(self.pending.values()):
+            self._advance(room)
+
+    def _advance(self, pending: PendingRoom) -> None:
+        room = self.client.rooms.get(pending.room_id)
+        if room is None or pending.ready.done():
+            return
+
+        if pending.state == RoomReadiness.CREATED:
+            if (
+                pending.mxid not in room.users
+                and pending.mxid not in room.invited_users
+            ):
+                return
+            pending.set_state(RoomReadiness.INVITED)
+
+        if pending.state == RoomReadiness.INVITED:
+            # The encryption of a new room is synced together with its invite
+            if not room.encrypted or self.client.olm is None:
+                pending.ready.set_result(None)
+                return
+            pending.set_state(RoomReadiness.ENCRYPTED)
+
+        if pending.state == RoomReadiness.ENCRYPTED:
+            if pending.mxid in self.client.users_for_key_query:
+                return
+            pending.set_state(RoomReadiness.DEVICES_KNOWN)
+            pending.ready.set_result(None)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Sends a message to a room
+SendFunction = Callable[[str, Any], Awaitable[None]]
+
+
+class RoomWorkers:
+    def __init__(self, send: SendFunction):
+        """Sends messages through one worker per room.
+
+        Each room's messages are sent one after another, in the order they were
+        submitted, while the workers of different rooms run in parallel. Submitting
+        does not wait for anything, so no lock has to be held while sending. A worker
+        exits once its room has no more messages, reporting the room's flush rate.
+
+        Args:
+            send: Sends a single message to a room.
+        """
+        self.send = send
+
+        # room ID -> messages waiting to be sent, each with a future completed once sent
+        self.queues: Dict[str, Deque[Tuple[Any, asyncio.Future]]] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+
+        # The messages per second of every flush, for the summary
+        self.flush_rates: List[float] = []
+
+    def submit(self, room_id: str, message: Any) -> asyncio.Future:
+        """Queue a message to a room, returning a future completed once it was sent"""
+        sent = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(room_id, deque()).append((message, sent))
+        if room_id not in self.workers:
+            self.workers[room_id] = asyncio.create_task(self._work(room_id))
+        return sent
+
+    async def _work(self, room_id: str) -> None:
+        queue = self.queues[room_id]
+        start = time.monotonic()
+        flushed = 0
+        try:
+            while queue:
+                message, sent = queue.popleft()
+                try:
+                    await self.send(room_id, message)
+                except Exception:
+                    # Keep going, so one failure doesn't hold up the rest of the room
+                    logger.exception(f"Failed to send a message to {room_id}")
+                finally:
+                    sent.set_result(None)
+                flushed += 1
+        finally:
+            del self.queues[room_id]
+            del self.workers[room_id]
+
+        elapsed = time.monotonic() - start
+        rate = flushed / max(elapsed, 1e-6)
+        self.flush_rates.append(rate)
+        logger.debug(
+            f"Flushed {flushed} messages to {room_id} in {elapsed:.2f}s "
+            f"({rate:.1f} messages/s)"
+        )
+
+    def log_summary(self) -> None:
+        if self.flush_rates:
+            logger.info(
+                f"Flushed {len(self.flush_rates)} rooms, at a median of "
+                f"{statistics.median(self.flush_rates):.1f} messages/s per room"
+            )
@@ -0,0 +1,62 @@
+import logging
+from datetime import timedelta
+from typing import Dict
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+logger = logging.getLogger(__name__)
+
+
+class GroupSessionPolicy:
+    def __init__(self, client: AsyncClient, max_messages: int, max_age_hours: float):
+        """Applies the rotation policy to the Megolm sessions of rooms, and counts the
+        sessions that were shared.
+
+        A Megolm session is shared with every device in a room before it is used, so
+        each new session costs a round of key shares. A session is reused for every
+        message sent to its room until it has encrypted `max_messages` messages or is
+        `max_age_hours` old; nio still replaces it earlier if a member leaves.
+
+        Args:
+            client: The client whose sessions are managed.
+
+            max_messages: The number of messages a session encrypts before rotating.
+
+            max_age_hours: The number of hours a session is used before rotating.
+        """
+        self.client = client
+        self.max_messages = max_messages
+        self.max_age = timedelta(hours=max_age_hours)
+
+        # room ID -> the ID of the last session seen in the room
+        self.sessions: Dict[str, str] = {}
+        # The number of sessions shared, i.e. rounds of key shares
+        self.key_shares = 0
+
+    def observe(self, room_id: str) -> None:
+        """Apply the policy to the current session of a room, counting it if new.
+
+        Called after every send and after preparing a room, so a session is covered
+        by the policy before it could be rotated by nio's defaults.
+        """
+        if self.client.olm is None:
+            return
+        session = self.client.olm.outbound_group_sessions.get(room_id)
+        if session is None or not session.shared:
+            return
+
+        session.max_messages = self.max_messages
+        session.max_age = self.max_age
+
+        if self.sessions.get(room_id) != session.id:
+            self.sessions[room_id] = session.id
+            self.key_shares += 1
+            logger.debug(f"Shared a new group session {session.id} in {room_id}")
+
+    def log_summary(self, campaign: str) -> None:
+        if self.client.olm is not None:
+            logger.info(
+                f"Campaign {campaign}: shared {self.key_shares} group sessions "
+                f"in {len(self.sessions)} rooms"
+            )
@@ -0,0 +1,109 @@
+import json
+import logging
+import time
+from typing import Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, MatrixRoom, SyncResponse
+from nio.rooms import RoomSummary
+
+from nio_send.direct_rooms import DirectRoomIndex
+from nio_send.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# The minimum time between two snapshots taken while syncing, in seconds
+SNAPSHOT_INTERVAL = 60
+
+
+class SyncSnapshot:
+    def __init__(self, client: AsyncClient, store: Storage, dm_index: DirectRoomIndex):
+        """A snapshot of the synced state the bot needs to send, so a later run can
+        send right away rather than wait for its first sync.
+
+        Only the DM rooms are kept: whether they are encrypted, their members and
+        whether the member list is complete, and their summary, together with the sync
+        token they were taken at. With lazy-loaded members, the other member of a DM
+        may only be named among the heroes of its summary. The DM index and the device lists of encrypted rooms are already
+        persisted, by the index itself and the client's encryption store.
+
+        Args:
+            client: The client whose rooms are snapshotted.
+
+            store: Bot storage, holding the snapshot.
+
+            dm_index: The index of DM rooms, naming the rooms to keep.
+        """
+        self.client = client
+        self.store = store
+        self.dm_index = dm_index
+        self.saved_at = 0.0
+
+    async def restore(self) -> bool:
+        """Restore the rooms and sync token of the last snapshot.
+
+        Syncing then continues from that token, catching up with whatever changed
+        since in the background.
+
+        Returns:
+            Whether a snapshot was restored.
+        """
+        snapshot = await self.store.get_sync_snapshot(self.client.user_id)
+        if snapshot is None:
+            return False
+
+        next_batch, rooms = snapshot
+        for room_id, encrypted, members_synced, members, summary in rooms:
+            room = MatrixRoom(room_id, self.client.user_id, bool(encrypted))
+            for user_id, membership in json.loads(members).items():
+                room.add_member(user_id, None, None, invited=membership == "invite")
+            room.members_synced = bool(members_synced)
+            if summary is not None:
+                room.summary = RoomSummary(**json.loads(summary))
+            self.client.rooms[room_id] = room
+
+        self.client.next_batch = next_batch
+        logger.info(f"Restored {len(rooms)} rooms from the sync snapshot")
+        return True
+
+    async def save(self) -> None:
+        """Snapshot the DM rooms, as of the last sync"""
+        if self.client.next_batch is None:
+            return
+
+        rooms = []
+        for room_id in set(self.dm_index.rooms.values()):
+            room: Optional[MatrixRoom] = self.client.rooms.get(room_id)
+            if room is None:
+                continue
+            members = {user_id: "join" for user_id in room.users}
+            members.update({user_id: "invite" for user_id in room.invited_users})
+            summary = None
+            if room.summary is not None:
+                summary = json.dumps(
+                    {
+                        "invited_member_count": room.summary.invited_member_count,
+                        "joined_member_count": room.summary.joined_member_count,
+                        "heroes": room.summary.heroes,
+                    }
+                )
+            rooms.append(
+                (
+                    room_id,
+                    room.encrypted,
+                    room.members_synced,
+                    json.dumps(members),
+                    summary,
+                )
+            )
+
+        await self.store.set_sync_snapshot(
+            self.client.user_id, self.client.next_batch, rooms
+        )
+        self.saved_at = time.monotonic()
+        logger.debug(f"Saved a sync snapshot of {len(rooms)} rooms")
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback refreshing the snapshot every SNAPSHOT_INTERVAL seconds"""
+        if time.monotonic() - self.saved_at >= SNAPSHOT_INTERVAL:
+            await self.save()
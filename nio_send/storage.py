@@ -1,5 +1,10 @@
+import asyncio
+import functools
 import logging
-from typing import Any, Dict
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
 
 # The latest migration version of the database.
 #
@@ -8,10 +13,29 @@ from typing import Any, Dict
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 1
+latest_migration_version = 13
+
+# The account of the DM rooms stored before there were several accounts, until the main
+# account claims them
+UNCLAIMED_ACCOUNT = ""
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+def on_database_thread(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Turn a blocking Storage method into a coroutine that runs it on the database
+    thread, so queries don't block the event loop."""
+
+    @functools.wraps(func)
+    async def wrapper(self: "Storage", *args, **kwargs) -> T:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, self, *args, **kwargs)
+        )
+
+    return wrapper
+
 
 class Storage:
     def __init__(self, database_config: Dict[str, str]):
@@ -20,12 +44,23 @@ class Storage:
         Runs an initial setup or migrations depending on whether a database file has already
         been created.
 
+        The database connection is only ever used from a single dedicated thread. The
+        query methods are coroutines that wait for that thread, so blocking database
+        calls never stall the event loop.
+
         Args:
             database_config: a dictionary containing the following keys:
                 * type: A string, one of "sqlite" or "postgres".
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
         """
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="nio-send-db"
+        )
+        self._executor.submit(self._setup, database_config).result()
+
+    def _setup(self, database_config: Dict[str, str]) -> None:
+        """Connect to the database and bring it up to date. Runs on the database thread."""
         self.conn = self._get_database_connection(
             database_config["type"], database_config["connection_string"]
         )
@@ -120,6 +155,270 @@ class Storage:
 
             logger.info("Database migrated to v1")
 
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # Add table mapping users to their DM room, so we don't have to search
+            # every joined room for one each time a message is sent
+            self._execute(
+                """
+                CREATE TABLE direct_rooms (
+                    user_id TEXT PRIMARY KEY,
+                    room_id TEXT NOT NULL
+                )
+                """
+            )
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # Uploaded media is deduplicated by content instead of by filename, so
+            # replace the filename keyed table
+            self._execute("DROP TABLE static_media_uris")
+
+            # The content hash of each file, so unchanged files are not hashed again
+            self._execute(
+                """
+                CREATE TABLE media_files (
+                    path TEXT PRIMARY KEY,
+                    size BIGINT NOT NULL,
+                    mtime_ns BIGINT NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+                """
+            )
+            # The uri each distinct file content was uploaded to
+            self._execute(
+                """
+                CREATE TABLE media_uploads (
+                    sha256 TEXT NOT NULL,
+                    size BIGINT NOT NULL,
+                    uri TEXT NOT NULL,
+                    uploaded_at BIGINT NOT NULL,
+                    PRIMARY KEY (sha256, size)
+                )
+                """
+            )
+            self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+
+        if current_migration_version < 4:
+            logger.info("Migrating the database from v3 to v4...")
+
+            # Encrypted uploads of content are cached separately from plain ones,
+            # together with the key needed to decrypt them
+            self._execute(
+                """
+                CREATE TABLE media_uploads_v4 (
+                    sha256 TEXT NOT NULL,
+                    size BIGINT NOT NULL,
+                    encrypted INTEGER NOT NULL,
+                    uri TEXT NOT NULL,
+                    file_info TEXT,
+                    uploaded_at BIGINT NOT NULL,
+                    PRIMARY KEY (sha256, size, encrypted)
+                )
+                """
+            )
+            self._execute(
+                """
+                INSERT INTO media_uploads_v4 (
+                    sha256, size, encrypted, uri, file_info, uploaded_at
+                )
+                SELECT sha256, size, 0, uri, NULL, uploaded_at FROM media_uploads
+                """
+            )
+            self._execute("DROP TABLE media_uploads")
+            self._execute("ALTER TABLE media_uploads_v4 RENAME TO media_uploads")
+            self._execute("UPDATE migration_version SET version = 4")
+
+            logger.info("Database migrated to v4")
+
+        if current_migration_version < 5:
+            logger.info("Migrating the database from v4 to v5...")
+
+            # Add table tracking the state of every queued message, so a campaign
+            # can be resumed after a crash without sending anything twice
+            self._execute(
+                """
+                CREATE TABLE outbound_messages (
+                    txn_id TEXT PRIMARY KEY,
+                    campaign TEXT NOT NULL,
+                    position BIGINT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    message_type TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    room_name TEXT NOT NULL,
+                    room_id TEXT,
+                    state TEXT NOT NULL,
+                    updated_at BIGINT NOT NULL,
+                    UNIQUE (campaign, position)
+                )
+                """
+            )
+            self._execute(
+                "CREATE INDEX outbound_messages_state ON outbound_messages (state)"
+            )
+            self._execute("UPDATE migration_version SET version = 5")
+
+            logger.info("Database migrated to v5")
+
+        if current_migration_version < 6:
+            logger.info("Migrating the database from v5 to v6...")
+
+            # Add tables holding a snapshot of the synced rooms, so sending can start
+            # before the first sync completes
+            self._execute(
+                """
+                CREATE TABLE sync_snapshot (
+                    next_batch TEXT NOT NULL,
+                    saved_at BIGINT NOT NULL
+                )
+                """
+            )
+            self._execute(
+                """
+                CREATE TABLE sync_snapshot_rooms (
+                    room_id TEXT PRIMARY KEY,
+                    encrypted INTEGER NOT NULL,
+                    members_synced INTEGER NOT NULL,
+                    members TEXT NOT NULL
+                )
+                """
+            )
+            self._execute("UPDATE migration_version SET version = 6")
+
+            logger.info("Database migrated to v6")
+
+        if current_migration_version < 7:
+            logger.info("Migrating the database from v6 to v7...")
+
+            # Add the per-recipient values of the placeholders of queued messages
+            self._execute("ALTER TABLE outbound_messages ADD COLUMN variables TEXT")
+            self._execute("UPDATE migration_version SET version = 7")
+
+            logger.info("Database migrated to v7")
+
+        if current_migration_version < 8:
+            logger.info("Migrating the database from v7 to v8...")
+
+            # Add table remembering resolved room aliases across runs
+            self._execute(
+                """
+                CREATE TABLE room_aliases (
+                    alias TEXT PRIMARY KEY,
+                    room_id TEXT NOT NULL,
+                    resolved_at BIGINT NOT NULL
+                )
+                """
+            )
+            self._execute("UPDATE migration_version SET version = 8")
+
+            logger.info("Database migrated to v8")
+
+        if current_migration_version < 9:
+            logger.info("Migrating the database from v8 to v9...")
+
+            # Several accounts may send from the same database, each with DM rooms and
+            # a sync snapshot of its own. The DM rooms of the single account before
+            # are kept without an account, until the main account claims them. The
+            # snapshot is dropped, and taken again after the first sync.
+            self._execute("ALTER TABLE direct_rooms RENAME TO direct_rooms_v8")
+            self._execute(
+                """
+                CREATE TABLE direct_rooms (
+                    account TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    room_id TEXT NOT NULL,
+                    PRIMARY KEY (account, user_id)
+                )
+                """
+            )
+            self._execute(
+                """
+                INSERT INTO direct_rooms (account, user_id, room_id)
+                SELECT ?, user_id, room_id FROM direct_rooms_v8
+                """,
+                (UNCLAIMED_ACCOUNT,),
+            )
+            self._execute("DROP TABLE direct_rooms_v8")
+            self._execute("DROP TABLE sync_snapshot")
+            self._execute("DROP TABLE sync_snapshot_rooms")
+            self._execute(
+                """
+                CREATE TABLE sync_snapshot (
+                    account TEXT PRIMARY KEY,
+                    next_batch TEXT NOT NULL,
+                    saved_at BIGINT NOT NULL
+                )
+                """
+            )
+            self._execute(
+                """
+                CREATE TABLE sync_snapshot_rooms (
+                    account TEXT NOT NULL,
+                    room_id TEXT NOT NULL,
+                    encrypted INTEGER NOT NULL,
+                    members_synced INTEGER NOT NULL,
+                    members TEXT NOT NULL,
+                    PRIMARY KEY (account, room_id)
+                )
+                """
+            )
+            self._execute("UPDATE migration_version SET version = 9")
+
+            logger.info("Database migrated to v9")
+
+        if current_migration_version < 10:
+            logger.info("Migrating the database from v9 to v10...")
+
+            # Files are also told apart by inode, and their MIME type is cached with
+            # their hash. Files hashed before have no inode, so are inspected again.
+            self._execute("ALTER TABLE media_files ADD COLUMN inode BIGINT")
+            self._execute("ALTER TABLE media_files ADD COLUMN mime_type TEXT")
+            self._execute("UPDATE migration_version SET version = 10")
+
+            logger.info("Database migrated to v10")
+
+        if current_migration_version < 11:
+            logger.info("Migrating the database from v10 to v11...")
+
+            # The dimensions, thumbnail and blurhash of uploaded images, so they are
+            # only generated once
+            self._execute("ALTER TABLE media_uploads ADD COLUMN info TEXT")
+            self._execute("UPDATE migration_version SET version = 11")
+
+            logger.info("Database migrated to v11")
+
+        if current_migration_version < 12:
+            logger.info("Migrating the database from v11 to v12...")
+
+            # The room summary of each snapshotted room, as the members of rooms synced
+            # with lazy-loaded members may only be known from it. Rooms snapshotted
+            # before have none, until the next snapshot.
+            self._execute("ALTER TABLE sync_snapshot_rooms ADD COLUMN summary TEXT")
+            self._execute("UPDATE migration_version SET version = 12")
+
+            logger.info("Database migrated to v12")
+
+        if current_migration_version < 13:
+            logger.info("Migrating the database from v12 to v13...")
+
+            # When each message was queued, so unfinished messages are resumed in the
+            # order they were queued in. Messages queued before only have the time
+            # they were last updated to go by.
+            self._execute("ALTER TABLE outbound_messages ADD COLUMN queued_at BIGINT")
+            self._execute(
+                "UPDATE outbound_messages SET queued_at = updated_at * 1000000"
+            )
+            self._execute("UPDATE migration_version SET version = 13")
+
+            logger.info("Database migrated to v13")
+
     def _execute(self, *args) -> None:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
 
@@ -133,44 +432,487 @@ class Storage:
         else:
             self.cursor.execute(*args)
 
-    def delete_uri(self, filename: str):
-        """Delete a uri entry via its filename"""
+    @on_database_thread
+    def close(self) -> None:
+        """Close the database connection"""
+        self.conn.close()
+        self._executor.shutdown(wait=False)
+
+    @on_database_thread
+    def get_file_info(
+        self, path: str, size: int, mtime_ns: int, inode: int
+    ) -> Optional[Tuple[str, str]]:
+        """Get the content hash and MIME type of a file, if the file has not changed
+        since it was last inspected"""
         self._execute(
             """
-            DELETE FROM static_media_uris WHERE filename = ?
+            SELECT sha256, mime_type FROM media_files
+            WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?
+                AND mime_type IS NOT NULL
         """,
-            ((filename,)),
+            (
+                path,
+                size,
+                mtime_ns,
+                inode,
+            ),
         )
 
-    def get_uri(self, filename):
-        """Get the uri of a file by the filename"""
+        row = self.cursor.fetchone()
+        if row is not None:
+            return row[0], row[1]
+        return None
 
+    @on_database_thread
+    def set_file_info(
+        self,
+        path: str,
+        size: int,
+        mtime_ns: int,
+        inode: int,
+        sha256: str,
+        mime_type: str,
+    ):
+        """Store the content hash and MIME type of a file"""
         self._execute(
             """
-            SELECT uri FROM static_media_uris
-            WHERE filename = ?
+            INSERT INTO media_files (
+                path,
+                size,
+                mtime_ns,
+                inode,
+                sha256,
+                mime_type
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?
+            )
+            ON CONFLICT (path) DO UPDATE SET
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                inode = excluded.inode,
+                sha256 = excluded.sha256,
+                mime_type = excluded.mime_type
         """,
-            ((filename,)),
+            (
+                path,
+                size,
+                mtime_ns,
+                inode,
+                sha256,
+                mime_type,
+            ),
+        )
+
+    @on_database_thread
+    def get_media_uri(
+        self, sha256: str, size: int, encrypted: bool
+    ) -> Optional[Tuple[str, Optional[str], Optional[str], int]]:
+        """Get the uri, the JSON encoded decryption info (for encrypted uploads), the
+        JSON encoded message info (for images) and the upload time (in seconds since
+        the epoch) of uploaded content"""
+        self._execute(
+            """
+            SELECT uri, file_info, info, uploaded_at FROM media_uploads
+            WHERE sha256 = ? AND size = ? AND encrypted = ?
+        """,
+            (
+                sha256,
+                size,
+                int(encrypted),
+            ),
         )
 
         row = self.cursor.fetchone()
         if row is not None:
-            return row[0]
+            return row[0], row[1], row[2], row[3]
         return None
 
-    def set_uri(self, filename, uri):
-        """Create a new URI for a file with filename"""
+    @on_database_thread
+    def set_media_uri(
+        self,
+        sha256: str,
+        size: int,
+        encrypted: bool,
+        uri: str,
+        file_info: Optional[str] = None,
+        info: Optional[str] = None,
+    ):
+        """Store the uri that content was uploaded to"""
         self._execute(
             """
-            INSERT INTO static_media_uris (
-                filename,
-                uri
-            ) VALUES(
-                ?, ?
+            INSERT INTO media_uploads (
+                sha256,
+                size,
+                encrypted,
+                uri,
+                file_info,
+                info,
+                uploaded_at
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?, ?
             )
+            ON CONFLICT (sha256, size, encrypted) DO UPDATE SET
+                uri = excluded.uri,
+                file_info = excluded.file_info,
+                info = excluded.info,
+                uploaded_at = excluded.uploaded_at
         """,
             (
-                filename,
+                sha256,
+                size,
+                int(encrypted),
                 uri,
+                file_info,
+                info,
+                int(time.time()),
+            ),
+        )
+
+    @on_database_thread
+    def set_media_info(self, sha256: str, size: int, encrypted: bool, info: str):
+        """Store the message info of content uploaded before, keeping its upload
+        time"""
+        self._execute(
+            """
+            UPDATE media_uploads SET info = ?
+            WHERE sha256 = ? AND size = ? AND encrypted = ?
+        """,
+            (
+                info,
+                sha256,
+                size,
+                int(encrypted),
+            ),
+        )
+
+    @on_database_thread
+    def delete_media_uri(self, sha256: str, size: int, encrypted: bool):
+        """Forget the uri of uploaded content"""
+        self._execute(
+            """
+            DELETE FROM media_uploads
+            WHERE sha256 = ? AND size = ? AND encrypted = ?
+        """,
+            (
+                sha256,
+                size,
+                int(encrypted),
             ),
         )
+
+    @on_database_thread
+    def delete_media_uris_before(self, uploaded_before: int):
+        """Forget the uris of all content uploaded before a time, in seconds since the
+        epoch"""
+        self._execute(
+            """
+            DELETE FROM media_uploads WHERE uploaded_at < ?
+        """,
+            (uploaded_before,),
+        )
+
+    @on_database_thread
+    def get_direct_rooms(self, account: str) -> Dict[str, str]:
+        """Get the DM room IDs of an account with all users, keyed by user ID"""
+        self._execute(
+            """
+            SELECT user_id, room_id FROM direct_rooms WHERE account = ?
+        """,
+            (account,),
+        )
+        return dict(self.cursor.fetchall())
+
+    @on_database_thread
+    def set_direct_room(self, account: str, user_id: str, room_id: str):
+        """Store the DM room of an account with a user, replacing any previous one"""
+        self._execute(
+            """
+            INSERT INTO direct_rooms (
+                account,
+                user_id,
+                room_id
+            ) VALUES (
+                ?, ?, ?
+            )
+            ON CONFLICT (account, user_id) DO UPDATE SET room_id = excluded.room_id
+        """,
+            (
+                account,
+                user_id,
+                room_id,
+            ),
+        )
+
+    @on_database_thread
+    def claim_direct_rooms(self, account: str):
+        """Assign the DM rooms stored before there were several accounts to an
+        account"""
+        self._execute(
+            """
+            UPDATE direct_rooms SET account = ? WHERE account = ?
+        """,
+            (
+                account,
+                UNCLAIMED_ACCOUNT,
+            ),
+        )
+
+    @on_database_thread
+    def delete_direct_room(self, account: str, user_id: str):
+        """Forget the DM room of an account with a user"""
+        self._execute(
+            """
+            DELETE FROM direct_rooms WHERE account = ? AND user_id = ?
+        """,
+            (
+                account,
+                user_id,
+            ),
+        )
+
+    @on_database_thread
+    def get_room_alias(self, alias: str) -> Optional[Tuple[str, int]]:
+        """Get the room ID a room alias was resolved to, and when it was resolved"""
+        self._execute(
+            """
+            SELECT room_id, resolved_at FROM room_aliases WHERE alias = ?
+        """,
+            (alias,),
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    @on_database_thread
+    def set_room_alias(self, alias: str, room_id: str):
+        """Store the room ID a room alias was resolved to"""
+        self._execute(
+            """
+            INSERT INTO room_aliases (
+                alias,
+                room_id,
+                resolved_at
+            ) VALUES (
+                ?, ?, ?
+            )
+            ON CONFLICT (alias) DO UPDATE SET
+                room_id = excluded.room_id,
+                resolved_at = excluded.resolved_at
+        """,
+            (
+                alias,
+                room_id,
+                int(time.time()),
+            ),
+        )
+
+    @on_database_thread
+    def enqueue_message(
+        self,
+        campaign: str,
+        position: int,
+        user_id: str,
+        message_type: str,
+        content: str,
+        room_name: str,
+        variables: Optional[str],
+        state: str,
+    ) -> Tuple[str, str, Optional[str]]:
+        """Queue a message of a campaign, unless it was queued before.
+
+        Args:
+            variables: The values of the message's placeholders, as a JSON object.
+
+        Returns:
+            The transaction ID, state and (if known) room ID of the message.
+        """
+        self._execute(
+            """
+            INSERT INTO outbound_messages (
+                txn_id,
+                campaign,
+                position,
+                user_id,
+                message_type,
+                content,
+                room_name,
+                variables,
+                state,
+                updated_at,
+                queued_at
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+            )
+            ON CONFLICT (campaign, position) DO NOTHING
+        """,
+            (
+                uuid.uuid4().hex,
+                campaign,
+                position,
+                user_id,
+                message_type,
+                content,
+                room_name,
+                variables,
+                state,
+                int(time.time()),
+                # In microseconds, so messages queued in quick succession keep their
+                # order
+                time.time_ns() // 1000,
+            ),
+        )
+        self._execute(
+            """
+            SELECT txn_id, state, room_id FROM outbound_messages
+            WHERE campaign = ? AND position = ?
+        """,
+            (
+                campaign,
+                position,
+            ),
+        )
+        row = self.cursor.fetchone()
+        return row[0], row[1], row[2]
+
+    @on_database_thread
+    def set_message_state(self, txn_id: str, state: str, room_id: str = None):
+        """Update the state of a queued message, and the room it is sent to"""
+        self._execute(
+            """
+            UPDATE outbound_messages
+            SET state = ?, room_id = COALESCE(?, room_id), updated_at = ?
+            WHERE txn_id = ?
+        """,
+            (
+                state,
+                room_id,
+                int(time.time()),
+                txn_id,
+            ),
+        )
+
+    @on_database_thread
+    def get_campaign_states(self, campaign: str) -> Dict[str, int]:
+        """Get the number of messages of a campaign in each state"""
+        self._execute(
+            """
+            SELECT state, COUNT(*) FROM outbound_messages
+            WHERE campaign = ?
+            GROUP BY state
+        """,
+            (campaign,),
+        )
+        return dict(self.cursor.fetchall())
+
+    @on_database_thread
+    def get_unfinished_messages(
+        self, states: Tuple[str, ...], exclude_campaign: str
+    ) -> List[Tuple[str, str, str, str, str, Optional[str], Optional[str]]]:
+        """Get the messages of other campaigns in one of the given states, in the
+        order they were queued.
+
+        Returns:
+            A list of (txn_id, user_id, message_type, content, room_name, variables,
+            room_id) tuples.
+        """
+        self._execute(
+            f"""
+            SELECT txn_id, user_id, message_type, content, room_name, variables,
+                room_id
+            FROM outbound_messages
+            WHERE state IN ({", ".join("?" * len(states))}) AND campaign != ?
+            ORDER BY queued_at, position
+        """,
+            (*states, exclude_campaign),
+        )
+        return self.cursor.fetchall()
+
+    @on_database_thread
+    def get_sync_snapshot(
+        self, account: str
+    ) -> Optional[Tuple[str, List[Tuple[str, int, int, str, Optional[str]]]]]:
+        """Get the last snapshot of the rooms synced by an account, if one was saved.
+
+        Returns:
+            The sync token the snapshot was taken at, and a list of
+            (room_id, encrypted, members_synced, members, summary) tuples, where members
+            is a JSON object of the membership of each user, and summary a JSON object
+            of the room summary, if the room had one.
+        """
+        self._execute(
+            """
+            SELECT next_batch FROM sync_snapshot WHERE account = ?
+        """,
+            (account,),
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+
+        self._execute(
+            """
+            SELECT room_id, encrypted, members_synced, members, summary
+            FROM sync_snapshot_rooms WHERE account = ?
+        """,
+            (account,),
+        )
+        return row[0], self.cursor.fetchall()
+
+    @on_database_thread
+    def set_sync_snapshot(
+        self,
+        account: str,
+        next_batch: str,
+        rooms: List[Tuple[str, bool, bool, str, Optional[str]]],
+    ):
+        """Replace the snapshot of the rooms synced by an account"""
+        self._execute("BEGIN")
+        try:
+            self._execute("DELETE FROM sync_snapshot WHERE account = ?", (account,))
+            self._execute(
+                "DELETE FROM sync_snapshot_rooms WHERE account = ?", (account,)
+            )
+            self._execute(
+                """
+                INSERT INTO sync_snapshot (
+                    account,
+                    next_batch,
+                    saved_at
+                ) VALUES (
+                    ?, ?, ?
+                )
+            """,
+                (
+                    account,
+                    next_batch,
+                    int(time.time()),
+                ),
+            )
+            for room_id, encrypted, members_synced, members, summary in rooms:
+                self._execute(
+                    """
+                    INSERT INTO sync_snapshot_rooms (
+                        account,
+                        room_id,
+                        encrypted,
+                        members_synced,
+                        members,
+                        summary
+                    ) VALUES (
+                        ?, ?, ?, ?, ?, ?
+                    )
+                """,
+                    (
+                        account,
+                        room_id,
+                        int(encrypted),
+                        int(members_synced),
+                        members,
+                        summary,
+                    ),
+                )
+        except Exception:
+            self._execute("ROLLBACK")
+            raise
+        self._execute("COMMIT")
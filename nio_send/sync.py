@@ -0,0 +1,76 @@
+import logging
+from typing import Any, Dict, Optional, Tuple, Union
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, UploadFilterResponse
+
+logger = logging.getLogger(__name__)
+
+# The only room events the bot needs: memberships, to find DMs and be told of
+# invites, and encryption, to know how to send to a room
+SYNC_EVENT_TYPES = ["m.room.member", "m.room.encryption"]
+
+# The number of timeline events per room returned by a sync. Rooms created by the bot
+# only get a handful of member events at once.
+TIMELINE_LIMIT = 20
+
+# Nothing else is needed, so it is filtered out entirely
+NO_EVENTS = {"not_types": ["*"]}
+
+SyncFilter = Union[str, Dict[str, Any]]
+
+
+def make_sync_filter(lazy_load_members: bool, timeline_limit: int) -> Dict[str, Any]:
+    """Build a sync filter that only returns the events the bot needs.
+
+    Args:
+        lazy_load_members: Whether to only return the members of a room that are
+            relevant to the returned events, rather than every member.
+
+        timeline_limit: The maximum number of timeline events returned per room.
+    """
+    room_events = {"types": SYNC_EVENT_TYPES, "lazy_load_members": lazy_load_members}
+    return {
+        "presence": NO_EVENTS,
+        "account_data": NO_EVENTS,
+        "room": {
+            "state": room_events,
+            "timeline": {**room_events, "limit": timeline_limit},
+            "ephemeral": NO_EVENTS,
+            "account_data": NO_EVENTS,
+        },
+    }
+
+
+async def upload_sync_filter(client: AsyncClient, sync_filter: Dict) -> SyncFilter:
+    """Upload a filter to the homeserver, so syncs only need to pass its ID.
+
+    Falls back to passing the whole filter with every sync if uploading fails.
+    """
+    resp = await client.upload_filter(
+        presence=sync_filter["presence"],
+        account_data=sync_filter["account_data"],
+        room=sync_filter["room"],
+    )
+    if isinstance(resp, UploadFilterResponse):
+        return resp.filter_id
+
+    logger.warning(f"Failed to upload the sync filter, sending it inline: {resp}")
+    return sync_filter
+
+
+async def get_sync_filters(
+    client: AsyncClient, lazy_load_members: bool
+) -> Tuple[Optional[SyncFilter], Optional[SyncFilter]]:
+    """Get the filters of the first sync and of the syncs after it.
+
+    The first sync does not backfill the timeline: it only needs the current state of
+    the rooms, while later syncs need the new member events as they happen.
+    """
+    first_sync_filter = await upload_sync_filter(
+        client, make_sync_filter(lazy_load_members, timeline_limit=1)
+    )
+    sync_filter = await upload_sync_filter(
+        client, make_sync_filter(lazy_load_members, TIMELINE_LIMIT)
+    )
+    return first_sync_filter, sync_filter
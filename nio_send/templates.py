@@ -0,0 +1,70 @@
+import html
+import re
+from typing import Dict, Optional
+
+from commonmark import commonmark
+from commonmark.common import normalize_uri
+
+from nio_send.utils import LRUCache
+
+# The number of distinct message texts whose rendered HTML is kept
+RENDER_CACHE_SIZE = 1024
+
+# A placeholder filled in per recipient, e.g. `{{first_name}}`
+PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+# A placeholder in a link or image destination, which commonmark percent-encodes
+ENCODED_PLACEHOLDER = re.compile(r"%7B%7B(\w+)%7D%7D", re.IGNORECASE)
+
+# message text -> HTML rendered from its markdown
+_rendered = LRUCache(RENDER_CACHE_SIZE)
+
+
+def render_markdown(message: str) -> str:
+    """Render the markdown of a message to HTML, reusing earlier renderings.
+
+    A campaign sends the same text to many users, so each text is only parsed once.
+    """
+    formatted = _rendered.get(message)
+    if formatted is None:
+        formatted = commonmark(message)
+        _rendered.set(message, formatted)
+    return formatted
+
+
+def fill_placeholders(
+    text: str, variables: Optional[Dict[str, str]], escape: bool = False
+) -> str:
+    """Substitute the `{{name}}` placeholders of a message with per-recipient values.
+
+    Placeholders are filled in after rendering, so the markdown of a template is only
+    rendered once for all of its recipients; the values are inserted as plain text,
+    and are not themselves rendered. Placeholders without a value are left as they are.
+
+    Args:
+        text: The message text, or the HTML rendered from it.
+
+        variables: The values of the placeholders, by name.
+
+        escape: Whether to HTML-escape the values, for filling in rendered HTML. The
+            placeholders of link destinations are then filled in as well, with the
+            values percent-encoded as commonmark encodes destinations.
+    """
+    if not variables:
+        return text
+
+    def substitute(match: re.Match) -> str:
+        value = variables.get(match.group(1))
+        if value is None:
+            return match.group(0)
+        return html.escape(value) if escape else value
+
+    def substitute_encoded(match: re.Match) -> str:
+        value = variables.get(match.group(1))
+        if value is None:
+            return match.group(0)
+        return html.escape(normalize_uri(value))
+
+    text = PLACEHOLDER.sub(substitute, text)
+    if escape:
+        text = ENCODED_PLACEHOLDER.sub(substitute_encoded, text)
+    return text
@@ -1,13 +1,22 @@
 import asyncio
 import logging
 import re
-from typing import List, Optional
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional, Tuple
 
 # noinspection PyPackageRequirements
 import nio
 
+from nio_send.ratelimit import get_rate_limiter
+from nio_send.storage import Storage
+
 logger = logging.getLogger(__name__)
 
+# The number of room aliases remembered, resolved or not
+ALIAS_CACHE_SIZE = 1000
+
 # Domain part from https://stackoverflow.com/a/106223/1489738
 USER_ID_REGEX = (
     r"@[a-z0-9_=\/\-\.]*:(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9]"
@@ -122,12 +131,10 @@ async def get_room_id(
     client: nio.AsyncClient, room: str, logger: logging.Logger
 ) -> str:
     if room.startswith("#"):
-        response = await client.room_resolve_alias(room)
-        if getattr(response, "room_id", None):
-            logger.debug(f"Room '{room}' resolved to {response.room_id}")
-            return response.room_id
+        room_id = await get_alias_resolver(client).resolve(client, room)
+        if room_id is not None:
+            return room_id
         else:
-            logger.warning(f"Could not resolve '{room}' to a room ID")
             raise ValueError("Unknown room alias")
     elif room.startswith("!"):
         return room
@@ -143,20 +150,219 @@ async def sleep_ms(delay_ms):
     await asyncio.sleep(delay_s)
 
 
-def with_ratelimit(func):
+def with_ratelimit(func, endpoint: str = "send"):
     """
-    Decorator for calling client methods with backoff, specified in server response if rate limited.
+    Decorator for calling client methods through the client's rate limiter.
+
+    Requests wait for a token of the endpoint's bucket before they are made. If the
+    server still rate limits a request, the bucket backs off as specified in the server
+    response and the request is retried, up to the limiter's `max_retries` times.
+
+    Args:
+        func: A client method, or a function taking the client as its first argument.
+
+        endpoint: The kind of request, one of the buckets of the rate limiter.
     """
 
     async def wrapper(*args, **kwargs):
+        client = getattr(func, "__self__", None) or args[0]
+        limiter = get_rate_limiter(client)
+        bucket = limiter.buckets[endpoint]
+
+        retries = 0
         while True:
+            await bucket.acquire()
             response = await func(*args, **kwargs)
             if isinstance(response, nio.ErrorResponse):
                 if response.status_code == "M_LIMIT_EXCEEDED":
-                    await sleep_ms(response.retry_after_ms)
+                    bucket.on_rate_limited(response.retry_after_ms)
+                    if retries >= limiter.max_retries:
+                        logger.warning(
+                            f"Giving up on {endpoint} request after {retries} retries"
+                        )
+                        return response
+                    retries += 1
                 else:
                     return response
             else:
+                bucket.on_success()
                 return response
 
     return wrapper
+
+
+class KeyedLock:
+    """A set of asyncio locks, one per key (e.g. a user or room ID).
+
+    Tasks holding locks for different keys run concurrently, while tasks using the
+    same key are serialized in the order they requested the lock. Locks are created on
+    demand and dropped again once no task holds or waits for them.
+    """
+
+    def __init__(self):
+        # key -> [lock, number of tasks holding or waiting for the lock]
+        self._locks: Dict[Any, list] = {}
+
+    def locked(self, key: Any) -> bool:
+        """Whether the lock for a key is currently held"""
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def acquire(self, key: Any) -> AsyncIterator[None]:
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class LRUCache:
+    """A dictionary of bounded size whose entries may expire.
+
+    Lookups, insertions and evictions are O(1). Once full, the least recently used
+    entry is evicted to make room. The number of lookups that found (hits) or did not
+    find (misses) an entry is counted, to judge whether the cache is sized well.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        """
+        Args:
+            max_size: The maximum number of entries.
+
+            ttl: The number of seconds after which an entry expires, or None to keep
+                entries until they are evicted.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (value, expiry time), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of a key, counting the lookup as a hit or a miss"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Set the value of a key, evicting the least recently used entries if full"""
+        now = time.monotonic()
+        expires = now + self.ttl if self.ttl is not None else float("inf")
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        # Drop expired entries that were not used since, while they are cheap to find
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest[1] >= now:
+                break
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a key, returning its value"""
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class AliasResolver:
+    def __init__(
+        self,
+        ttl: float = 3600,
+        negative_ttl: float = 60,
+        store: Optional[Storage] = None,
+    ):
+        """Resolves room aliases to room IDs, remembering the results.
+
+        Sending to a room by alias would otherwise resolve the alias again for every
+        message. Resolved aliases are remembered for `ttl` seconds, and aliases that
+        do not exist for `negative_ttl` seconds, so a missing room does not cost a
+        request per message either. Other failures, such as rate limits or server
+        errors, are not remembered, so the next message tries again. Concurrent
+        lookups of the same alias share a single request.
+
+        Args:
+            ttl: The number of seconds a resolved alias is remembered for.
+
+            negative_ttl: The number of seconds an alias that could not be resolved is
+                remembered for.
+
+            store: Bot storage to keep resolved aliases in across runs, if any.
+        """
+        self.ttl = ttl
+        self.store = store
+
+        # alias -> room ID
+        self.resolved = LRUCache(ALIAS_CACHE_SIZE, ttl)
+        # alias -> True, for aliases that do not exist
+        self.unresolved = LRUCache(ALIAS_CACHE_SIZE, negative_ttl)
+        # alias -> the lookup in progress
+        self.lookups: Dict[str, asyncio.Future] = {}
+
+    async def resolve(self, client: nio.AsyncClient, alias: str) -> Optional[str]:
+        """Get the room ID of an alias, or None if it could not be resolved"""
+        room_id = self.resolved.get(alias)
+        if room_id is not None:
+            return room_id
+        if self.unresolved.get(alias) is not None:
+            return None
+
+        lookup = self.lookups.get(alias)
+        if lookup is None:
+            lookup = self.lookups[alias] = asyncio.ensure_future(
+                self._lookup(client, alias)
+            )
+            lookup.add_done_callback(lambda _: self.lookups.pop(alias, None))
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, client: nio.AsyncClient, alias: str) -> Optional[str]:
+        if self.store is not None:
+            stored = await self.store.get_room_alias(alias)
+            if stored is not None and stored[1] + self.ttl > time.time():
+                self.resolved.set(alias, stored[0])
+                return stored[0]
+
+        response = await with_ratelimit(client.room_resolve_alias, "resolve")(alias)
+        room_id = getattr(response, "room_id", None)
+        if not room_id:
+            logger.warning(f"Could not resolve '{alias}' to a room ID: {response}")
+            if getattr(response, "status_code", None) == "M_NOT_FOUND":
+                self.unresolved.set(alias, True)
+            return None
+
+        logger.debug(f"Room '{alias}' resolved to {room_id}")
+        self.resolved.set(alias, room_id)
+        if self.store is not None:
+            await self.store.set_room_alias(alias, room_id)
+        return room_id
+
+
+def get_alias_resolver(client: nio.AsyncClient) -> AliasResolver:
+    """Get the alias resolver shared by all requests of a client"""
+    resolver = getattr(client, "alias_resolver", None)
+    if resolver is None:
+        resolver = client.alias_resolver = AliasResolver()
+    return resolver
@@ -11,7 +11,7 @@ if [ $# -ge 1 ]
 then
     files=$*
   else
-    files="nio_send/* nio_send tests/*"
+    files="nio_send/* nio_send tests/* benchmarks/*"
 fi
 
 echo "Linting these locations: $files"
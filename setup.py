@@ -28,9 +28,9 @@ setup(
     version=version,
     url="https://github.com/murlock1000/nio-send",
     description="A matrix bot for queuing messages and creating rooms",
-    packages=find_packages(exclude=["tests", "tests.*"]),
+    packages=find_packages(exclude=["tests", "tests.*", "benchmarks", "benchmarks.*"]),
     install_requires=[
-        "matrix-nio[e2e]>=0.10.0",
+        "matrix-nio[e2e]>=0.26.0",
         "Markdown>=3.1.1",
         "PyYAML>=5.1.2",
         "python-magic",
@@ -38,6 +38,7 @@ setup(
     ],
     extras_require={
         "postgres": ["psycopg2>=2.8.5"],
+        "images": ["Pillow", "blurhash-python"],
         "dev": [
             "isort==5.0.4",
             "flake8==3.8.3",
@@ -48,11 +49,11 @@ setup(
     classifiers=[
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python :: 3 :: Only",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
-        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
     ],
+    python_requires=">=3.9",
     long_description=long_description,
     long_description_content_type="text/markdown",
     # Allow the user to run the bot with `nio_send ...`
@@ -0,0 +1,91 @@
+import unittest
+from collections import Counter
+from unittest.mock import AsyncMock, Mock
+
+from nio_send.accounts import AccountPool, HashRing
+
+
+class HashRingTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.users = [f"@user{index}:example.com" for index in range(1000)]
+
+    def test_keys_are_spread_evenly(self):
+        """Tests that every node gets a fair share of the keys"""
+        ring = HashRing(["@bot1:example.com", "@bot2:example.com", "@bot3:example.com"])
+
+        shares = Counter(ring.get(user) for user in self.users)
+
+        self.assertEqual(len(shares), 3)
+        for share in shares.values():
+            self.assertGreater(share, 200)
+
+    def test_adding_a_node_only_moves_its_keys(self):
+        """Tests that keys keep their node, unless the new node takes them over"""
+        before = HashRing(["@bot1:example.com", "@bot2:example.com"])
+        after = HashRing(
+            ["@bot1:example.com", "@bot2:example.com", "@bot3:example.com"]
+        )
+
+        for user in self.users:
+            if after.get(user) != "@bot3:example.com":
+                self.assertEqual(after.get(user), before.get(user))
+
+
+class AccountPoolTestCase(unittest.IsolatedAsyncioTestCase):
+    def make_account(self, user_id: str) -> Mock:
+        account = Mock()
+        account.user_id = user_id
+        account.callbacks.send_msg = AsyncMock()
+        account.callbacks.max_in_flight = 15
+        account.callbacks.dm_index.rooms = {}
+        return account
+
+    async def test_users_always_hear_from_the_same_account(self):
+        """Tests that all messages to a user are sent by one account"""
+        accounts = [
+            self.make_account("@bot1:example.com"),
+            self.make_account("@bot2:example.com"),
+        ]
+        pool = AccountPool(accounts, Mock(), Mock())
+
+        for _ in range(3):
+            for index in range(20):
+                await pool.send_msg(f"@user{index}:example.com", "Hello", "text")
+
+        senders = {}
+        for account in accounts:
+            for call in account.callbacks.send_msg.await_args_list:
+                senders.setdefault(call.args[0], set()).add(account.user_id)
+        self.assertEqual(len(senders), 20)
+        self.assertTrue(all(len(accounts) == 1 for accounts in senders.values()))
+        self.assertEqual(pool.max_in_flight, 30)
+
+    async def test_users_keep_their_dm_rooms(self):
+        """Tests that users who share a DM room with an account hear from it, rather
+        than the account they hash to"""
+        accounts = [
+            self.make_account("@bot1:example.com"),
+            self.make_account("@bot2:example.com"),
+        ]
+        pool = AccountPool(accounts, Mock(), Mock())
+        users = [f"@user{index}:example.com" for index in range(20)]
+        # As when accounts are added to a single account setup
+        accounts[0].callbacks.dm_index.rooms = {
+            user: f"!dm{index}:example.com" for index, user in enumerate(users)
+        }
+
+        for user in users:
+            self.assertIs(pool.account_for(user), accounts[0])
+        # The ring's choice wins among several accounts with a DM room
+        for user in users:
+            accounts[1].callbacks.dm_index.rooms[user] = "!other:example.com"
+            self.assertEqual(pool.account_for(user).user_id, pool.ring.get(user))
+        # Users without a DM room are spread over the accounts
+        self.assertEqual(
+            {pool.account_for(f"@new{index}:example.com") for index in range(20)},
+            set(accounts),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
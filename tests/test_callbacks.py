@@ -1,9 +1,14 @@
+import asyncio
+import os
+import tempfile
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock
 
 import nio
+from aiohttp import ClientConnectionError
 
 from nio_send.callbacks import Callbacks
+from nio_send.campaign import CampaignMessage, MessageState, run_campaign
 from nio_send.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -19,6 +24,14 @@ class CallbacksTestCase(unittest.TestCase):
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.max_concurrent_sends = 10
+        self.fake_config.max_concurrent_room_creates = 5
+        self.fake_config.room_ready_timeout = 120
+        self.fake_config.session_rotation_messages = 100
+        self.fake_config.session_rotation_hours = 168
+        self.fake_config.media_cache_max_age = 30
+        self.fake_config.dedup_cache_size = 1000
+        self.fake_config.dedup_cache_ttl = 3600
 
         self.callbacks = Callbacks(
             self.fake_client, self.fake_storage, self.fake_config
@@ -45,6 +58,166 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    def test_should_process(self):
+        """Tests that each event is only processed once"""
+        self.assertTrue(self.callbacks.should_process("$event1"))
+        self.assertTrue(self.callbacks.should_process("$event2"))
+        self.assertFalse(self.callbacks.should_process("$event1"))
+
+        self.assertEqual(self.callbacks.received_events.hits, 1)
+        self.assertEqual(self.callbacks.received_events.misses, 2)
+
+
+class ResumedMessagesTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.rooms = {}
+
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_storage.set_message_state = AsyncMock()
+
+        self.fake_config = Mock()
+        self.fake_config.max_concurrent_sends = 10
+        self.fake_config.max_concurrent_room_creates = 5
+        self.fake_config.room_ready_timeout = 120
+        self.fake_config.session_rotation_messages = 100
+        self.fake_config.session_rotation_hours = 168
+        self.fake_config.media_cache_max_age = 30
+        self.fake_config.dedup_cache_size = 1000
+        self.fake_config.dedup_cache_ttl = 3600
+
+        self.callbacks = Callbacks(
+            self.fake_client, self.fake_storage, self.fake_config
+        )
+        self.callbacks.prewarmer.prewarm = AsyncMock()
+        self.callbacks.session_policy.observe = Mock()
+
+        self.submitted = []
+
+        def submit(room_id, message):
+            self.submitted.append((room_id, message.txn_id))
+            # Sent right away
+            sent = asyncio.get_running_loop().create_future()
+            sent.set_result(None)
+            return sent
+
+        self.callbacks.room_workers.submit = Mock(side_effect=submit)
+
+    def sync_room(self, room_id: str, mxid: str) -> None:
+        room = nio.MatrixRoom(room_id, self.fake_client.user_id)
+        room.add_member(mxid, None, None, invited=True)
+        self.fake_client.rooms[room_id] = room
+
+    async def test_resumed_into_unsynced_room(self):
+        """Tests that messages resumed into a room that is not synced yet wait for
+        it, rather than fail"""
+        for txn_id in ("txn1", "txn2"):
+            await self.callbacks.send_msg(
+                "@bob:example.com",
+                "Hello",
+                "text",
+                room_id="!old:example.com",
+                txn_id=txn_id,
+            )
+
+        self.assertEqual(self.submitted, [])
+        self.assertEqual(len(self.callbacks.rooms_pending["!old:example.com"]), 2)
+        self.assertEqual(
+            self.callbacks.user_rooms_pending,
+            {"@bob:example.com": ["!old:example.com"]},
+        )
+        self.fake_storage.set_message_state.assert_awaited_with(
+            "txn2", MessageState.ROOM_PENDING, "!old:example.com"
+        )
+        self.assertTrue(self.callbacks.sync_needed.is_set())
+
+        # Messages to the user queue up behind the room, too
+        await self.callbacks.send_msg("@bob:example.com", "Bye", "text", txn_id="txn3")
+
+        self.sync_room("!old:example.com", "@bob:example.com")
+        await self.callbacks.readiness.on_sync(Mock(spec=nio.SyncResponse))
+        await asyncio.gather(*self.callbacks.waiting_rooms)
+
+        self.assertEqual(
+            self.submitted,
+            [
+                ("!old:example.com", "txn1"),
+                ("!old:example.com", "txn2"),
+                ("!old:example.com", "txn3"),
+            ],
+        )
+        self.callbacks.prewarmer.prewarm.assert_awaited_once_with("!old:example.com")
+        self.assertEqual(self.callbacks.rooms_pending, {})
+        self.assertEqual(self.callbacks.user_rooms_pending, {})
+
+    async def test_resumed_into_ready_room(self):
+        """Tests that messages resumed into a synced room are sent right away"""
+        self.sync_room("!old:example.com", "@bob:example.com")
+        await self.callbacks.send_msg(
+            "@bob:example.com",
+            "Hello",
+            "text",
+            room_id="!old:example.com",
+            txn_id="txn1",
+        )
+
+        self.assertEqual(self.submitted, [("!old:example.com", "txn1")])
+        self.assertEqual(self.callbacks.rooms_pending, {})
+
+
+class FailedQueueingTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.rooms = {}
+
+        self.fake_config = Mock()
+        self.fake_config.max_concurrent_sends = 10
+        self.fake_config.max_concurrent_room_creates = 5
+        self.fake_config.room_ready_timeout = 120
+        self.fake_config.session_rotation_messages = 100
+        self.fake_config.session_rotation_hours = 168
+        self.fake_config.media_cache_max_age = 30
+        self.fake_config.dedup_cache_size = 1000
+        self.fake_config.dedup_cache_ttl = 3600
+
+        self.callbacks = Callbacks(self.fake_client, self.store, self.fake_config)
+        self.callbacks.main_loop = Mock()
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+        self.tmp_dir.cleanup()
+
+    async def test_campaign_ends_when_room_creation_raises(self):
+        """Tests that messages whose room can't be created because of an error are
+        failed, so the campaign still ends"""
+        self.callbacks.provisioner.provision = AsyncMock(
+            side_effect=ClientConnectionError("Connection refused")
+        )
+        messages = [
+            CampaignMessage(f"@user{index}:example.com", "text", "Hello", "")
+            for index in range(3)
+        ]
+
+        await run_campaign(self.callbacks, "campaign", messages)
+        self.callbacks.finish_queueing()
+
+        self.assertEqual(self.callbacks.items_to_send, 0)
+        self.callbacks.main_loop.cancel.assert_called_once()
+        self.assertEqual(
+            await self.store.get_campaign_states("campaign"),
+            {MessageState.FAILED: 3},
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
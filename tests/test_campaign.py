@@ -0,0 +1,217 @@
+import json
+import os
+import tempfile
+import unittest
+
+from nio_send.campaign import (
+    CampaignMessage,
+    MessageState,
+    QueuedMessage,
+    get_manifest_campaign,
+    queue_messages,
+    read_manifest,
+)
+from nio_send.errors import ManifestError
+from nio_send.storage import Storage
+
+
+class ReadManifestTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _write(self, filename: str, contents: str) -> str:
+        path = os.path.join(self.tmp_dir.name, filename)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+    def test_read_csv(self):
+        """Tests that CSV rows are converted to campaign messages"""
+        path = self._write(
+            "campaign.csv",
+            "user,type,content,room_name\n"
+            "alice,text,Hello!,Greetings\n"
+            "@bob:other.org,image,banner.png,\n",
+        )
+
+        messages = list(read_manifest(path, "example.com"))
+
+        self.assertEqual(
+            messages,
+            [
+                CampaignMessage("@alice:example.com", "text", "Hello!", "Greetings"),
+                CampaignMessage(
+                    "@bob:other.org",
+                    "image",
+                    os.path.join(self.tmp_dir.name, "banner.png"),
+                    "",
+                ),
+            ],
+        )
+
+    def test_read_jsonl_skips_invalid_rows(self):
+        """Tests that broken or incomplete JSONL rows are skipped"""
+        path = self._write(
+            "campaign.jsonl",
+            "\n".join(
+                [
+                    json.dumps({"user": "alice", "type": "text", "content": "Hi"}),
+                    "{not json",
+                    json.dumps({"user": "bob", "type": "video", "content": "x"}),
+                    json.dumps({"type": "text", "content": "No user"}),
+                    json.dumps({"user": "carol", "type": "text", "content": "Hey"}),
+                ]
+            ),
+        )
+
+        messages = list(read_manifest(path, "example.com"))
+
+        self.assertEqual(
+            [message.user_id for message in messages],
+            ["@alice:example.com", "@carol:example.com"],
+        )
+
+    def test_read_yaml(self):
+        """Tests that YAML manifests are read as a list of messages"""
+        path = self._write(
+            "campaign.yaml",
+            "- user: alice\n  type: text\n  content: Hello\n  room_name: Room\n",
+        )
+
+        self.assertEqual(
+            list(read_manifest(path, "example.com")),
+            [CampaignMessage("@alice:example.com", "text", "Hello", "Room")],
+        )
+
+    def test_placeholder_values(self):
+        """Tests that extra fields of a row are kept as placeholder values"""
+        path = self._write(
+            "campaign.csv",
+            "user,type,content,first_name,city\n"
+            "alice,text,Hi {{first_name}},Alice,\n",
+        )
+
+        self.assertEqual(
+            list(read_manifest(path, "example.com")),
+            [
+                CampaignMessage(
+                    "@alice:example.com",
+                    "text",
+                    "Hi {{first_name}}",
+                    "",
+                    {"first_name": "Alice"},
+                )
+            ],
+        )
+
+    def test_unknown_format(self):
+        """Tests that manifests of an unknown format are rejected up front"""
+        path = self._write("campaign.txt", "")
+
+        with self.assertRaises(ManifestError):
+            read_manifest(path, "example.com")
+
+        with self.assertRaises(ManifestError):
+            read_manifest(os.path.join(self.tmp_dir.name, "missing.csv"), "example.com")
+
+
+class QueueMessagesTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+        self.messages = [
+            CampaignMessage(
+                "@alice:example.com",
+                "text",
+                "Hello {{first_name}}",
+                "Room",
+                {"first_name": "Alice"},
+            ),
+            CampaignMessage("@bob:example.com", "text", "Hello", "Room"),
+        ]
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def _queue(self, campaign: str, messages):
+        return [
+            queued async for queued in queue_messages(self.store, campaign, messages)
+        ]
+
+    async def test_resume_campaign(self):
+        """Tests that running a campaign again only yields its unsent messages"""
+        first_run = await self._queue("campaign", self.messages)
+        self.assertEqual([q.message for q in first_run], self.messages)
+
+        # The first message was sent, the second one was waiting for its room
+        await self.store.set_message_state(first_run[0].txn_id, MessageState.SENT)
+        await self.store.set_message_state(
+            first_run[1].txn_id, MessageState.ROOM_PENDING, "!room:example.com"
+        )
+
+        second_run = await self._queue("campaign", self.messages)
+
+        # The pending message is resent with the same transaction ID and room
+        self.assertEqual(
+            second_run,
+            [QueuedMessage(self.messages[1], first_run[1].txn_id, "!room:example.com")],
+        )
+
+    async def test_unfinished_messages_of_other_campaigns(self):
+        """Tests that unfinished messages of earlier campaigns are sent first"""
+        earlier = await self._queue("earlier", self.messages)
+        # Failed messages are not retried
+        await self.store.set_message_state(earlier[1].txn_id, MessageState.FAILED)
+
+        new_message = CampaignMessage("@carol:example.com", "text", "Hi", "")
+        queued = await self._queue("new", [new_message])
+
+        self.assertEqual(
+            [q.message for q in queued],
+            [self.messages[0], new_message],
+        )
+        self.assertEqual(queued[0].txn_id, earlier[0].txn_id)
+
+    async def test_unfinished_messages_in_queued_order(self):
+        """Tests that unfinished messages of earlier campaigns are resumed in the order
+        they were queued, rather than by campaign ID"""
+        first = await self._queue("zzz", self.messages[:1])
+        second = await self._queue("aaa", self.messages[1:])
+
+        queued = await self._queue("new", [])
+
+        self.assertEqual(
+            [q.txn_id for q in queued], [first[0].txn_id, second[-1].txn_id]
+        )
+
+    async def test_manifest_runs(self):
+        """Tests that a manifest is resumed while it has unsent messages, and sent
+        again once it was finished"""
+        self.assertEqual(await get_manifest_campaign(self.store, "hash"), "hash")
+        first_run = await self._queue("hash", self.messages)
+
+        # Interrupted, so resumed
+        await self.store.set_message_state(first_run[0].txn_id, MessageState.SENT)
+        self.assertEqual(await get_manifest_campaign(self.store, "hash"), "hash")
+
+        # Finished, so sent again
+        await self.store.set_message_state(first_run[1].txn_id, MessageState.FAILED)
+        self.assertEqual(await get_manifest_campaign(self.store, "hash"), "hash:2")
+        second_run = await self._queue("hash:2", self.messages)
+        self.assertEqual([q.message for q in second_run], self.messages)
+        self.assertEqual(await get_manifest_campaign(self.store, "hash"), "hash:2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from nio_send.campaign import MessageState
+from nio_send.daemon import JobServer, JobState
+from nio_send.storage import Storage
+
+
+class JobServerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+
+        self.fake_config = Mock()
+        self.fake_config.user_suffix = "example.com"
+        self.fake_config.daemon_token = None
+        self.media_dir = os.path.join(self.tmp_dir.name, "media")
+        os.mkdir(self.media_dir)
+        self.fake_config.daemon_media_dir = os.path.realpath(self.media_dir)
+
+        self.fake_callbacks = Mock()
+        self.fake_callbacks.config = self.fake_config
+        self.fake_callbacks.store = self.store
+        self.fake_callbacks.max_in_flight = 15
+
+        async def send_msg(mxid, content, message_type, txn_id=None, **kwargs):
+            await self.store.set_message_state(txn_id, MessageState.SENT)
+
+        self.fake_callbacks.send_msg = AsyncMock(side_effect=send_msg)
+
+        self.job_server = JobServer(self.fake_callbacks, self.fake_config)
+        self.client = TestClient(TestServer(self.job_server.app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        await self.store.close()
+        self.tmp_dir.cleanup()
+
+    async def test_submit_job(self):
+        """Tests that the messages of a job are sent, and its state reported"""
+        resp = await self.client.post(
+            "/jobs",
+            json={
+                "messages": [
+                    {"user": "alice", "type": "text", "content": "Hello"},
+                    {"user": "bob", "type": "text", "content": "Hello"},
+                ]
+            },
+        )
+        self.assertEqual(resp.status, 201)
+        job_id = (await resp.json())["job_id"]
+
+        self.assertEqual(
+            await self.wait_for_job(job_id),
+            {
+                "job_id": job_id,
+                "state": JobState.DONE,
+                "messages": {MessageState.SENT: 2},
+            },
+        )
+        self.assertEqual(
+            [call.args[0] for call in self.fake_callbacks.send_msg.await_args_list],
+            ["@alice:example.com", "@bob:example.com"],
+        )
+        # Finished jobs are reported from the database alone
+        self.assertEqual(self.job_server.jobs, {})
+
+    async def test_sending_once_queued(self):
+        """Tests that a job is reported as sending once all of its messages were
+        queued, while they are still being sent"""
+        can_send = asyncio.Event()
+        send_msg = self.fake_callbacks.send_msg.side_effect
+
+        async def slow_send_msg(*args, **kwargs):
+            await can_send.wait()
+            await send_msg(*args, **kwargs)
+
+        self.fake_callbacks.send_msg.side_effect = slow_send_msg
+        resp = await self.client.post(
+            "/jobs",
+            json={
+                "messages": [
+                    {"user": "alice", "type": "text", "content": "Hello"},
+                    {"user": "bob", "type": "text", "content": "Hello"},
+                ]
+            },
+        )
+        job_id = (await resp.json())["job_id"]
+
+        self.assertEqual(
+            await self.wait_for_job(job_id, state=JobState.SENDING),
+            {
+                "job_id": job_id,
+                "state": JobState.SENDING,
+                "messages": {MessageState.QUEUED: 2},
+            },
+        )
+
+        can_send.set()
+        await self.wait_for_job(job_id)
+
+    async def wait_for_job(
+        self, job_id: str, headers=None, state: str = JobState.DONE
+    ) -> dict:
+        """Poll the state of a job until it is done, or in the given state"""
+        for _ in range(100):
+            resp = await self.client.get(f"/jobs/{job_id}", headers=headers)
+            status = await resp.json()
+            if status["state"] == state:
+                return status
+            await asyncio.sleep(0.05)
+        self.fail(f"Job {job_id} did not reach {state}")
+
+    async def test_json_and_token_are_required(self):
+        """Tests that only JSON requests with the configured token are accepted"""
+        job = {"messages": [{"user": "alice", "type": "text", "content": "Hello"}]}
+
+        # As a web page could send it, without a CORS preflight
+        resp = await self.client.post(
+            "/jobs", data=json.dumps(job), headers={"Content-Type": "text/plain"}
+        )
+        self.assertEqual(resp.status, 415)
+
+        self.fake_config.daemon_token = "secret"
+        resp = await self.client.post("/jobs", json=job)
+        self.assertEqual(resp.status, 401)
+        resp = await self.client.post(
+            "/jobs", json=job, headers={"Authorization": "Bearer wrong"}
+        )
+        self.assertEqual(resp.status, 401)
+        self.fake_callbacks.send_msg.assert_not_awaited()
+
+        headers = {"Authorization": "Bearer secret"}
+        resp = await self.client.post("/jobs", json=job, headers=headers)
+        self.assertEqual(resp.status, 201)
+        job_id = (await resp.json())["job_id"]
+        resp = await self.client.get(f"/jobs/{job_id}")
+        self.assertEqual(resp.status, 401)
+        await self.wait_for_job(job_id, headers)
+
+    async def test_files_are_limited_to_media_dir(self):
+        """Tests that only files in the media directory can be sent"""
+        with open(os.path.join(self.media_dir, "banner.png"), "wb") as f:
+            f.write(b"not really a png")
+
+        for content in ("/etc/passwd", "../bot.db"):
+            resp = await self.client.post(
+                "/jobs",
+                json={
+                    "messages": [{"user": "eve", "type": "file", "content": content}]
+                },
+            )
+            self.assertEqual(resp.status, 400)
+        self.fake_callbacks.send_msg.assert_not_awaited()
+
+        resp = await self.client.post(
+            "/jobs",
+            json={
+                "messages": [{"user": "bob", "type": "image", "content": "banner.png"}]
+            },
+        )
+        self.assertEqual(resp.status, 201)
+        await self.wait_for_job((await resp.json())["job_id"])
+        self.assertEqual(
+            self.fake_callbacks.send_msg.await_args.args[1],
+            os.path.join(self.fake_config.daemon_media_dir, "banner.png"),
+        )
+
+        # No files at all, without a media directory
+        self.fake_config.daemon_media_dir = None
+        resp = await self.client.post(
+            "/jobs",
+            json={
+                "messages": [{"user": "bob", "type": "image", "content": "banner.png"}]
+            },
+        )
+        self.assertEqual(resp.status, 400)
+
+    async def test_invalid_jobs_are_rejected(self):
+        """Tests that jobs with invalid messages are rejected as a whole"""
+        resp = await self.client.post(
+            "/jobs",
+            json={
+                "messages": [
+                    {"user": "alice", "type": "text", "content": "Hello"},
+                    {"user": "bob", "type": "video", "content": "clip.mp4"},
+                ]
+            },
+        )
+        self.assertEqual(resp.status, 400)
+
+        resp = await self.client.post(
+            "/jobs", data="not json", headers={"Content-Type": "application/json"}
+        )
+        self.assertEqual(resp.status, 400)
+
+        resp = await self.client.get("/jobs/unknown")
+        self.assertEqual(resp.status, 404)
+
+        self.fake_callbacks.send_msg.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_send.direct_rooms import DirectRoomIndex
+from nio_send.storage import UNCLAIMED_ACCOUNT, Storage
+
+
+class DirectRoomIndexTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.own_user = "@fake_user:example.com"
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = self.own_user
+        self.fake_client.rooms = {}
+
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_storage.get_direct_rooms.return_value = {}
+
+        self.index = DirectRoomIndex(self.fake_client, self.fake_storage)
+
+    def _make_room(self, room_id: str, *members: str) -> nio.MatrixRoom:
+        room = nio.MatrixRoom(room_id, self.own_user)
+        for member in (self.own_user,) + members:
+            room.add_member(member, None, None)
+        self.fake_client.rooms[room_id] = room
+        return room
+
+    async def test_build(self):
+        """Tests that only rooms shared with exactly one other user are indexed"""
+        self._make_room("!dm:example.com", "@alice:example.com")
+        self._make_room("!group:example.com", "@bob:example.com", "@carol:example.com")
+
+        await self.index.build()
+
+        self.assertEqual(self.index.rooms, {"@alice:example.com": "!dm:example.com"})
+        self.fake_storage.set_direct_room.assert_awaited_once_with(
+            self.own_user, "@alice:example.com", "!dm:example.com"
+        )
+        self.assertEqual(
+            (await self.index.get("@alice:example.com")).room_id, "!dm:example.com"
+        )
+        self.assertIsNone(await self.index.get("@bob:example.com"))
+
+    async def test_build_skipped_when_loaded(self):
+        """Tests that a persisted index is used without scanning all rooms"""
+        self.fake_storage.get_direct_rooms.return_value = {
+            "@alice:example.com": "!dm:example.com"
+        }
+        self._make_room("!dm:example.com", "@alice:example.com")
+        self._make_room("!other:example.com", "@bob:example.com")
+
+        await self.index.load()
+        await self.index.build()
+
+        self.assertNotIn("@bob:example.com", self.index.rooms)
+        self.fake_storage.set_direct_room.assert_not_awaited()
+
+    async def test_update(self):
+        """Tests that member events add and remove DM rooms"""
+        room = self._make_room("!dm:example.com")
+
+        # Inviting a user to our room turns it into a DM
+        room.add_member("@alice:example.com", None, None, invited=True)
+        invite = Mock(spec=nio.RoomMemberEvent)
+        invite.membership = "invite"
+        invite.state_key = "@alice:example.com"
+        await self.index.update(room, invite)
+
+        self.assertEqual(await self.index.get("@alice:example.com"), room)
+
+        # The user leaving removes it again
+        room.remove_member("@alice:example.com")
+        leave = Mock(spec=nio.RoomMemberEvent)
+        leave.membership = "leave"
+        leave.state_key = "@alice:example.com"
+        await self.index.update(room, leave)
+
+        self.assertIsNone(await self.index.get("@alice:example.com"))
+        self.fake_storage.delete_direct_room.assert_awaited_once_with(
+            self.own_user, "@alice:example.com"
+        )
+
+    async def test_get_drops_stale_rooms(self):
+        """Tests that rooms which are no longer DMs are dropped from the index"""
+        self.fake_storage.get_direct_rooms.return_value = {
+            "@alice:example.com": "!gone:example.com"
+        }
+        await self.index.load()
+
+        self.assertIsNone(await self.index.get("@alice:example.com"))
+        self.assertEqual(self.index.rooms, {})
+
+
+class ClaimDirectRoomsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+        self.tmp_dir.cleanup()
+
+    async def test_claim_direct_rooms(self):
+        """Tests that the DM rooms of a single account setup are kept for the main
+        account"""
+        await self.store.set_direct_room(
+            UNCLAIMED_ACCOUNT, "@alice:example.com", "!dm:example.com"
+        )
+        await self.store.claim_direct_rooms("@bot1:example.com")
+
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.user_id = "@bot1:example.com"
+        index = DirectRoomIndex(fake_client, self.store)
+        await index.load()
+        self.assertEqual(index.rooms, {"@alice:example.com": "!dm:example.com"})
+        self.assertEqual(await self.store.get_direct_rooms(UNCLAIMED_ACCOUNT), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from nio_send.media import (
+    BLURHASH_KEY,
+    CHUNK_SIZE,
+    MediaCache,
+    UploadedMedia,
+    describe_image,
+    read_file_chunks,
+    upload_file,
+)
+from nio_send.preparation import FileInfo, ImageInfo, Thumbnail
+from nio_send.storage import Storage
+from nio_send.utils import LRUCache
+
+
+class MediaCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+        self.media_cache = MediaCache(self.store, max_age_days=1)
+
+        self.file_path = os.path.join(self.tmp_dir.name, "banner.png")
+        with open(self.file_path, "wb") as f:
+            f.write(b"not really a png")
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def test_file_info_is_cached(self):
+        """Tests that an unchanged file is only inspected once"""
+        file_stat = os.stat(self.file_path)
+        expected = FileInfo(
+            hashlib.sha256(b"not really a png").hexdigest(), "image/png"
+        )
+
+        self.assertEqual(
+            await self.media_cache.get_file_info(self.file_path, file_stat), expected
+        )
+        with patch("nio_send.media.inspect_file") as inspect_file:
+            self.assertEqual(
+                await self.media_cache.get_file_info(self.file_path, file_stat),
+                expected,
+            )
+            # Also kept in the database, for later runs
+            self.media_cache.file_infos = LRUCache(1)
+            self.assertEqual(
+                await self.media_cache.get_file_info(self.file_path, file_stat),
+                expected,
+            )
+            inspect_file.assert_not_called()
+
+    async def test_replaced_file_is_inspected(self):
+        """Tests that a file replaced by another one is inspected again, even if its
+        size and modification time did not change"""
+        file_stat = os.stat(self.file_path)
+        await self.media_cache.get_file_info(self.file_path, file_stat)
+
+        other_path = os.path.join(self.tmp_dir.name, "other.png")
+        with open(other_path, "wb") as f:
+            f.write(b"not really a PNG")
+        os.utime(other_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        os.replace(other_path, self.file_path)
+
+        info = await self.media_cache.get_file_info(
+            self.file_path, os.stat(self.file_path)
+        )
+        self.assertEqual(info.sha256, hashlib.sha256(b"not really a PNG").hexdigest())
+
+    async def test_uri_reuse_and_eviction(self):
+        """Tests that uploaded uris are reused until they are stale"""
+        media = UploadedMedia("mxc://example.com/AbCdEf")
+        await self.media_cache.set_upload("abc", 16, media)
+        self.assertEqual(await self.media_cache.get_upload("abc", 16, False), media)
+
+        # Content of a different size is a different file
+        self.assertIsNone(await self.media_cache.get_upload("abc", 17, False))
+        # And plain uploads can't be sent as encrypted attachments
+        self.assertIsNone(await self.media_cache.get_upload("abc", 16, True))
+
+        # Invalid uris are evicted
+        await self.media_cache.set_upload(
+            "def", 16, UploadedMedia("https://example.com/f")
+        )
+        self.assertIsNone(await self.media_cache.get_upload("def", 16, False))
+        self.assertIsNone(await self.store.get_media_uri("def", 16, False))
+
+        # As are ones that are too old
+        with patch("nio_send.storage.time.time", return_value=time.time() - 2 * 86400):
+            await self.media_cache.set_upload(
+                "ghi", 16, UploadedMedia("mxc://example.com/GhI")
+            )
+        self.assertIsNone(await self.media_cache.get_upload("ghi", 16, False))
+
+        # Or evicted up front
+        with patch("nio_send.storage.time.time", return_value=time.time() - 2 * 86400):
+            await self.media_cache.set_upload(
+                "jkl", 16, UploadedMedia("mxc://example.com/JkL")
+            )
+        await self.media_cache.evict_stale()
+        self.assertIsNone(await self.store.get_media_uri("jkl", 16, False))
+        self.assertIsNotNone(await self.store.get_media_uri("abc", 16, False))
+
+    async def test_encrypted_upload(self):
+        """Tests that encrypted uploads are cached with their decryption info"""
+        file_info = {
+            "v": "v2",
+            "key": {"kty": "oct", "alg": "A256CTR", "k": "secret"},
+            "iv": "iv",
+            "hashes": {"sha256": "hash"},
+        }
+        media = UploadedMedia("mxc://example.com/EnC", file_info)
+        await self.media_cache.set_upload("abc", 16, media)
+
+        cached = await self.media_cache.get_upload("abc", 16, True)
+        self.assertEqual(cached, media)
+        self.assertEqual(
+            cached.as_file(), {"url": "mxc://example.com/EnC", **file_info}
+        )
+        self.assertIsNone(await self.media_cache.get_upload("abc", 16, False))
+
+    async def test_image_info(self):
+        """Tests that the description of an image is cached with its upload"""
+        media = UploadedMedia("mxc://example.com/AbC")
+        await self.media_cache.set_upload("abc", 16, media)
+        self.assertIsNone((await self.media_cache.get_upload("abc", 16, False)).info)
+
+        media = media._replace(info={"w": 1600, "h": 900})
+        await self.media_cache.set_info("abc", 16, media)
+        self.assertEqual(await self.media_cache.get_upload("abc", 16, False), media)
+
+
+class DescribeImageTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.thumbnail_path = os.path.join(self.tmp_dir.name, "thumbnail")
+        with open(self.thumbnail_path, "wb") as f:
+            f.write(b"a small jpeg")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def test_describe_image(self):
+        """Tests that images are described with their dimensions, blurhash and an
+        uploaded thumbnail"""
+        image = ImageInfo(
+            1600,
+            900,
+            "LEHV6nWB2yk8pyo0adR*.7kCMdnj",
+            Thumbnail(self.thumbnail_path, 800, 450, "image/jpeg", 12),
+        )
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.upload = AsyncMock(
+            return_value=(nio.UploadResponse("mxc://example.com/ThU"), None)
+        )
+
+        with patch("nio_send.media.inspect_image", return_value=image):
+            info = await describe_image(
+                fake_client,
+                "banner.png",
+                UploadedMedia("mxc://example.com/BaN"),
+                "image/png",
+                123456,
+            )
+
+        self.assertEqual(
+            info,
+            {
+                "w": 1600,
+                "h": 900,
+                BLURHASH_KEY: "LEHV6nWB2yk8pyo0adR*.7kCMdnj",
+                "thumbnail_url": "mxc://example.com/ThU",
+                "thumbnail_info": {
+                    "w": 800,
+                    "h": 450,
+                    "mimetype": "image/jpeg",
+                    "size": 12,
+                },
+            },
+        )
+        # The thumbnail is only needed until it is uploaded
+        self.assertFalse(os.path.exists(self.thumbnail_path))
+
+    async def test_small_images_are_their_own_thumbnail(self):
+        """Tests that images smaller than a thumbnail are used as their thumbnail"""
+        file_info = {"v": "v2", "key": {"k": "secret"}, "iv": "iv", "hashes": {}}
+        media = UploadedMedia("mxc://example.com/IcO", file_info)
+        fake_client = Mock(spec=nio.AsyncClient)
+
+        with patch("nio_send.media.inspect_image", return_value=ImageInfo(64, 48)):
+            info = await describe_image(
+                fake_client, "icon.png", media, "image/png", 2048
+            )
+
+        self.assertEqual(
+            info,
+            {
+                "w": 64,
+                "h": 48,
+                "thumbnail_file": media.as_file(),
+                "thumbnail_info": {
+                    "w": 64,
+                    "h": 48,
+                    "mimetype": "image/png",
+                    "size": 2048,
+                },
+            },
+        )
+        fake_client.upload.assert_not_called()
+
+    async def test_without_image_dependencies(self):
+        """Tests that images are sent undescribed without the image dependencies"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        with patch("nio_send.preparation.Image", new=None):
+            self.assertEqual(
+                await describe_image(
+                    fake_client,
+                    "banner.png",
+                    UploadedMedia("mxc://example.com/BaN"),
+                    "image/png",
+                    123456,
+                ),
+                {},
+            )
+        fake_client.upload.assert_not_called()
+
+
+class UploadTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "large.bin")
+        self.size = CHUNK_SIZE * 3 + 10
+        with open(self.file_path, "wb") as f:
+            f.write(os.urandom(self.size))
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def test_read_file_chunks(self):
+        """Tests that files are read in bounded chunks, with progress reported"""
+        progress = Mock()
+        chunks = [
+            chunk
+            async for chunk in read_file_chunks(self.file_path, self.size, progress)
+        ]
+
+        self.assertEqual([len(chunk) for chunk in chunks], [CHUNK_SIZE] * 3 + [10])
+        # The end of the upload is always reported
+        transferred, total, _ = progress.call_args.args
+        self.assertEqual((transferred, total), (self.size, self.size))
+
+    async def test_upload_retries(self):
+        """Tests that rate limited uploads are retried with a fresh stream"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        uploaded = []
+
+        async def fake_upload(data_provider, **kwargs):
+            uploaded.append(
+                b"".join([chunk async for chunk in data_provider(len(uploaded), 0)])
+            )
+            if len(uploaded) == 1:
+                return (
+                    nio.UploadError("Too many requests", "M_LIMIT_EXCEEDED", 10),
+                    None,
+                )
+            return nio.UploadResponse("mxc://example.com/AbC"), None
+
+        fake_client.upload = AsyncMock(side_effect=fake_upload)
+
+        with patch("nio_send.media.sleep_ms", new=AsyncMock()) as sleep_ms:
+            media = await upload_file(
+                fake_client, self.file_path, "application/octet-stream", self.size
+            )
+
+        self.assertEqual(media, UploadedMedia("mxc://example.com/AbC"))
+        # The rate limiter, rather than a fixed delay, holds back the retry
+        sleep_ms.assert_not_awaited()
+        self.assertEqual(len(uploaded), 2)
+        self.assertEqual(len(uploaded[1]), self.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
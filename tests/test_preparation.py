@@ -0,0 +1,204 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+from nio.crypto.attachments import decrypt_attachment
+
+from nio_send.media import upload_file
+from nio_send.preparation import (
+    THUMBNAIL_SIZE,
+    FileInfo,
+    FilePreparer,
+    Image,
+    guess_mime_type,
+    inspect_file,
+    inspect_image,
+)
+
+
+class FilePreparerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "notes.txt")
+        self.content = b"some notes\n" * 20000
+        with open(self.file_path, "wb") as f:
+            f.write(self.content)
+
+        self.preparer = FilePreparer(max_workers=1, max_queued=2, encrypt_files=True)
+
+    def tearDown(self) -> None:
+        self.preparer.executor.shutdown()
+        self.tmp_dir.cleanup()
+
+    async def test_inspect_file(self):
+        """Tests that files are hashed and sniffed by the workers"""
+        self.assertEqual(
+            await self.preparer.inspect_file(self.file_path),
+            FileInfo(hashlib.sha256(self.content).hexdigest(), "text/plain"),
+        )
+
+    def test_mime_type_fast_path(self):
+        """Tests that known extensions are trusted, and other files sniffed"""
+        with patch("nio_send.preparation.magic") as magic:
+            self.assertEqual(inspect_file(self.file_path).mime_type, "text/plain")
+            magic.from_buffer.assert_not_called()
+
+        unknown_path = os.path.join(self.tmp_dir.name, "notes")
+        os.rename(self.file_path, unknown_path)
+        self.assertIsNone(guess_mime_type(unknown_path))
+        self.assertEqual(inspect_file(unknown_path).mime_type, "text/plain")
+
+    async def test_encrypt_file(self):
+        """Tests that an encrypted file decrypts to the original content"""
+        encrypted_path, file_info = await self.preparer.encrypt_file(self.file_path)
+        try:
+            with open(encrypted_path, "rb") as f:
+                ciphertext = f.read()
+        finally:
+            os.remove(encrypted_path)
+
+        self.assertNotEqual(ciphertext, self.content)
+        self.assertEqual(
+            decrypt_attachment(
+                ciphertext,
+                file_info["key"]["k"],
+                file_info["hashes"]["sha256"],
+                file_info["iv"],
+            ),
+            self.content,
+        )
+
+    async def test_streamed_encryption_by_default(self):
+        """Tests that files are encrypted while they are uploaded, unless the workers
+        are set to encrypt them"""
+        self.preparer.encrypt_files = False
+        self.preparer.encrypt_file = AsyncMock()
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.upload = AsyncMock(
+            return_value=(nio.UploadResponse("mxc://example.com/AbC"), {"v": "v2"})
+        )
+
+        media = await upload_file(
+            fake_client,
+            self.file_path,
+            "text/plain",
+            len(self.content),
+            encrypt=True,
+            preparer=self.preparer,
+        )
+
+        self.assertEqual(media.file_info, {"v": "v2"})
+        self.assertTrue(fake_client.upload.await_args.kwargs["encrypt"])
+        self.preparer.encrypt_file.assert_not_awaited()
+
+    async def test_upload_prepared_file(self):
+        """Tests that files encrypted by the workers are uploaded as is"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        uploaded = {}
+
+        async def fake_upload(data_provider, **kwargs):
+            uploaded.update(kwargs)
+            uploaded["data"] = b"".join(
+                [chunk async for chunk in data_provider(False, 0)]
+            )
+            return nio.UploadResponse("mxc://example.com/AbC"), None
+
+        fake_client.upload = AsyncMock(side_effect=fake_upload)
+
+        media = await upload_file(
+            fake_client,
+            self.file_path,
+            "text/plain",
+            len(self.content),
+            encrypt=True,
+            preparer=self.preparer,
+        )
+
+        self.assertEqual(media.uri, "mxc://example.com/AbC")
+        self.assertTrue(media.encrypted)
+        # Already encrypted, so not encrypted again while uploading
+        self.assertFalse(uploaded["encrypt"])
+        self.assertEqual(uploaded["content_type"], "application/octet-stream")
+        self.assertEqual(uploaded["filename"], "notes.txt")
+        self.assertEqual(
+            decrypt_attachment(
+                uploaded["data"],
+                media.file_info["key"]["k"],
+                media.file_info["hashes"]["sha256"],
+                media.file_info["iv"],
+            ),
+            self.content,
+        )
+
+
+@unittest.skipUnless(Image, "Pillow is not installed")
+class InspectImageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _write_image(self, filename: str, mode: str, size, **kwargs) -> str:
+        path = os.path.join(self.tmp_dir.name, filename)
+        Image.new(mode, size, "red").save(path, **kwargs)
+        return path
+
+    def _inspect(self, path: str):
+        info = inspect_image(path)
+        if info.thumbnail is not None:
+            self.addCleanup(os.remove, info.thumbnail.path)
+        return info
+
+    def _assert_thumbnail(self, info, mime_type: str, image_format: str):
+        thumbnail = info.thumbnail
+        self.assertEqual(thumbnail.mime_type, mime_type)
+        self.assertLessEqual(thumbnail.width, THUMBNAIL_SIZE[0])
+        self.assertLessEqual(thumbnail.height, THUMBNAIL_SIZE[1])
+        self.assertEqual(thumbnail.size, os.path.getsize(thumbnail.path))
+        with Image.open(thumbnail.path) as image:
+            self.assertEqual(image.format, image_format)
+            self.assertEqual(image.size, (thumbnail.width, thumbnail.height))
+
+    def test_small_image(self):
+        """Tests that images within THUMBNAIL_SIZE are their own thumbnail"""
+        info = self._inspect(self._write_image("small.png", "RGB", (64, 48)))
+
+        self.assertEqual((info.width, info.height), (64, 48))
+        self.assertIsNone(info.thumbnail)
+
+    def test_large_image(self):
+        """Tests that larger images get a JPEG thumbnail within THUMBNAIL_SIZE"""
+        info = self._inspect(self._write_image("large.png", "RGB", (1600, 1200)))
+
+        self.assertEqual((info.width, info.height), (1600, 1200))
+        self._assert_thumbnail(info, "image/jpeg", "JPEG")
+        self.assertEqual((info.thumbnail.width, info.thumbnail.height), (800, 600))
+
+    def test_large_transparent_image(self):
+        """Tests that transparent images get a PNG thumbnail, keeping transparency"""
+        info = self._inspect(self._write_image("large.png", "RGBA", (2000, 500)))
+
+        self._assert_thumbnail(info, "image/png", "PNG")
+        self.assertEqual((info.thumbnail.width, info.thumbnail.height), (800, 200))
+
+    def test_rotated_image(self):
+        """Tests that images are measured and thumbnailed the way they are displayed,
+        after applying their EXIF orientation"""
+        exif = Image.Exif()
+        # Rotated by 90 degrees
+        exif[0x0112] = 6
+        path = self._write_image("rotated.jpg", "RGB", (1200, 900), exif=exif)
+
+        info = self._inspect(path)
+
+        self.assertEqual((info.width, info.height), (900, 1200))
+        self._assert_thumbnail(info, "image/jpeg", "JPEG")
+        self.assertEqual((info.thumbnail.width, info.thumbnail.height), (450, 600))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_send.prewarm import SessionPrewarmer
+
+
+class SessionPrewarmerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.olm = Mock()
+        self.fake_client.olm.should_share_group_session.return_value = True
+        self.fake_client.should_query_keys = True
+        self.fake_client.sharing_session = {}
+        self.fake_client.get_users_for_key_claiming.return_value = {
+            "@alice:example.com": ["DEVICE"]
+        }
+        self.fake_client.rooms = {}
+        for room_id in ("!a:example.com", "!b:example.com", "!plain:example.com"):
+            room = nio.MatrixRoom(room_id, "@bot:example.com")
+            room.encrypted = room_id != "!plain:example.com"
+            self.fake_client.rooms[room_id] = room
+
+        for method in (
+            "joined_members",
+            "keys_query",
+            "keys_claim",
+            "share_group_session",
+        ):
+            setattr(self.fake_client, method, AsyncMock())
+
+    async def test_rooms_are_prepared_in_one_batch(self):
+        """Tests that rooms ready at the same time share one keys query and claim"""
+        prewarmer = SessionPrewarmer(self.fake_client, window=0.01)
+
+        await asyncio.gather(
+            prewarmer.prewarm("!a:example.com"),
+            prewarmer.prewarm("!b:example.com"),
+            prewarmer.prewarm("!plain:example.com"),
+        )
+
+        self.assertEqual(self.fake_client.joined_members.await_count, 2)
+        self.fake_client.keys_query.assert_awaited_once()
+        self.fake_client.keys_claim.assert_awaited_once_with(
+            {"@alice:example.com": ["DEVICE"]}
+        )
+        shared = {
+            call.args[0]
+            for call in self.fake_client.share_group_session.await_args_list
+        }
+        self.assertEqual(shared, {"!a:example.com", "!b:example.com"})
+
+    async def test_nothing_to_prepare_without_encryption(self):
+        """Tests that clients without encryption skip prewarming"""
+        self.fake_client.olm = None
+        prewarmer = SessionPrewarmer(self.fake_client, window=0.01)
+
+        await prewarmer.prewarm("!a:example.com")
+
+        self.fake_client.keys_query.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+from unittest.mock import Mock, patch
+
+import nio
+
+from nio_send.provisioning import RoomProvisioner
+
+
+class RoomProvisionerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_in_flight_are_capped(self):
+        """Tests that no more than max_in_flight rooms are created at once"""
+        provisioner = RoomProvisioner(Mock(spec=nio.AsyncClient), max_in_flight=2)
+        in_flight = 0
+        max_seen = 0
+
+        async def create_private_room(client, mxid, room_name):
+            nonlocal in_flight, max_seen
+            in_flight += 1
+            max_seen = max(max_seen, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return nio.RoomCreateResponse(f"!{mxid[1:]}")
+
+        with patch(
+            "nio_send.provisioning.create_private_room", new=create_private_room
+        ):
+            room_ids = await asyncio.gather(
+                *(provisioner.provision(f"@user{i}:example.com", "") for i in range(5))
+            )
+
+        self.assertEqual(max_seen, 2)
+        self.assertEqual(room_ids[0], "!user0:example.com")
+        self.assertEqual(provisioner.created, 5)
+        self.assertGreater(provisioner.rate, 0)
+
+    async def test_failed_creation(self):
+        """Tests that failures are counted and return no room"""
+        provisioner = RoomProvisioner(Mock(spec=nio.AsyncClient), max_in_flight=2)
+
+        async def create_private_room(client, mxid, room_name):
+            return nio.RoomCreateError("Forbidden", "M_FORBIDDEN")
+
+        with patch(
+            "nio_send.provisioning.create_private_room", new=create_private_room
+        ):
+            self.assertIsNone(await provisioner.provision("@user:example.com", ""))
+
+        self.assertEqual((provisioner.created, provisioner.failed), (0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_send.ratelimit import RateLimiter, TokenBucket
+from nio_send.utils import with_ratelimit
+
+
+class TokenBucketTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_then_rate(self):
+        """Tests that requests beyond the burst size are spaced out at the rate"""
+        bucket = TokenBucket(rate=50, burst=2)
+
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        elapsed = time.monotonic() - start
+
+        # Two requests go through at once, the other two wait 1/50s each
+        self.assertGreaterEqual(elapsed, 0.04)
+        self.assertLess(elapsed, 0.5)
+
+    async def test_rate_limited(self):
+        """Tests that a rate limit pauses the bucket and lowers its rate"""
+        bucket = TokenBucket(rate=50, burst=5)
+
+        bucket.on_rate_limited(10)
+        self.assertEqual(bucket.rate, 25)
+
+        start = time.monotonic()
+        await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.01)
+
+        # Successes recover the rate, up to the configured one
+        for _ in range(100):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 50)
+
+
+class WithRatelimitTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_gives_up_after_max_retries(self):
+        """Tests that requests which keep being rate limited are given up on"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.rate_limiter = RateLimiter({"send": (1000, 10)}, max_retries=2)
+        error = nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 1)
+        send = AsyncMock(return_value=error)
+
+        response = await with_ratelimit(send)(fake_client, "!room:example.com")
+
+        self.assertIs(response, error)
+        self.assertEqual(send.await_count, 3)
+
+    async def test_retries_until_success(self):
+        """Tests that rate limited requests are retried"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.rate_limiter = RateLimiter()
+        success = nio.RoomSendResponse("$event", "!room:example.com")
+        send = AsyncMock(
+            side_effect=[
+                nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 1),
+                success,
+            ]
+        )
+
+        response = await with_ratelimit(send)(fake_client, "!room:example.com")
+
+        self.assertIs(response, success)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_send.readiness import RoomReadiness, RoomReadinessTracker
+
+
+class RoomReadinessTrackerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@bot:example.com"
+        self.fake_client.rooms = {}
+        self.fake_client.olm = None
+        self.fake_client.users_for_key_query = set()
+
+        self.room = nio.MatrixRoom("!room:example.com", self.fake_client.user_id)
+        self.room.add_member(self.fake_client.user_id, None, None)
+
+    async def test_ready_once_invited(self):
+        """Tests that an unencrypted room is ready once the invite was synced"""
+        tracker = RoomReadinessTracker(self.fake_client, timeout=1)
+        pending = tracker.track(self.room.room_id, "@alice:example.com")
+        self.assertEqual(pending.state, RoomReadiness.CREATED)
+
+        # The room is synced, but without the invite yet
+        self.fake_client.rooms[self.room.room_id] = self.room
+        await tracker.on_sync(Mock())
+        self.assertEqual(pending.state, RoomReadiness.CREATED)
+
+        self.room.add_member("@alice:example.com", None, None, invited=True)
+        await tracker.on_sync(Mock())
+
+        self.assertTrue(await tracker.wait(self.room.room_id))
+        self.assertEqual(tracker.pending, {})
+
+    async def test_encrypted_room_waits_for_devices(self):
+        """Tests that encrypted rooms are only ready once the devices are known"""
+        self.fake_client.olm = Mock()
+        self.fake_client.users_for_key_query = {"@alice:example.com"}
+        self.room.encrypted = True
+        self.room.add_member("@alice:example.com", None, None, invited=True)
+        self.fake_client.rooms[self.room.room_id] = self.room
+
+        tracker = RoomReadinessTracker(self.fake_client, timeout=1)
+        pending = tracker.track(self.room.room_id, "@alice:example.com")
+        self.assertEqual(pending.state, RoomReadiness.ENCRYPTED)
+
+        self.fake_client.users_for_key_query = set()
+        await tracker.on_keys_query(Mock())
+
+        self.assertEqual(pending.state, RoomReadiness.DEVICES_KNOWN)
+        self.assertTrue(await tracker.wait(self.room.room_id))
+
+    async def test_timeout(self):
+        """Tests that rooms whose invite is never synced time out as unusable"""
+        tracker = RoomReadinessTracker(self.fake_client, timeout=0.01)
+        tracker.track(self.room.room_id, "@alice:example.com")
+
+        self.assertFalse(await tracker.wait(self.room.room_id))
+        self.assertEqual(tracker.pending, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
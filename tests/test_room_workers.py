@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from nio_send.room_workers import RoomWorkers
+
+
+class RoomWorkersTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_order_within_room_and_parallel_rooms(self):
+        """Tests that a room's messages are sent in order, and rooms in parallel"""
+        sent = []
+        in_flight = set()
+        parallel = False
+
+        async def send(room_id: str, message: int):
+            nonlocal parallel
+            in_flight.add(room_id)
+            parallel = parallel or len(in_flight) > 1
+            await asyncio.sleep(0.001)
+            in_flight.discard(room_id)
+            sent.append((room_id, message))
+
+        workers = RoomWorkers(send)
+        futures = [
+            workers.submit(room_id, message)
+            for message in range(5)
+            for room_id in ("!a:example.com", "!b:example.com")
+        ]
+        await asyncio.gather(*futures)
+
+        for room_id in ("!a:example.com", "!b:example.com"):
+            self.assertEqual(
+                [message for room, message in sent if room == room_id], list(range(5))
+            )
+        self.assertTrue(parallel)
+        self.assertEqual(workers.workers, {})
+        self.assertEqual(len(workers.flush_rates), 2)
+
+    async def test_failure_does_not_stop_room(self):
+        """Tests that messages after a failed one are still sent"""
+        sent = []
+
+        async def send(room_id: str, message: int):
+            if message == 0:
+                raise RuntimeError("Boom")
+            sent.append(message)
+
+        workers = RoomWorkers(send)
+        await asyncio.gather(*(workers.submit("!a:example.com", m) for m in range(3)))
+
+        self.assertEqual(sent, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
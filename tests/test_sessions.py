@@ -0,0 +1,60 @@
+import unittest
+from datetime import timedelta
+from unittest.mock import Mock
+
+import nio
+
+from nio_send.sessions import GroupSessionPolicy
+
+
+class GroupSessionPolicyTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.olm = Mock()
+        self.fake_client.olm.outbound_group_sessions = {}
+
+    def share_session(self, room_id: str, session_id: str) -> Mock:
+        session = Mock()
+        session.id = session_id
+        session.shared = True
+        self.fake_client.olm.outbound_group_sessions[room_id] = session
+        return session
+
+    def test_policy_is_applied(self):
+        """Tests that the rotation policy is set on the sessions of rooms"""
+        policy = GroupSessionPolicy(self.fake_client, 500, 24)
+        session = self.share_session("!a:example.com", "session1")
+
+        policy.observe("!a:example.com")
+
+        self.assertEqual(session.max_messages, 500)
+        self.assertEqual(session.max_age, timedelta(hours=24))
+
+    def test_key_shares_are_counted_once_per_session(self):
+        """Tests that a session reused for many messages is only counted once"""
+        policy = GroupSessionPolicy(self.fake_client, 100, 168)
+
+        self.share_session("!a:example.com", "session1")
+        for _ in range(10):
+            policy.observe("!a:example.com")
+        self.assertEqual(policy.key_shares, 1)
+
+        # The session was rotated
+        self.share_session("!a:example.com", "session2")
+        policy.observe("!a:example.com")
+        self.share_session("!b:example.com", "session3")
+        policy.observe("!b:example.com")
+        self.assertEqual(policy.key_shares, 3)
+
+    def test_unshared_sessions_are_ignored(self):
+        """Tests that rooms without keys, or unencrypted clients, are not counted"""
+        policy = GroupSessionPolicy(self.fake_client, 100, 168)
+        session = self.share_session("!a:example.com", "session1")
+        session.shared = False
+
+        policy.observe("!a:example.com")
+        policy.observe("!b:example.com")
+        self.fake_client.olm = None
+        policy.observe("!a:example.com")
+
+        self.assertEqual(policy.key_shares, 0)
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+
+import nio
+from nio.rooms import RoomSummary
+
+from nio_send.direct_rooms import DirectRoomIndex
+from nio_send.snapshot import SyncSnapshot
+from nio_send.storage import Storage
+
+
+class SyncSnapshotTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmp_dir.name, "bot.db"),
+            }
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def make_snapshot(self, user_id: str = "@bot:example.com") -> SyncSnapshot:
+        client = nio.AsyncClient("https://example.com", user_id)
+        client.user_id = user_id
+        dm_index = DirectRoomIndex(client, self.store)
+        return SyncSnapshot(client, self.store, dm_index)
+
+    async def test_restore_without_snapshot(self):
+        """Tests that nothing is restored before a snapshot was saved"""
+        self.assertFalse(await self.make_snapshot().restore())
+
+    async def test_save_and_restore(self):
+        """Tests that the DM rooms are restored with their members and sync token"""
+        snapshot = self.make_snapshot()
+        client = snapshot.client
+        client.next_batch = "s42"
+
+        dm = nio.MatrixRoom("!dm:example.com", client.user_id, encrypted=True)
+        dm.add_member(client.user_id, None, None)
+        dm.add_member("@alice:example.com", None, None, invited=True)
+        dm.members_synced = True
+        client.rooms[dm.room_id] = dm
+        # Rooms that are not DMs are left out
+        client.rooms["!other:example.com"] = nio.MatrixRoom(
+            "!other:example.com", client.user_id
+        )
+        snapshot.dm_index.rooms["@alice:example.com"] = dm.room_id
+
+        await snapshot.save()
+
+        restored = self.make_snapshot()
+        self.assertTrue(await restored.restore())
+
+        self.assertEqual(restored.client.next_batch, "s42")
+        self.assertEqual(list(restored.client.rooms), [dm.room_id])
+        room = restored.client.rooms[dm.room_id]
+        self.assertTrue(room.encrypted)
+        self.assertTrue(room.members_synced)
+        self.assertIn(client.user_id, room.users)
+        self.assertIn("@alice:example.com", room.invited_users)
+        self.assertEqual(room.member_count, 2)
+
+        # Other accounts have snapshots of their own
+        self.assertFalse(await self.make_snapshot("@other:example.com").restore())
+
+    async def test_save_and_restore_summary(self):
+        """Tests that a DM whose other member is only named by the room summary is
+        still found after a restore"""
+        snapshot = self.make_snapshot()
+        client = snapshot.client
+        client.next_batch = "s42"
+
+        # Synced with lazy-loaded members, so only our own membership is known
+        dm = nio.MatrixRoom("!dm:example.com", client.user_id)
+        dm.add_member(client.user_id, None, None)
+        dm.summary = RoomSummary(0, 2, ["@alice:example.com"])
+        client.rooms[dm.room_id] = dm
+        await snapshot.dm_index._set("@alice:example.com", dm.room_id)
+
+        await snapshot.save()
+
+        restored = self.make_snapshot()
+        self.assertTrue(await restored.restore())
+        await restored.dm_index.load()
+
+        room = restored.client.rooms[dm.room_id]
+        self.assertEqual(room.summary, RoomSummary(0, 2, ["@alice:example.com"]))
+        self.assertEqual(room.member_count, 2)
+        self.assertIs(await restored.dm_index.get("@alice:example.com"), room)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_send.sync import SYNC_EVENT_TYPES, get_sync_filters, make_sync_filter
+
+
+class SyncFilterTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_make_sync_filter(self):
+        """Tests that the filter only asks for the room events the bot needs"""
+        sync_filter = make_sync_filter(lazy_load_members=True, timeline_limit=5)
+
+        self.assertEqual(sync_filter["room"]["state"]["types"], SYNC_EVENT_TYPES)
+        self.assertTrue(sync_filter["room"]["state"]["lazy_load_members"])
+        self.assertEqual(sync_filter["room"]["timeline"]["limit"], 5)
+        self.assertEqual(sync_filter["presence"], {"not_types": ["*"]})
+
+    async def test_get_sync_filters(self):
+        """Tests that filters are uploaded, and sent inline if that fails"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        fake_client.upload_filter = AsyncMock(
+            side_effect=[
+                nio.UploadFilterResponse("1"),
+                nio.UploadFilterError("Unknown endpoint", "M_UNRECOGNIZED"),
+            ]
+        )
+
+        first_sync_filter, sync_filter = await get_sync_filters(fake_client, True)
+
+        self.assertEqual(first_sync_filter, "1")
+        self.assertEqual(sync_filter["room"]["timeline"]["types"], SYNC_EVENT_TYPES)
+
+
+if __name__ == "__main__":
+    unittest.main()
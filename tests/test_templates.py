@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import patch
+
+from nio_send import templates
+from nio_send.templates import fill_placeholders, render_markdown
+
+
+class TemplatesTestCase(unittest.TestCase):
+    def test_render_markdown_is_cached(self):
+        """Tests that the same text is only rendered once"""
+        with patch.object(
+            templates, "commonmark", wraps=templates.commonmark
+        ) as commonmark:
+            first = render_markdown("Hello **cached** world")
+            second = render_markdown("Hello **cached** world")
+
+        self.assertEqual(first, "<p>Hello <strong>cached</strong> world</p>\n")
+        self.assertEqual(second, first)
+        commonmark.assert_called_once()
+
+    def test_fill_placeholders(self):
+        """Tests that placeholders are filled in, escaping values in HTML"""
+        variables = {"name": "<Alice & Bob>"}
+        formatted = render_markdown("Hello **{{name}}**, {{ missing }}")
+
+        self.assertEqual(
+            fill_placeholders(formatted, variables, escape=True),
+            "<p>Hello <strong>&lt;Alice &amp; Bob&gt;</strong>, {{ missing }}</p>\n",
+        )
+        self.assertEqual(
+            fill_placeholders("Hello {{name}}", variables), "Hello <Alice & Bob>"
+        )
+        self.assertEqual(fill_placeholders("Hello {{name}}", None), "Hello {{name}}")
+
+    def test_fill_link_placeholders(self):
+        """Tests that placeholders in link destinations are filled in, although
+        commonmark percent-encodes them"""
+        message = "[Open](https://x.org/u/{{id}}?n={{name}}) for {{name}}, {{other}}"
+        variables = {"id": "@bob:x.org", "name": "Bob & Co", "other": "<b>"}
+        formatted = render_markdown(message)
+        self.assertIn("%7B%7Bid%7D%7D", formatted)
+
+        self.assertEqual(
+            fill_placeholders(formatted, variables, escape=True),
+            '<p><a href="https://x.org/u/@bob:x.org?n=Bob%20&amp;%20Co">Open</a> '
+            "for Bob &amp; Co, &lt;b&gt;</p>\n",
+        )
+        self.assertEqual(
+            fill_placeholders(message, variables),
+            "[Open](https://x.org/u/@bob:x.org?n=Bob & Co) for Bob & Co, <b>",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import nio
+
+from nio_send.storage import Storage
+from nio_send.utils import AliasResolver, KeyedLock, LRUCache, get_room_id
+
+
+class KeyedLockTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_same_key_is_serialized(self):
+        """Tests that tasks using the same key run one after another, in order"""
+        locks = KeyedLock()
+        order = []
+
+        async def worker(name: str):
+            async with locks.acquire("@alice:example.com"):
+                order.append(f"{name} start")
+                await asyncio.sleep(0)
+                order.append(f"{name} end")
+
+        await asyncio.gather(worker("first"), worker("second"))
+
+        self.assertEqual(
+            order, ["first start", "first end", "second start", "second end"]
+        )
+
+    async def test_different_keys_run_concurrently(self):
+        """Tests that holding one key does not block another"""
+        locks = KeyedLock()
+        release = asyncio.Event()
+
+        async def holder():
+            async with locks.acquire("@alice:example.com"):
+                await release.wait()
+
+        holder_task = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        self.assertTrue(locks.locked("@alice:example.com"))
+
+        async with locks.acquire("@bob:example.com"):
+            self.assertTrue(locks.locked("@bob:example.com"))
+
+        release.set()
+        await holder_task
+
+        # Unused locks are cleaned up
+        self.assertFalse(locks.locked("@alice:example.com"))
+        self.assertEqual(locks._locks, {})
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        """Tests that a full cache evicts the entry that was used longest ago"""
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_entries_expire(self):
+        """Tests that entries are dropped once their TTL has passed"""
+        cache = LRUCache(max_size=10, ttl=60)
+        with patch("nio_send.utils.time.monotonic", return_value=1000):
+            cache.set("a", 1)
+        with patch("nio_send.utils.time.monotonic", return_value=1059):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("nio_send.utils.time.monotonic", return_value=1061):
+            self.assertIsNone(cache.get("a"))
+            cache.set("b", 2)
+
+        self.assertEqual(len(cache), 1)
+
+
+class AliasResolverTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.room_resolve_alias = AsyncMock(
+            return_value=nio.RoomResolveAliasResponse(
+                "#news:example.com", "!news:example.com", []
+            )
+        )
+        # Requests are made through the client's rate limiter
+        self.fake_client.room_resolve_alias.__self__ = self.fake_client
+
+    async def test_lookups_are_coalesced_and_cached(self):
+        """Tests that an alias is resolved once, however often it is sent to"""
+        self.fake_client.alias_resolver = AliasResolver()
+
+        room_ids = await asyncio.gather(
+            *(
+                get_room_id(self.fake_client, "#news:example.com", Mock())
+                for _ in range(5)
+            )
+        )
+        room_ids.append(
+            await get_room_id(self.fake_client, "#news:example.com", Mock())
+        )
+
+        self.assertEqual(room_ids, ["!news:example.com"] * 6)
+        self.fake_client.room_resolve_alias.assert_awaited_once()
+
+    async def test_unresolved_aliases_are_cached(self):
+        """Tests that an alias that could not be resolved is not retried at once"""
+        self.fake_client.room_resolve_alias.return_value = nio.RoomResolveAliasError(
+            "Room alias not found", "M_NOT_FOUND"
+        )
+        resolver = AliasResolver(negative_ttl=60)
+
+        self.assertIsNone(await resolver.resolve(self.fake_client, "#gone:example.com"))
+        self.assertIsNone(await resolver.resolve(self.fake_client, "#gone:example.com"))
+        self.fake_client.room_resolve_alias.assert_awaited_once()
+
+    async def test_failed_lookups_are_retried(self):
+        """Tests that aliases are looked up again after errors other than the alias
+        not existing"""
+        self.fake_client.room_resolve_alias.return_value = nio.RoomResolveAliasError(
+            "Internal server error", "M_UNKNOWN"
+        )
+        resolver = AliasResolver(negative_ttl=60)
+
+        self.assertIsNone(await resolver.resolve(self.fake_client, "#news:example.com"))
+        self.assertIsNone(await resolver.resolve(self.fake_client, "#news:example.com"))
+        self.assertEqual(self.fake_client.room_resolve_alias.await_count, 2)
+
+    async def test_rate_limited_lookups_are_retried(self):
+        """Tests that rate limited lookups wait for the rate limiter and are retried"""
+        self.fake_client.room_resolve_alias.side_effect = [
+            nio.RoomResolveAliasError("Too many requests", "M_LIMIT_EXCEEDED", 10),
+            nio.RoomResolveAliasResponse("#news:example.com", "!news:example.com", []),
+        ]
+        resolver = AliasResolver()
+
+        self.assertEqual(
+            await resolver.resolve(self.fake_client, "#news:example.com"),
+            "!news:example.com",
+        )
+        self.assertEqual(self.fake_client.room_resolve_alias.await_count, 2)
+        self.assertIn("resolve", self.fake_client.rate_limiter.buckets)
+
+    async def test_resolved_aliases_are_stored(self):
+        """Tests that resolved aliases are reused by later runs"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = Storage(
+                {
+                    "type": "sqlite",
+                    "connection_string": os.path.join(tmp_dir, "bot.db"),
+                }
+            )
+            try:
+                await AliasResolver(store=store).resolve(
+                    self.fake_client, "#news:example.com"
+                )
+                room_id = await AliasResolver(store=store).resolve(
+                    self.fake_client, "#news:example.com"
+                )
+            finally:
+                await store.close()
+
+        self.assertEqual(room_id, "!news:example.com")
+        self.fake_client.room_resolve_alias.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()